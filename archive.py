@@ -0,0 +1,253 @@
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import yaml
+import pandas as pd
+from sqlalchemy import create_engine
+import migration as mig
+from staging import pa, set_dtypes
+from upload import partition_exists
+from utils import get_logger
+
+if pa is not None:
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+# Hive layout: <ARCHIVE_FOLDER>/city=<city>/date=<YYYY-MM-DD>/telemetry.parquet
+PARTITIONING = ['city', 'date']
+ROW_GROUP_SIZE = 128 * 1024
+
+# read back from COPY as text, type inference would turn '00312345' into '312345' and '123' into '123.0'
+TEXT_COLUMNS = ['city', 'uniqueid', 'gosnum', 'bortnum']
+FINGERPRINT_SUMS = ['bus_id', 'speed', 'heading', 'direction', 'probeg']
+FINGERPRINT_TEXT = ['uniqueid', 'gosnum', 'bortnum']
+
+
+def archive_folder(config_):
+    return config_.get('ARCHIVE_FOLDER', 'archive')
+
+
+def day_path(folder, city, date):
+    return f'{folder}/city={city}/date={date.strftime("%Y-%m-%d")}/telemetry.parquet'
+
+
+def export_partition(date, engine_):
+    """
+    Returns telemetry partition of date as DataFrame with city column, sorted by city, route, vehicle and time
+    """
+
+    connection = engine_.raw_connection()
+
+    try:
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as buffer:
+            connection.cursor().copy_expert(mig.ARCHIVE_EXPORT_QUERY.format(date.strftime('%Y_%m_%d')), buffer)
+            buffer.seek(0)
+            df = pd.read_csv(buffer, parse_dates=['timestamp', 'upload_date'],
+                             dtype={column: str for column in TEXT_COLUMNS})
+    finally:
+        connection.close()
+
+    return set_dtypes(df)
+
+
+def fingerprint(df):
+    """
+    Returns content fingerprint of telemetry, same fields as migration.ARCHIVE_FINGERPRINT_QUERY
+    """
+
+    result = {'rows': len(df)}
+
+    for column in FINGERPRINT_SUMS:
+        result[column] = int(df[column].sum()) if column in df.columns else 0
+
+    for column in FINGERPRINT_TEXT:
+        values = df[column].dropna().astype(str) if column in df.columns else pd.Series([], dtype=str)
+        result[f'{column}_count'] = len(values)
+        result[f'{column}_length'] = int(values.str.len().sum())
+
+    return result
+
+
+def read_day(date, folder, cities):
+    """
+    Reads written Parquet files of date back for verification
+    """
+
+    return pd.concat([pq.read_table(day_path(folder, city, date)).to_pandas() for city in cities],
+                     ignore_index=True)
+
+
+def write_day(df, date, folder, compression='zstd'):
+    """
+    Writes one day of telemetry as one Parquet file per city, returns {city: rows written}
+    Files are written next to their target and renamed, so readers never see a partial file
+    """
+
+    if pa is None:
+        raise ImportError('Archiving requires pyarrow')
+
+    written = {}
+
+    for city, part in df.groupby('city', sort=True):
+        path = day_path(folder, city, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        table = pa.Table.from_pandas(part.drop(columns=PARTITIONING, errors='ignore'), preserve_index=False)
+        pq.write_table(table, path + '.tmp', compression=compression, row_group_size=ROW_GROUP_SIZE)
+        os.replace(path + '.tmp', path)
+
+        written[city] = pq.ParquetFile(path).metadata.num_rows
+
+    return written
+
+
+def archive_day(date, config_, engine_, logger_):
+    """
+    Exports a day partition to Parquet, verifies content of the written files against the partition,
+    then detaches and drops the partition
+    Returns number of archived rows, 0 if the day was left in the database
+    """
+
+    suffix = date.strftime('%Y_%m_%d')
+    folder = archive_folder(config_)
+
+    if not partition_exists(f'telemetry_{suffix}', engine_):
+        logger_.debug(f'No partition for {date}, skipping')
+        return 0
+
+    row = engine_.execute(mig.ARCHIVE_FINGERPRINT_QUERY.format(suffix)).fetchone()
+    expected = {key: int(value) for key, value in row.items()}
+
+    # files of an earlier archive of the day (re-loaded since) must not outlive it
+    remove_day(date, config_)
+    written = write_day(export_partition(date, engine_), date, folder, config_.get('ARCHIVE_COMPRESSION', 'zstd'))
+
+    actual = fingerprint(read_day(date, folder, written)) if written else fingerprint(pd.DataFrame())
+
+    if actual != expected:
+        logger_.debug(f'Content mismatch for {date}: partition = {expected} // parquet = {actual}, partition kept')
+        return 0
+
+    with engine_.begin() as connection:
+        connection.execute(mig.ARCHIVE_DROP_DDL.format(suffix, date.strftime('%Y-%m-%d')))
+
+    logger_.debug(f'Archived {date}: {expected["rows"]} rows in {len(written)} cities, partition dropped')
+
+    return expected['rows']
+
+
+def archive_telemetry(config_, engine_, logger_=None, before=None):
+    """
+    Archives every loaded day older than ARCHIVE_AGE_DAYS (or before date) that is not archived yet
+    """
+
+    logger_ = logger_ or get_logger('archive')
+    before = before or datetime.date.today() - datetime.timedelta(days=config_.get('ARCHIVE_AGE_DAYS', 90))
+
+    days = [row[0] for row in engine_.execute(mig.ARCHIVE_DAYS_QUERY.format(before.strftime('%Y-%m-%d')))]
+    logger_.debug(f'{len(days)} days to archive before {before}')
+
+    rows = sum(archive_day(day, config_, engine_, logger_) for day in days)
+
+    logger_.debug(f'Archived {rows} rows')
+
+    return rows
+
+
+def read_archive(folder, start, end, dates=None, routes=None, vehicles=None, cities=None, columns=None):
+    """
+    Reads archived telemetry with timestamp in [start, end) from Parquet
+    Filters are pushed down: city and date prune directories, bus_id, uniqueid and timestamp skip row groups
+    """
+
+    if pa is None:
+        raise ImportError('Reading archive requires pyarrow')
+
+    if not os.path.isdir(folder):
+        return pd.DataFrame()
+
+    dataset = ds.dataset(folder, format='parquet', partitioning=ds.partitioning(
+        pa.schema([('city', pa.string()), ('date', pa.date32())]), flavor='hive'))
+
+    expression = (ds.field('date') >= start.date()) & (ds.field('date') <= end.date()) & \
+                 (ds.field('timestamp') >= pa.scalar(start, pa.timestamp('ns'))) & \
+                 (ds.field('timestamp') < pa.scalar(end, pa.timestamp('ns')))
+
+    if dates is not None:
+        expression &= ds.field('date').isin(pa.array(list(dates), pa.date32()))
+    if routes is not None:
+        expression &= ds.field('bus_id').isin(list(routes))
+    if vehicles is not None:
+        expression &= ds.field('uniqueid').isin(list(vehicles))
+    if cities is not None:
+        expression &= ds.field('city').isin(list(cities))
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def read_telemetry(config_, engine_, start, end, routes=None, vehicles=None, cities=None, columns=None):
+    """
+    Returns telemetry with timestamp in [start, end) from hot partitions and archived days together
+    Archived days are taken from Parquet only, so a day is never read twice
+    """
+
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+
+    query = mig.HOT_TELEMETRY_QUERY
+    params = {'start': start.to_pydatetime(), 'end': end.to_pydatetime()}
+
+    if routes is not None:
+        query += ' and t.bus_id = any(%(routes)s)'
+        params['routes'] = [int(route) for route in routes]
+    if vehicles is not None:
+        query += ' and t.uniqueid = any(%(vehicles)s)'
+        params['vehicles'] = list(vehicles)
+    if cities is not None:
+        query += ' and c.name = any(%(cities)s)'
+        params['cities'] = list(cities)
+
+    hot = pd.read_sql(query, engine_, params=params)
+
+    if columns is not None:
+        hot = hot[columns]
+
+    archived = [row[0] for row in engine_.execute(mig.ARCHIVED_DAYS_QUERY.format(start.strftime('%Y-%m-%d'),
+                                                                                end.strftime('%Y-%m-%d')))]
+
+    if len(archived) == 0:
+        return hot
+
+    cold = read_archive(archive_folder(config_), start, end, archived, routes, vehicles, cities, columns)
+
+    if len(cold) == 0:
+        return hot
+
+    return pd.concat([hot, cold], ignore_index=True) if len(hot) != 0 else cold
+
+
+def remove_day(date, config_):
+    """
+    Removes archived Parquet files of date, e.g. after the day was re-loaded into the database
+    """
+
+    folder = archive_folder(config_)
+
+    for city_folder in os.listdir(folder) if os.path.isdir(folder) else []:
+        shutil.rmtree(f'{folder}/{city_folder}/date={date.strftime("%Y-%m-%d")}', ignore_errors=True)
+
+
+if __name__ == '__main__':
+    with open('config.yaml') as file:
+        config = yaml.Loader(file).get_data()
+
+    postgres_engine = create_engine('postgresql+psycopg2://{}:{}@{}/{}'.format(
+        config['DB_USER'],
+        config['DB_PASS'],
+        config['DB_HOST'],
+        config['DB_NAME']
+    ))
+
+    archive_telemetry(config, postgres_engine,
+                      before=datetime.date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None)
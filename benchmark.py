@@ -0,0 +1,305 @@
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+import yaml
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from utils import get_logger, peak_rss_mb
+from upload import copy_dataframe
+
+
+def synthetic_telemetry(rows, date=datetime.date(2021, 1, 4), routes=100, vehicles=500, seed=0):
+    """
+    Returns pandas.DataFrame shaped like get_telemetry output
+    """
+
+    rng = np.random.default_rng(seed)
+
+    seconds = np.sort(rng.integers(0, 24 * 60 * 60, rows))
+    vehicle = rng.integers(0, vehicles, rows)
+
+    # each vehicle serves one route for the whole day
+    df = pd.DataFrame({
+        'uniqueid': np.char.mod('%08x', vehicle),
+        'timestamp': pd.Timestamp(date) + pd.to_timedelta(seconds, unit='s'),
+        'bus_id': vehicle % routes,
+        'heading': rng.integers(0, 360, rows),
+        'speed': rng.integers(0, 60, rows),
+        'lon': 49.1 + rng.normal(0, 0.05, rows),
+        'lat': 55.8 + rng.normal(0, 0.03, rows),
+        'direction': rng.integers(0, 2, rows),
+        'gosnum': np.char.mod('%04d', vehicle),
+        'bortnum': np.char.mod('%05d', vehicle),
+        'probeg': rng.integers(0, 500000, rows),
+    })
+    df['upload_date'] = datetime.datetime.today()
+
+    return df
+
+
+def synthetic_network(stops=1000, roads=3000, seed=0):
+    """
+    Returns (stops_df, roads_gdf) shaped like dev.get_stops and dev.fetch_roads output
+    Roads are short random polylines around the same center as synthetic_telemetry
+    """
+
+    import geopandas as gpd
+    import shapely
+
+    rng = np.random.default_rng(seed)
+
+    stops_df = pd.DataFrame({
+        'id': np.arange(stops),
+        'lat': 55.8 + rng.normal(0, 0.03, stops),
+        'lon': 49.1 + rng.normal(0, 0.05, stops),
+        'name': [f'stop {i}' for i in range(stops)],
+    })
+    stops_df['utm'] = 32639
+
+    start = np.column_stack([49.1 + rng.normal(0, 0.05, roads), 55.8 + rng.normal(0, 0.03, roads)])
+    steps = rng.normal(0, 0.002, (roads, 5, 2)).cumsum(axis=1)
+    coordinates = np.concatenate([start[:, None, :], start[:, None, :] + steps], axis=1)
+
+    roads_gdf = gpd.GeoDataFrame({
+        'id': np.arange(roads),
+        'name': None,
+        'highway': 'primary',
+    }, geometry=shapely.linestrings(coordinates), crs=4326)
+
+    return stops_df, roads_gdf
+
+
+def notebook_stop_detection(telemetry_df, stops_df, roads_gdf, buffer=50, speed=15):
+    """
+    clip_telemetry + identify_stops from path_detection.ipynb, kept as the baseline
+    """
+
+    import geopandas as gpd
+
+    telemetry_gdf = gpd.GeoDataFrame(telemetry_df, geometry=gpd.points_from_xy(telemetry_df['lon'],
+                                                                                telemetry_df['lat']), crs=4326)
+    stops_gdf = gpd.GeoDataFrame(stops_df, geometry=gpd.points_from_xy(stops_df['lon'], stops_df['lat']), crs=4326)
+
+    epsg = 32600 + int(telemetry_gdf['lon'].mean() + 186) // 6
+
+    telemetry_utm = telemetry_gdf.to_crs(epsg)
+    stops_utm = stops_gdf.to_crs(epsg)
+    roads_utm = roads_gdf.to_crs(epsg)
+
+    joined_buffer = gpd.GeoSeries([stops_utm['geometry'].buffer(buffer).union_all(),
+                                   roads_utm['geometry'].buffer(buffer).union_all()]).union_all()
+
+    clipped = gpd.clip(telemetry_utm, joined_buffer)
+
+    sjoin = gpd.sjoin_nearest(clipped, stops_utm, how='left', max_distance=buffer, rsuffix='stop',
+                              distance_col='dist')
+    sjoin['is_stop'] = (sjoin['id'].notna()) & (sjoin['speed'] <= speed)
+
+    return sjoin
+
+
+def notebook_tracks(marked_df):
+    """
+    get_tracks + aggregate_tracks from path_detection.ipynb, kept as the baseline
+    """
+
+    df = marked_df.rename(columns={'stop_id': 'id', 'stop_name': 'name'})
+    df['id'] = df['id'].astype('float64')
+    df = df.sort_values(['uniqueid', 'timestamp'])
+    df['track'] = ((df['id'] != df['id'].shift(1)) &
+                   (df['id'].shift(1).notna()) |
+                   (df['uniqueid'] != df['uniqueid'].shift(1))).cumsum()
+    df = df.sort_values(['uniqueid', 'timestamp']).reset_index(drop=True)
+
+    df['name'] = df['name'].astype(str)
+    grouped = df.groupby(['track', 'uniqueid', 'bus_id']).agg({
+        'speed': ['mean', 'median'],
+        'timestamp': ['min', 'max'],
+        'x': lambda x: list(x),
+        'name': 'max',
+        'dist': 'min',
+        'id': 'max'
+    }).reset_index()
+
+    grouped.columns = grouped.columns.get_level_values(0).astype(str) + '_' + \
+        grouped.columns.get_level_values(1).astype(str)
+    grouped['id_from'] = grouped['id_max'].shift(1).where(grouped['uniqueid_'] == grouped['uniqueid_'].shift(1))
+
+    return grouped
+
+
+def timed(function, *args, **kwargs):
+    """
+    Returns (result, seconds) of function call
+    """
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+
+    return result, time.perf_counter() - start
+
+
+def bench_copy(config_, engine_, logger_, rows=100000):
+    """
+    Compares DataFrame.to_sql against copy_dataframe on a scratch copy of transport.telemetry
+    """
+
+    df = synthetic_telemetry(rows)
+
+    engine_.execute("""
+        DROP TABLE IF EXISTS transport.telemetry_bench;
+        CREATE TABLE transport.telemetry_bench (LIKE transport.telemetry);
+    """)
+
+    try:
+        _, to_sql_time = timed(df.to_sql, 'telemetry_bench', engine_, index=False, if_exists='append',
+                               schema='transport')
+        engine_.execute("TRUNCATE TABLE transport.telemetry_bench;")
+        _, copy_time = timed(copy_dataframe, df, 'telemetry_bench', engine_, config_.get('COPY_CHUNK_SIZE', 100000))
+    finally:
+        engine_.execute("DROP TABLE IF EXISTS transport.telemetry_bench;")
+
+    logger_.debug(f'to_sql: {rows / to_sql_time:.0f} rows/s // COPY: {rows / copy_time:.0f} rows/s // '
+                  f'speedup x{to_sql_time / copy_time:.1f}')
+
+
+def bench_spatial(config_, engine_, logger_, rows=200000):
+    """
+    Compares notebook buffer/clip/sjoin stop detection against spatial.classify_points on a synthetic city-day
+    """
+
+    from spatial import NetworkIndex, classify_points
+
+    df = synthetic_telemetry(rows)
+    stops_df, roads_gdf = synthetic_network()
+
+    notebook, notebook_time = timed(notebook_stop_detection, df, stops_df, roads_gdf)
+    index, index_time = timed(NetworkIndex, stops_df, roads_gdf)
+    vectorized, classify_time = timed(classify_points, df, index)
+
+    logger_.debug(f'notebook: {rows / notebook_time:.0f} rows/s ({len(notebook)} kept) // '
+                  f'index build: {index_time:.2f}s // classify_points: {rows / classify_time:.0f} rows/s '
+                  f'({len(vectorized)} kept) // speedup x{notebook_time / (index_time + classify_time):.1f}')
+
+
+def bench_tracks(config_, engine_, logger_, rows=500000):
+    """
+    Compares notebook groupby/lambda track aggregation against tracks.build_tracks
+    """
+
+    from spatial import NetworkIndex, classify_points
+    from tracks import build_tracks
+
+    stops_df, roads_gdf = synthetic_network()
+    marked = classify_points(synthetic_telemetry(rows), NetworkIndex(stops_df, roads_gdf), clip=False)
+
+    notebook, notebook_time = timed(notebook_tracks, marked)
+    vectorized, vectorized_time = timed(build_tracks, marked)
+
+    logger_.debug(f'notebook: {rows / notebook_time:.0f} rows/s ({len(notebook)} tracks) // '
+                  f'build_tracks: {rows / vectorized_time:.0f} rows/s ({len(vectorized)} tracks) // '
+                  f'speedup x{notebook_time / vectorized_time:.1f}')
+
+
+def bench_pipeline(config_, engine_, logger_, rows=200000, cities=2, routes=50):
+    """
+    Runs download -> staging -> upload -> spatial end to end against stub_server.StubServer
+    Upload writes a synthetic 2000-01-03 day partition, so it only runs with BENCH_UPLOAD set
+    and a reachable database; the day is dropped again afterwards, dictionary encoding and speed grid
+    are off for it so transport.dictionary and speed_grid are not touched
+    """
+
+    from download import get_cities, get_routes
+    from fetch import fetch_telemetry
+    from upload import read_telemetry_files, upload_telemetry
+    from spatial import NetworkIndex, classify_points
+    from stub_server import StubServer, SyntheticCity
+    from tracks import build_tracks
+    from client import get_client
+
+    import migration as mig
+
+    date = datetime.date(2000, 1, 3)
+    uploaded = False
+    data = SyntheticCity(cities, routes, points=max(rows // (cities * routes), 1))
+    temp_folder = tempfile.mkdtemp(prefix='bench_')
+
+    def report(stage, stage_rows, seconds):
+        logger_.debug(f'{stage}: {stage_rows} rows in {seconds:.2f}s // {stage_rows / max(seconds, 1e-9):.0f} rows/s '
+                      f'// peak RSS {peak_rss_mb():.0f} MB')
+
+    try:
+        with StubServer(data) as stub:
+            config = dict(config_, HOST=stub.url, TEMP_FOLDER=temp_folder, MANIFEST_PATH=None, HTTP_BACKOFF=0,
+                          FETCH_RATE_LIMIT=None, DICTIONARY_ENCODE=False, SPEED_GRID=False)
+            client = get_client(config, logger_=logger_)
+
+            start = time.perf_counter()
+            cities_df = get_cities(config, client_=client)
+            city_dict = dict(zip(cities_df['name'], cities_df['id']))
+            routes_df = pd.concat([get_routes(city, city_dict, config, date.strftime('%Y-%m-%d'), client_=client)
+                                   for city in cities_df['name']])
+            client.close()
+            logger_.debug(f'scrape: {len(cities_df)} cities, {len(routes_df)} routes in '
+                          f'{time.perf_counter() - start:.2f}s')
+
+            units = [(date, city, route_id) for city, route_id in
+                     zip(routes_df['city_id'].map({v: k for k, v in city_dict.items()}), routes_df['id'])]
+            stats = fetch_telemetry(units, config, logger_)
+            report('download + staging', stats['rows'], stats['elapsed'])
+
+        folder = '/'.join([temp_folder, f'telemetry_{date.strftime("%Y_%m_%d")}'])
+        frames, read_time = timed(lambda: list(read_telemetry_files(folder, logger_)))
+        df = pd.concat(frames, ignore_index=True)
+        report('read staged', len(df), read_time)
+
+        if not config_.get('BENCH_UPLOAD'):
+            logger_.debug('upload: skipped, BENCH_UPLOAD is not set')
+        else:
+            uploaded = True
+            _, upload_time = timed(upload_telemetry, config, engine_)
+            report('upload', len(df), upload_time)
+
+        stops_df, roads_gdf = synthetic_network()
+        index, index_time = timed(NetworkIndex, stops_df, roads_gdf)
+        marked, classify_time = timed(classify_points, df, index)
+        report('classify', len(df), index_time + classify_time)
+
+        tracks_df, tracks_time = timed(build_tracks, marked)
+        report('tracks', len(marked), tracks_time)
+        logger_.debug(f'{len(tracks_df)} tracks')
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+        if uploaded:
+            engine_.execute(mig.TELEMETRY_DAY_DROP_DDL.format(date.strftime('%Y_%m_%d'), date.strftime('%Y-%m-%d')))
+            logger_.debug(f'Dropped benchmark day {date}')
+
+
+BENCHMARKS = {
+    'copy': bench_copy,
+    'spatial': bench_spatial,
+    'tracks': bench_tracks,
+    'pipeline': bench_pipeline,
+}
+
+
+if __name__ == '__main__':
+    with open('config.yaml') as file:
+        config = yaml.Loader(file).get_data()
+
+    postgres_engine = create_engine('postgresql+psycopg2://{}:{}@{}/{}'.format(
+        config['DB_USER'],
+        config['DB_PASS'],
+        config['DB_HOST'],
+        config['DB_NAME']
+    ))
+
+    logger = get_logger('benchmark')
+
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        logger.debug(f'Running {name}')
+        BENCHMARKS[name](config, postgres_engine, logger)
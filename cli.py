@@ -0,0 +1,306 @@
+import os
+import sys
+import time
+import argparse
+import datetime
+import importlib
+from utils import get_logger
+
+STARTED = time.perf_counter()
+
+# stage -> seconds spent importing modules for it
+import_seconds = {}
+
+
+def lazy_import(stage, name):
+    """
+    Imports module name when a command needs it and adds the import time to stage
+    """
+
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_seconds[stage] = import_seconds.get(stage, 0) + time.perf_counter() - start
+
+    return module
+
+
+def report_imports(logger_):
+    logger_.debug('Import time: ' + ' // '.join(f'{stage} = {seconds:.3f}s' for stage, seconds in
+                                                 import_seconds.items()) +
+                  f' // total run = {time.perf_counter() - STARTED:.3f}s')
+
+
+def load_config(path):
+    yaml = lazy_import('config', 'yaml')
+
+    with open(path) as file:
+        return yaml.Loader(file).get_data()
+
+
+def get_engine(config_):
+    sqlalchemy = lazy_import('sqlalchemy', 'sqlalchemy')
+
+    return sqlalchemy.create_engine('postgresql+psycopg2://{}:{}@{}/{}'.format(
+        config_['DB_USER'],
+        config_['DB_PASS'],
+        config_['DB_HOST'],
+        config_['DB_NAME']
+    ))
+
+
+def get_manifest(config_):
+    return lazy_import('manifest', 'manifest').Manifest(config_)
+
+
+def make_temp_folder(config_, logger_):
+    if not os.path.isdir(config_['TEMP_FOLDER']):
+        os.mkdir(config_['TEMP_FOLDER'])
+        logger_.debug(f'TEMP_FOLDER created at {config_["TEMP_FOLDER"]}')
+
+
+def migrate(args, config_, logger_):
+    mig = lazy_import('migrate', 'migration')
+
+    for query in [mig.SCHEMA_DDL, mig.REFERENCE_MIGRATION, mig.TELEMETRY_MIGRATION, mig.ANALYTICS_MIGRATION,
+                  mig.DICTIONARY_MIGRATION]:
+        mig.run_migrations(query, config_)
+
+
+def sync_cities(args, config_, logger_):
+    download = lazy_import('sync', 'download')
+    upload = lazy_import('sync', 'upload')
+
+    make_temp_folder(config_, logger_)
+    engine = get_engine(config_)
+
+    download.write_cities(config_, engine)
+    upload.load_files(config_, engine, ['cities'])
+
+
+def sync_routes(args, config_, logger_):
+    download = lazy_import('sync', 'download')
+    upload = lazy_import('sync', 'upload')
+
+    make_temp_folder(config_, logger_)
+    engine = get_engine(config_)
+
+    download.write_routes(config_, engine)
+    upload.load_files(config_, engine, ['routes'])
+
+
+def pending_units(config_, engine_, manifest_, start=None, end=None):
+    """
+    Returns (date, city, route_id) units of configured cities from start to end (yesterday by default)
+    that are not in manifest_ or failed, given up units are not fetched again
+    start defaults to the earliest day with failed or missing units, then to the last fetched day
+    """
+
+    mig = lazy_import('fetch', 'migration')
+    manifest = lazy_import('fetch', 'manifest')
+
+    routes = [(city, route_id, valid_from.date()) for city, route_id, valid_from in engine_.execute("""
+        select c.name
+             , r.id
+             , r.valid_from
+        from transport.cities c
+            inner join transport.routes r
+                on c.id = r.city_id
+        where r.valid_to is null
+        """).fetchall() if city in config_['CITIES']]
+
+    date = start or manifest_.first_incomplete_date(routes) or manifest_.last_date(config_['CITIES'])
+
+    if date is None:
+        date = engine_.execute(mig.MAX_DATE_QUERY).fetchone()[0].date()
+
+    end = end or datetime.date.today() - datetime.timedelta(days=1)
+
+    units = []
+
+    while date <= end:
+        statuses = manifest_.statuses(date, config_['CITIES'])
+        for city, route_id, _ in routes:
+            if statuses.get((city, route_id), manifest.FAILED) == manifest.FAILED:
+                units.append((date, city, route_id))
+
+        date += datetime.timedelta(days=1)
+
+    return units
+
+
+def fetch(args, config_, logger_):
+    fetch_ = lazy_import('fetch', 'fetch')
+
+    make_temp_folder(config_, logger_)
+    manifest = get_manifest(config_)
+
+    for partial_date in manifest.partial_days():
+        logger_.debug(f'Found partially loaded day {partial_date}')
+
+    units = pending_units(config_, get_engine(config_), manifest, args.start, args.end)
+    fetch_.fetch_telemetry(units, config_, get_logger('telemetry'), manifest)
+
+
+def load(args, config_, logger_):
+    upload = lazy_import('load', 'upload')
+
+    make_temp_folder(config_, logger_)
+    engine = get_engine(config_)
+    manifest = get_manifest(config_)
+    fetched = manifest.units(upload.FETCHED)
+
+    upload.upload_telemetry(config_, engine, manifest)
+
+    if args.tracks or config_.get('PROCESS_TRACKS'):
+        scheduler = lazy_import('tracks', 'scheduler')
+
+        logger_.debug('Processing tracks of loaded days')
+        scheduler.run_units({(city, date) for city, _, date in fetched}, config_, engine_=engine)
+
+
+def pipeline(args, config_, logger_):
+    """
+    Fetches and loads at the same time, units left fetched by an interrupted run are loaded first
+    """
+
+    pipeline_ = lazy_import('pipeline', 'pipeline')
+    upload = lazy_import('pipeline', 'upload')
+
+    make_temp_folder(config_, logger_)
+    engine = get_engine(config_)
+    manifest = get_manifest(config_)
+    fetched = manifest.units(upload.FETCHED)
+
+    if fetched:
+        logger_.debug(f'Loading {len(fetched)} units left fetched by a previous run')
+        upload.upload_telemetry(config_, engine, manifest)
+
+    units = pending_units(config_, engine, manifest, args.start, args.end)
+    pipeline_.run_pipeline(units, config_, engine, manifest, get_logger('telemetry'))
+
+    if args.tracks or config_.get('PROCESS_TRACKS'):
+        scheduler = lazy_import('tracks', 'scheduler')
+
+        logger_.debug('Processing tracks of loaded days')
+        scheduler.run_units({(city, date) for city, _, date in fetched} | {(city, date) for date, city, _ in units},
+                            config_, engine_=engine)
+
+
+def status(args, config_, logger_):
+    path = lazy_import('manifest', 'manifest').manifest_path(config_)
+
+    # a missing manifest is reported as is, status never creates or seeds one
+    if not os.path.exists(path):
+        print(f'Manifest: {path} // no manifest yet')
+        return
+
+    manifest = get_manifest(config_)
+
+    print(f'Manifest: {manifest.path}')
+
+    for status_, (units, rows, first, last) in manifest.summary().items():
+        print(f'{status_:>8}: {units} units // {rows} rows // {first} .. {last}')
+
+    last = manifest.last_date(config_['CITIES'])
+    print(f'Last fetched day of {", ".join(config_["CITIES"])}: {last}')
+
+    if last is not None:
+        print(f'Days to fetch: {max((datetime.date.today() - datetime.timedelta(days=1) - last).days, 0)}')
+
+    partial_days = manifest.partial_days()
+
+    if partial_days:
+        print(f'Partially loaded days: {", ".join(str(day) for day in partial_days)}')
+
+
+def run(args, config_, logger_):
+    """
+    Runs the whole pipeline, steps before fetch are toggled by MIGRATION_COMPLETED, UPDATE_CITIES and UPDATE_ROUTES
+    With PIPELINE, fetch and load overlap instead of running one after the other
+    """
+
+    make_temp_folder(config_, logger_)
+
+    if not config_['MIGRATION_COMPLETED']:
+        logger_.debug('MIGRATION_COMPLETED flag set to False, running migrations')
+        migrate(args, config_, logger_)
+
+    if config_['UPDATE_CITIES'] or config_['UPDATE_ROUTES']:
+        download = lazy_import('sync', 'download')
+        upload = lazy_import('sync', 'upload')
+        engine = get_engine(config_)
+
+        if config_['UPDATE_CITIES']:
+            logger_.debug('UPDATE_CITIES flag set to True, running write_cities')
+            download.write_cities(config_, engine)
+
+        if config_['UPDATE_ROUTES']:
+            logger_.debug('UPDATE_ROUTES flag set to True, running write_routes')
+            download.write_routes(config_, engine)
+
+        logger_.debug('Syncing cities and routes')
+        upload.load_files(config_, engine)
+
+    if config_.get('PIPELINE'):
+        pipeline(args, config_, logger_)
+    else:
+        fetch(args, config_, logger_)
+        load(args, config_, logger_)
+
+
+COMMANDS = {
+    'run': (run, 'fetch and load everything (default), steps toggled by config flags'),
+    'migrate': (migrate, 'create schema, relations and views'),
+    'sync-cities': (sync_cities, 'scrape cities and sync transport.cities'),
+    'sync-routes': (sync_routes, 'scrape routes and sync transport.routes'),
+    'fetch': (fetch, 'download telemetry of days not fetched yet'),
+    'load': (load, 'load fetched telemetry into the database'),
+    'pipeline': (pipeline, 'fetch and load at the same time through a bounded queue'),
+    'status': (status, 'show manifest summary without touching the database'),
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='bustime_parser', description='Telemetry parser for bustime.ru')
+    parser.add_argument('--config', default='config.yaml', help='path to config (default: config.yaml)')
+
+    commands = parser.add_subparsers(dest='command')
+
+    for name, (_, help_) in COMMANDS.items():
+        command = commands.add_parser(name, help=help_)
+
+        if name in ('fetch', 'pipeline', 'run'):
+            command.add_argument('--start', type=datetime.date.fromisoformat,
+                                 help='first day to fetch, YYYY-MM-DD (default: last fetched day)')
+            command.add_argument('--end', type=datetime.date.fromisoformat,
+                                 help='last day to fetch, YYYY-MM-DD (default: yesterday)')
+        if name in ('load', 'pipeline', 'run'):
+            command.add_argument('--tracks', action='store_true', help='process tracks of loaded days')
+
+    parser.set_defaults(command='run', start=None, end=None, tracks=False)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logger = get_logger('__main__')
+
+    config = load_config(args.config)
+    logger.debug('Config loaded')
+
+    COMMANDS[args.command][0](args, config, logger)
+
+    if args.command != 'status':
+        metrics = lazy_import('metrics', 'metrics')
+        metrics.registry.report(logger)
+
+        if config.get('METRICS_PATH'):
+            metrics.registry.export(config['METRICS_PATH'])
+            logger.debug(f'Metrics written to {config["METRICS_PATH"]}')
+
+    report_imports(logger)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import time
+import random
+import threading
+import requests
+from json import JSONDecodeError
+from requests.adapters import HTTPAdapter
+import metrics
+from utils import get_logger
+
+OVERPASS_URL = 'http://overpass-api.de/api/interpreter'
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when the circuit breaker rejects a request without sending it
+    """
+
+
+class RetryableError(Exception):
+    """
+    Raised on responses that should be retried (5xx, 429, malformed JSON)
+    """
+
+
+class Client:
+    """
+    Pooled HTTP session with timeouts, exponential backoff with jitter,
+    a retry budget shared by all calls and a consecutive-failure circuit breaker
+    Thread safe, so one instance can be shared by fetch workers
+    """
+
+    def __init__(self, base_url='', timeout=30, retries=5, backoff=1, backoff_max=60, retry_budget=1000,
+                 breaker_threshold=10, breaker_cooldown=60, pool_size=10, logger_=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.logger = logger_ or get_logger('client')
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.counters = {'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _check_breaker(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.breaker_cooldown:
+                self.counters['rejected'] += 1
+                raise CircuitOpenError(f'Circuit open for {self.base_url or "client"}')
+            # half-open: let requests through until the next failure re-opens it
+            self.opened_at = None
+
+    def _record(self, ok):
+        with self.lock:
+            if ok:
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.breaker_threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                self.logger.debug(f'Circuit opened after {self.consecutive_failures} consecutive failures')
+
+    def _take_retry(self):
+        with self.lock:
+            if self.retry_budget is not None and self.counters['retries'] >= self.retry_budget:
+                return False
+            self.counters['retries'] += 1
+            return True
+
+    def _sleep(self, attempt):
+        """
+        Full jitter backoff: uniform(0, min(backoff_max, backoff * 2 ** attempt))
+        """
+
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+
+    def request(self, method, url, json_=False, **kwargs):
+        """
+        Sends request with retries, returns requests.Response or parsed JSON if json_=True
+        url is joined to base_url unless it is absolute
+        """
+
+        if not url.startswith('http'):
+            url = self.base_url + url
+        kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+
+        while True:
+            self._check_breaker()
+            self._count('requests')
+            metrics.inc('http_requests')
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code in RETRY_STATUSES:
+                    raise RetryableError(f'HTTP {response.status_code}')
+                response.raise_for_status()
+                metrics.inc('http_bytes', len(response.content))
+                result = response.json() if json_ else response
+                self._record(True)
+                return result
+            except (requests.ConnectionError, requests.Timeout, RetryableError, JSONDecodeError,
+                    requests.JSONDecodeError) as e:
+                self._record(False)
+
+                if attempt >= self.retries or not self._take_retry():
+                    self._count('failures')
+                    metrics.inc('http_failures')
+                    self.logger.debug(f'{method} {url} failed after {attempt + 1} attempts: {e!r}')
+                    raise
+
+                self.logger.debug(f'{method} {url} attempt {attempt + 1} failed: {e!r}, retrying')
+                metrics.inc('http_retries')
+                self._sleep(attempt)
+                attempt += 1
+            except requests.RequestException:
+                self._record(False)
+                self._count('failures')
+                metrics.inc('http_failures')
+                raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_client(config_, base_url=None, logger_=None):
+    """
+    Returns Client configured from HTTP_* keys of config, pointed at HOST by default
+    """
+
+    return Client(base_url if base_url is not None else config_['HOST'],
+                  timeout=config_.get('HTTP_TIMEOUT', 30),
+                  retries=config_.get('HTTP_RETRIES', 5),
+                  backoff=config_.get('HTTP_BACKOFF', 1),
+                  backoff_max=config_.get('HTTP_BACKOFF_MAX', 60),
+                  retry_budget=config_.get('HTTP_RETRY_BUDGET', 1000),
+                  breaker_threshold=config_.get('HTTP_BREAKER_THRESHOLD', 10),
+                  breaker_cooldown=config_.get('HTTP_BREAKER_COOLDOWN', 60),
+                  pool_size=config_.get('FETCH_WORKERS', 10),
+                  logger_=logger_)
+
+
+def get_overpass_client(config_=None, logger_=None):
+    """
+    Returns Client pointed at OVERPASS_URL (overridable in config)
+    """
+
+    config_ = config_ or {}
+
+    return get_client(config_, base_url=config_.get('OVERPASS_URL', OVERPASS_URL), logger_=logger_)
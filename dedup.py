@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+from utils import get_logger
+
+
+class Deduplicator:
+    """
+    Ingest stage dropping exact (uniqueid, timestamp) duplicates with a hash set per day,
+    optionally compacting stationary runs (same position within COMPACT_TOLERANCE degrees,
+    speed <= COMPACT_SPEED) of a vehicle to their first and last points
+    """
+
+    def __init__(self, config_, logger_=None):
+        self.compact = config_.get('COMPACT_STATIONARY', False)
+        self.tolerance = config_.get('COMPACT_TOLERANCE', 0.00001)
+        self.speed = config_.get('COMPACT_SPEED', 0)
+        self.logger = logger_ or get_logger('dedup')
+        self.seen = {}
+        self.counters = {'input': 0, 'duplicates': 0, 'compacted': 0}
+
+    def drop_duplicates(self, df):
+        """
+        Drops rows whose (uniqueid, timestamp) was already seen this run, including within df
+        """
+
+        keys = pd.util.hash_pandas_object(df[['uniqueid', 'timestamp']], index=False).to_numpy()
+        keep = ~pd.Series(keys).duplicated().to_numpy()
+
+        for date in np.unique(df['timestamp'].dt.date.to_numpy()):
+            day = (df['timestamp'].dt.date == date).to_numpy()
+            seen = self.seen.setdefault(date, set())
+            day_keys = keys[day].tolist()
+            keep[day] &= np.fromiter((key not in seen for key in day_keys), dtype=bool, count=len(day_keys))
+            seen.update(keys[day & keep].tolist())
+
+        return df[keep]
+
+    def compact_stationary(self, df):
+        """
+        Keeps only first and last point of each run of stationary points of a vehicle
+        """
+
+        df = df.sort_values(['uniqueid', 'timestamp'], kind='stable')
+
+        vehicle = df['uniqueid'].to_numpy()
+        lon = df['lon'].to_numpy(dtype='float64')
+        lat = df['lat'].to_numpy(dtype='float64')
+        stationary = (df['speed'].to_numpy(dtype='float64', na_value=np.inf) <= self.speed)
+
+        same = np.zeros(len(df), dtype=bool)
+        same[1:] = ((vehicle[1:] == vehicle[:-1]) & stationary[1:] & stationary[:-1] &
+                    (np.abs(lon[1:] - lon[:-1]) <= self.tolerance) & (np.abs(lat[1:] - lat[:-1]) <= self.tolerance))
+
+        # inside a run: row continues previous one and is continued by the next one
+        inner = same.copy()
+        inner[:-1] &= same[1:]
+        inner[-1:] = False
+
+        return df[~inner]
+
+    def process(self, df):
+        """
+        Applies deduplication and optional compaction to one frame
+        """
+
+        self.counters['input'] += len(df)
+
+        deduplicated = self.drop_duplicates(df)
+        self.counters['duplicates'] += len(df) - len(deduplicated)
+
+        if self.compact:
+            compacted = self.compact_stationary(deduplicated)
+            self.counters['compacted'] += len(deduplicated) - len(compacted)
+            deduplicated = compacted
+
+        return deduplicated
+
+    def iter(self, frames):
+        """
+        Applies process to a stream of frames
+        """
+
+        for frame in frames:
+            frame = self.process(frame)
+            if len(frame) != 0:
+                yield frame
+
+    def forget(self, before):
+        """
+        Frees hash sets of days before date
+        """
+
+        for date in [date for date in self.seen if date < before]:
+            del self.seen[date]
+
+    def report(self):
+        """
+        Logs reduction ratio and returns counters
+        """
+
+        output = self.counters['input'] - self.counters['duplicates'] - self.counters['compacted']
+        ratio = self.counters['input'] / output if output else float('nan')
+
+        self.logger.debug(f'Input = {self.counters["input"]} // duplicates = {self.counters["duplicates"]} // '
+                          f'compacted = {self.counters["compacted"]} // output = {output} // '
+                          f'reduction x{ratio:.2f}')
+
+        return self.counters
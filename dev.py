@@ -1,15 +1,21 @@
-import requests
+import json
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from json import JSONDecodeError
+import shapely
+from xml.etree import ElementTree
 from shapely.geometry import Polygon
+from client import get_overpass_client
+from spatial import utm_epsg
 
 
-def fetch_stops(city):
+def fetch_stops(city, client_=None):
     """
     Returns df of bus stops from Overpass API
     """
 
+    client_ = client_ or get_overpass_client()
+
     city = city[0].upper() + city[1:]
 
     query = f"""
@@ -24,16 +30,7 @@ def fetch_stops(city):
     out body qt;
     """
 
-    done_flag = False
-
-    while not done_flag:
-        try:
-            response = requests.get("http://overpass-api.de/api/interpreter",
-                                    params={'data': query.encode('utf-8')})
-            df = pd.DataFrame(response.json()['elements'])
-            done_flag = True
-        except JSONDecodeError:
-            pass
+    df = pd.DataFrame(client_.get('', params={'data': query.encode('utf-8')}, json_=True)['elements'])
 
     df['geometry'] = gpd.GeoSeries.from_xy(x=df['lon'], y=df['lat'])
     gdf = gpd.GeoDataFrame(df, geometry='geometry')
@@ -58,11 +55,11 @@ def get_tags(data_raw, tags):
     return data
 
 
-def get_stops(city_name, tags, engine_):
+def get_stops(city_name, tags, engine_, client_=None):
     # TODO: insert logger here
     # TODO: write docstring
 
-    stops_df = pd.DataFrame(get_tags(fetch_stops(city_name), tags)).drop(columns=['type', 'geometry'])
+    stops_df = pd.DataFrame(get_tags(fetch_stops(city_name, client_), tags)).drop(columns=['type', 'geometry'])
 
     city_id = engine_.execute(f"""
     select id
@@ -71,7 +68,7 @@ def get_stops(city_name, tags, engine_):
         and name = '{city_name}'
     """).fetchone()[0]
 
-    utm = 32600 + int(stops_df['lon'].mean() + 186) // 6
+    utm = utm_epsg(stops_df['lon'])
 
     stops_df['city_id'] = city_id
     stops_df['utm'] = utm
@@ -88,31 +85,65 @@ def get_stops(city_name, tags, engine_):
 
 # get_stops('kazan', ['name'], postgres_engine)
 
-def list_to_wkt(list_):
-    list_ = [' '.join([str(coordinate) for coordinate in node]) for node in list_]
-    wkt_string = 'LINESTRING (' + ','.join(list_) + ')'
-    return wkt_string
+def build_roads(elements):
+    """
+    Returns GeoDataFrame of ways from Overpass/OSM JSON elements
+    LineStrings are built directly from node coordinate arrays
+    """
+
+    nodes_dict = {node['id']: (node['lon'], node['lat']) for node in elements
+                  if node.get('type') == 'node' and 'lon' in node}
+
+    ways_list = []
+    coordinates = []
+    indices = []
+
+    for way in elements:
+        if way.get('type') != 'way' or way.get('nodes') is None:
+            continue
+
+        node_coordinates = [nodes_dict[node] for node in way['nodes'] if node in nodes_dict]
 
+        if len(node_coordinates) < 2:
+            continue
 
-def fetch_roads(city, clip=True):
+        tags = way.get('tags') or {}
+
+        coordinates.extend(node_coordinates)
+        indices.extend([len(ways_list)] * len(node_coordinates))
+        ways_list.append({
+            'id': way['id'],
+            'name': tags.get('name') or tags.get('ref') or tags.get('destination:ref'),
+            'highway': tags.get('highway')
+        })
+
+    geometry = shapely.linestrings(np.array(coordinates, dtype='float64').reshape(-1, 2),
+                                   indices=np.array(indices, dtype='int64'))
+
+    return gpd.GeoDataFrame(pd.DataFrame(ways_list, columns=['id', 'name', 'highway']), geometry=geometry)
+
+
+def filter_roads(gdf):
     """
-    Returns df with road graph
+    Keeps roads buses can use: *ary, trunk, residential and living_street highways
     """
 
-    city = city[0].upper() + city[1:]
+    return gdf[(gdf['highway'].str.find('ary') != -1) |
+               (gdf['highway'].str.find('trunk') != -1) |
+               (gdf['highway'].str.find('residential') != -1) |
+               (gdf['highway'].str.find('living_street') != -1)]
 
-    nodes_query = f"""
-    [out:json];
-    area
-      ["name:en"="{city}"];
-    ( 
-      node(area);
-    );
-    out body;
-    >;
-    out skel qt;
+
+def fetch_roads(city, clip=True, client_=None):
+    """
+    Returns df with road graph
     """
 
+    client_ = client_ or get_overpass_client()
+
+    city = city[0].upper() + city[1:]
+
+    # "out skel" after recursing down ways returns their nodes, no separate query for all nodes is needed
     ways_query = f"""
     [out:json];
     area
@@ -125,58 +156,9 @@ def fetch_roads(city, clip=True):
     out skel qt;
     """
 
-    done_flag = False
-
-    while not done_flag:
-        try:
-            ways_json = nodes_json = requests.get("http://overpass-api.de/api/interpreter",
-                                                  params={'data': nodes_query.encode('utf-8')}).json()
-            done_flag = True
-        except JSONDecodeError:
-            pass
-
-    nodes_dict = {node['id']: [node['lon'], node['lat']] for node in nodes_json['elements']}
-
-    done_flag = False
-
-    while not done_flag:
-        try:
-            ways_json = requests.get("http://overpass-api.de/api/interpreter",
-                                     params={'data': ways_query.encode('utf-8')}).json()
-            done_flag = True
-        except JSONDecodeError:
-            pass
-
-    for way in ways_json['elements']:
-        if way.get('tags') is None:
-            way['tags'] = {}
-
-    ways_list = [{
-        'id': way['id'],
-        'nodes': way.get('nodes'),
-        'name': way.get('tags').get('name'),
-        'ref': way.get('tags').get('ref'),
-        'highway': way.get('tags').get('highway'),
-        'destination:ref': way.get('tags').get('destination:ref')
-    } for way in ways_json['elements']]
-
-    for way in ways_list:
-        if way.get('nodes') is not None:
-            node_coordinates = []
-            for node in way['nodes']:
-                node_get = nodes_dict.get(node)
-                if node_get is not None:
-                    node_coordinates.append(node_get)
-            way['nodes_coordinates'] = node_coordinates
-
-    df = pd.DataFrame(ways_list)
-    df = df[df['nodes_coordinates'].notna()]
-    df['wkt'] = df['nodes_coordinates'].apply(list_to_wkt)
-    df['name'] = df['name'].combine_first(df['ref'].combine_first(df['destination:ref']))
-    gdf = df.copy()[['id', 'name', 'highway', 'wkt']]
-    gdf = gdf[(gdf['wkt'] != 'LINESTRING ()') & (gdf['wkt'].str.find(',') != -1)]
-    gdf['geometry'] = gpd.GeoSeries.from_wkt(gdf['wkt'])
-    gdf = gpd.GeoDataFrame(gdf, geometry='geometry')
+    ways_json = client_.get('', params={'data': ways_query.encode('utf-8')}, json_=True)
+
+    gdf = build_roads(ways_json['elements'])
 
     if clip:
         polygon_query = f"""
@@ -191,31 +173,73 @@ def fetch_roads(city, clip=True):
         out skel qt;
         """
 
-        done_flag = False
-
-        while not done_flag:
-            try:
-                polygon_json = requests.get("http://overpass-api.de/api/interpreter",
-                                            params={'data': polygon_query.encode('utf-8')}).json()
-                done_flag = True
-            except JSONDecodeError:
-                pass
+        polygon_json = client_.get('', params={'data': polygon_query.encode('utf-8')}, json_=True)
 
         admin_centre_id = [node for node in filter(lambda x: x['role'] == 'admin_centre',
                                                    polygon_json.get('elements')[0].get('members'))][0]['ref']
-        polygon_df = pd.DataFrame([node for node in polygon_json['elements'] \
-                                   if node.get('type') == 'node' and node.get('id') != admin_centre_id])
-        polygon_gdf = gpd.GeoDataFrame(polygon_df,
-                                       geometry=gpd.points_from_xy(polygon_df['lon'], polygon_df['lat']))
+        polygon_coords = [(node['lon'], node['lat']) for node in polygon_json['elements']
+                          if node.get('type') == 'node' and node.get('id') != admin_centre_id]
 
-        polygon_gdf['coords'] = polygon_gdf['geometry'].apply(lambda x: list(x.coords)[0])
-
-        polygon = Polygon(list(polygon_gdf['coords'])).convex_hull
+        polygon = Polygon(polygon_coords).convex_hull
         gdf = gpd.clip(gdf, polygon)
 
-        gdf = gdf[(gdf['highway'].str.find('ary') != -1) |
-                  (gdf['highway'].str.find('trunk') != -1) |
-                  (gdf['highway'].str.find('residential') != -1) |
-                  (gdf['highway'].str.find('living_street') != -1)]
+        gdf = filter_roads(gdf)
 
     return gdf
+
+
+def load_extract(path):
+    """
+    Returns Overpass-like list of elements (nodes with lon/lat and tags, ways with nodes and tags)
+    from local OSM extract: .json (Overpass output) or .osm (XML, e.g. from osmium cat extract.osm.pbf -o extract.osm)
+    """
+
+    if path.endswith('.json'):
+        with open(path, encoding='utf-8') as file_:
+            return json.load(file_)['elements']
+
+    elements = []
+
+    for _, element in ElementTree.iterparse(path):
+        if element.tag not in ('node', 'way'):
+            continue
+
+        tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+        item = {'type': element.tag, 'id': int(element.get('id'))}
+
+        if tags:
+            item['tags'] = tags
+
+        if element.tag == 'node':
+            item['lon'] = float(element.get('lon'))
+            item['lat'] = float(element.get('lat'))
+        else:
+            item['nodes'] = [int(nd.get('ref')) for nd in element.iter('nd')]
+
+        elements.append(item)
+        element.clear()
+
+    return elements
+
+
+def stops_from_extract(elements):
+    """
+    Returns GeoDataFrame of bus stops shaped like fetch_stops output from extract elements
+    """
+
+    df = pd.DataFrame([element for element in elements if element['type'] == 'node'
+                       and (element.get('tags') or {}).get('highway') == 'bus_stop'])
+
+    df['geometry'] = gpd.GeoSeries.from_xy(x=df['lon'], y=df['lat'])
+
+    return gpd.GeoDataFrame(df, geometry='geometry')
+
+
+def roads_from_extract(elements):
+    """
+    Returns filtered road GeoDataFrame from extract elements
+    Extract is expected to be cut to the city area already, so no boundary clip is done
+    """
+
+    return filter_roads(build_roads([element for element in elements if element['type'] == 'node' or
+                                     'highway' in (element.get('tags') or {})]))
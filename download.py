@@ -1,25 +1,181 @@
 import os
+import re
+import json
 import datetime
-import requests
 import pandas as pd
+import metrics
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
+from client import get_client
+from encoding import Dictionary
+from staging import empty_frame, get_extension, set_dtypes, write_frame
 from utils import sha256, get_logger
 
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
 
-def get_cities(config_, file_=None) -> dict:
+CITIES_ELEMENT = re.compile(r'<div[^>]*aria-label=" Список городов "')
+ROUTES_ELEMENT = re.compile(r'<select[^>]*name="bus_id"')
+
+
+def element_html(text, opening, tag):
     """
-    gets pandas.DataFrame of cities
-    if file parameter = None returns a pandas.DataFrame, else writes to <file>.csv
+    Returns html of the first element matched by opening regex up to its balanced closing tag,
+    so only that element is parsed instead of the whole page
+    Falls back to the whole text if the element is not found
+    """
+
+    match = opening.search(text)
+
+    if match is None:
+        return text
+
+    depth = 0
+
+    for token in re.finditer(rf'<(/?){tag}\b', text[match.start():], flags=re.IGNORECASE):
+        depth += -1 if token.group(1) else 1
+        if depth == 0:
+            end = text.find('>', match.start() + token.end())
+            return text[match.start():end + 1 if end != -1 else len(text)]
+
+    return text[match.start():]
+
+
+class PageCache:
+    """
+    Local cache of scraped pages: validators (ETag, Last-Modified), content hash and parsed data per key
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key):
+        return '/'.join([self.folder, f'{key}.json'])
+
+    def get(self, key):
+        try:
+            with open(self.path(key), encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, entry):
+        temporary = self.path(key) + '.tmp'
+
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(entry, file, ensure_ascii=False)
+
+        os.replace(temporary, self.path(key))
+
+
+def get_page_cache(config_):
+    """
+    Returns PageCache at SCRAPE_CACHE_FOLDER, None if caching is disabled
+    """
+
+    if not config_.get('SCRAPE_CACHE', True):
+        return None
+
+    return PageCache(config_.get('SCRAPE_CACHE_FOLDER', 'scrape_cache'))
+
+
+def scrape(client_, url, parse, cache_=None, key=None):
+    """
+    Returns parse(page text) of url
+    With cache_, sends If-None-Match / If-Modified-Since and reuses cached data on 304,
+    or when the downloaded page is byte-identical to the cached one
+    """
+
+    key = key or str(sha256(url, 16))
+    entry = cache_.get(key) if cache_ is not None else None
+    headers = {}
+
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    response = client_.get(url, headers=headers)
+
+    if entry is not None and response.status_code == 304:
+        metrics.inc('scrape_not_modified')
+        return entry['data']
+
+    content_hash = str(sha256(response.text, 16))
+
+    if entry is not None and entry.get('hash') == content_hash:
+        metrics.inc('scrape_unchanged')
+        data = entry['data']
+    else:
+        with metrics.span('scrape_parse'):
+            data = parse(response.text)
+
+    if cache_ is not None:
+        cache_.put(key, {'url': url, 'etag': response.headers.get('ETag'),
+                         'last_modified': response.headers.get('Last-Modified'), 'hash': content_hash, 'data': data})
+
+    return data
+
+
+def parse_cities(text):
+    """
+    Returns city slugs from the city list of the main page
     """
 
-    soup = BeautifulSoup(requests.get(config_['HOST']).text, features="html.parser")
+    soup = BeautifulSoup(element_html(text, CITIES_ELEMENT, 'div'), features=HTML_PARSER)
 
-    cities = [x.get('href').strip('/') for x in soup.find("div", {"aria-label": " Список городов "}). \
+    return [x.get('href').strip('/') for x in soup.find("div", {"aria-label": " Список городов "}). \
         find_all("a", {"class": 'item'})]
 
-    cities = [[sha256(city, 8), city] for city in cities]
 
-    cities_df = pd.DataFrame(cities, columns=['id', 'name'])
+def parse_routes(text):
+    """
+    Returns [route_id, name] pairs from the bus_id select of a city transport page
+    """
+
+    soup = BeautifulSoup(element_html(text, ROUTES_ELEMENT, 'select'), features=HTML_PARSER)
+
+    return [[int(x.get('value')), x.text] for x in soup.find('select', {'name': 'bus_id'}).find_all('option')
+            if x.get('value') != '0']
+
+
+def get_city_ids(engine_):
+    """
+    Returns city Dictionary, None if no engine_ is passed (ids then fall back to sha256 of name)
+    Database errors are raised, so ids of an existing database are never silently replaced by hashes
+    """
+
+    if engine_ is None:
+        return None
+
+    return Dictionary('city', engine_)
+
+
+def get_cities(config_, file_=None, client_=None, cache_=None, ids_=None) -> dict:
+    """
+    gets pandas.DataFrame of cities
+    if file parameter = None returns a pandas.DataFrame, else writes to <file>.csv
+    ids come from ids_ (city Dictionary) if passed, else from sha256 of name
+    a client created here (no client_ passed) is closed before returning
+    """
+
+    client = client_ or get_client(config_)
+
+    try:
+        cities = scrape(client, '/', parse_cities, cache_, 'cities')
+    finally:
+        if client_ is None:
+            client.close()
+
+    if ids_ is not None:
+        cities_df = pd.DataFrame({'id': ids_.encode(cities), 'name': cities})
+    else:
+        cities_df = pd.DataFrame([[sha256(city, 8), city] for city in cities], columns=['id', 'name'])
 
     if not file_:
         return cities_df
@@ -42,21 +198,24 @@ def get_route_type(route):
         return 'other'
 
 
-def get_routes(city: str, city_dict: dict, config_: dict, date: datetime.date, file_=None) -> list:
+def get_routes(city: str, city_dict: dict, config_: dict, date: datetime.date, file_=None, client_=None,
+               cache_=None) -> list:
     """
     gets pandas.DataFrame of routes by city
     requires city_dict (id: name)
+    a client created here (no client_ passed) is closed before returning
     """
 
-    soup = BeautifulSoup(requests.get(config_['HOST'] + '/' + city + '/' + 'transport/' + date).text,
-                         features="html.parser")
+    client = client_ or get_client(config_)
 
-    routes = [
-        [int(x.get('value')),
-         x.text,
-         get_route_type(x.text),
-         city_dict[city]] for x in soup.find('select', {'name': 'bus_id'}). \
-            find_all('option') if x.get('value') != '0']
+    # route list rarely changes between days, so the cache is keyed by city
+    try:
+        routes = scrape(client, '/' + city + '/' + 'transport/' + date, parse_routes, cache_, f'routes_{city}')
+    finally:
+        if client_ is None:
+            client.close()
+
+    routes = [[route_id, name, get_route_type(name), city_dict[city]] for route_id, name in routes]
 
     routes_df = pd.DataFrame(routes, columns=['id', 'name', 'type', 'city_id'])
 
@@ -66,39 +225,58 @@ def get_routes(city: str, city_dict: dict, config_: dict, date: datetime.date, f
         routes_df.to_csv(file_, encoding='utf-8', index=False)
 
 
-def get_telemetry(date: datetime.date, city_name: str, route_id: int, config_, logger_, file_=None):
+def get_telemetry(date: datetime.date, city_name: str, route_id: int, config_, logger_, file_=None, client_=None):
     """
     gets pandas.DataFrame of telemetry data by route_id
+    pass a shared client_ to reuse its connection pool, a client created here is closed before returning
     """
 
+    client = client_ or get_client(config_)
+
     data = {
         'city_slug': city_name,
         'bus_id': str(route_id),
         'day': date.strftime('%Y-%m-%d')
     }
 
-    telemetry_df = pd.DataFrame(requests.post(config_['HOST'] + '/ajax/transport/', data=data).json())
+    try:
+        with metrics.span('request', city=city_name, route=route_id):
+            response = client.post('/ajax/transport/', data=data, json_=True)
+    finally:
+        if client_ is None:
+            client.close()
+
+    with metrics.span('parse', city=city_name, route=route_id):
+        telemetry_df = pd.DataFrame(response)
+
+        if len(telemetry_df) != 0:
+            telemetry_df['timestamp'] = date.strftime('%Y-%m-%d') + ' ' + telemetry_df['timestamp']
+            telemetry_df['timestamp'] = pd.to_datetime(telemetry_df['timestamp'])
+            telemetry_df['upload_date'] = datetime.datetime.today()
+            telemetry_df = set_dtypes(telemetry_df)
+        else:
+            telemetry_df = empty_frame()
 
-    if len(telemetry_df) != 0:
-        telemetry_df['timestamp'] = date.strftime('%Y-%m-%d') + ' ' + telemetry_df['timestamp']
-        telemetry_df['timestamp'] = pd.to_datetime(telemetry_df['timestamp'])
-        telemetry_df['upload_date'] = datetime.datetime.today()
+    metrics.inc('fetched_rows', len(telemetry_df), city=city_name, route=route_id)
 
     logger_.debug(f'Date = {date} // City = {city_name} // Route = {route_id} // Row count = {len(telemetry_df)}')
 
     if not file_:
         return telemetry_df
     else:
-        telemetry_df.to_csv(file_, encoding='utf-8', index=False)
+        with metrics.span('write', city=city_name, route=route_id):
+            write_frame(telemetry_df, file_)
+        return len(telemetry_df)
 
 
-def write_cities(config_):
+def write_cities(config_, engine_=None):
     """
     Writes .csv with cities data to temp folder
     """
 
     filename = f'cities_{datetime.date.today().strftime("%Y_%m_%d")}.csv'
-    get_cities(config_, '/'.join([config_['TEMP_FOLDER'], filename]))
+    get_cities(config_, '/'.join([config_['TEMP_FOLDER'], filename]), cache_=get_page_cache(config_),
+               ids_=get_city_ids(engine_))
 
     logger = get_logger('write_cities')
     logger.debug(f'Saved cities at {filename}')
@@ -117,19 +295,45 @@ def write_routes(config_, engine_):
     except:
         city_df = pd.DataFrame([], columns=['id', 'name'])
 
+    from fetch import RateLimiter
+
+    cache = get_page_cache(config_)
+    client = get_client(config_, logger_=logger)
+
     if len(city_df) == 0:
         logger.debug('Cities load from DB failed, fetching from HOST')
-        city_df = get_cities(config_)
+        city_df = get_cities(config_, client_=client, cache_=cache, ids_=get_city_ids(engine_))
 
     city_dict = {x[1]: x[0] for x in city_df.to_records(index=False)}
 
-    df_list = []
+    limiter = RateLimiter(config_.get('FETCH_RATE_LIMIT'))
+
+    def city_routes(city):
+        limiter.acquire()
+        try:
+            return get_routes(city, city_dict, config_, config_['DATE'].strftime("%Y-%m-%d"), client_=client,
+                              cache_=cache)
+        except Exception as e:
+            logger.warning(f'Routes of {city} failed: {e!r}')
+            return None
+
+    # pages are fetched concurrently, results keep city order
+    with ThreadPoolExecutor(max_workers=config_.get('FETCH_WORKERS', 1)) as executor:
+        df_list = [df for df in executor.map(city_routes, list(city_df['name'])) if df is not None]
+
+    client.close()
 
-    for city in list(city_df['name']):
-        df_list.append(get_routes(city,
-                                  city_dict,
-                                  config_,
-                                  config_['DATE'].strftime("%Y-%m-%d")))
+    logger.debug(f'Fetched routes of {len(df_list)} of {len(city_df)} cities')
+
+    # many failed cities point at an outage or a site change rather than missing routes, so the run stops
+    failed = len(city_df) - len(df_list)
+
+    if not df_list:
+        raise RuntimeError(f'No routes fetched for {len(city_df)} cities, nothing written')
+
+    if failed > config_.get('ROUTES_MAX_FAILED', 0.1) * len(city_df):
+        raise RuntimeError(f'Routes of {failed} of {len(city_df)} cities failed, more than ROUTES_MAX_FAILED = '
+                           f'{config_.get("ROUTES_MAX_FAILED", 0.1)}, nothing written')
 
     filename = f'temp/routes_{datetime.date.today().strftime("%Y_%m_%d")}.csv'
 
@@ -137,22 +341,35 @@ def write_routes(config_, engine_):
     df.to_csv(filename, index=False)
 
 
-def write_telemetry(date, city_name, route_id, config_, logger_):
+def telemetry_path(date, city_name, route_id, config_):
     """
-    Writes .csv with telemetry data into temp folder with subfolder
+    Returns path of telemetry file in temp folder, file format is set by STAGING_FORMAT
     """
 
     folder = f'telemetry_{date.strftime("%Y_%m_%d")}'
-    path = '/'.join([config_['TEMP_FOLDER'], folder])
+    filename = f'{city_name}_{route_id}_{date.strftime("%Y_%m_%d")}{get_extension(config_)}'
+
+    return '/'.join([config_['TEMP_FOLDER'], folder, filename])
+
+
+def write_telemetry(date, city_name, route_id, config_, logger_, client_=None):
+    """
+    Writes telemetry data into temp folder with subfolder
+    Returns row count
+    """
+
+    path = telemetry_path(date, city_name, route_id, config_)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
 
-    if folder not in os.listdir(config_['TEMP_FOLDER']):
-        os.mkdir(path)
+    row_count = get_telemetry(date,
+                              city_name,
+                              route_id,
+                              config_,
+                              logger_,
+                              path,
+                              client_)
 
-    get_telemetry(date,
-                  city_name,
-                  route_id,
-                  config_,
-                  logger_,
-                  path+f'/{city_name}_{route_id}_{date.strftime("%Y_%m_%d")}.csv')
+    logger_.debug(f'Wrote data to {os.path.basename(path)}')
 
-    logger_.debug(f'Wrote data to {city_name}_{route_id}_{date.strftime("%Y_%m_%d")}.csv')
+    return row_count
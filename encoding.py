@@ -0,0 +1,99 @@
+import io
+import pandas as pd
+import migration as mig
+
+# telemetry column -> (dictionary kind, id column)
+TELEMETRY_ENCODED = {
+    'uniqueid': ('vehicle', 'vehicle_id'),
+    'gosnum': ('gosnum', 'gosnum_id'),
+}
+
+
+class Dictionary:
+    """
+    Dense stable integer ids of values of one kind (city, vehicle, gosnum), persisted in transport.dictionary
+    Known ids are cached in memory, unseen values are assigned ids in one round trip per encode call
+    """
+
+    def __init__(self, kind, engine_):
+        self.kind = kind
+        self.engine = engine_
+        self.ids = dict(engine_.execute(mig.DICTIONARY_QUERY.format(kind)).fetchall())
+        self.values = None
+
+    def insert(self, values):
+        """
+        Assigns ids to values not yet in transport.dictionary and caches ids of all of them
+        """
+
+        buffer = io.StringIO()
+        pd.Series(values, dtype='object').to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+        connection = self.engine.raw_connection()
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute(mig.DICTIONARY_STAGING_DDL)
+            cursor.copy_expert('COPY dictionary_staging (value) FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(mig.DICTIONARY_INSERT.format(self.kind))
+            cursor.execute(mig.DICTIONARY_STAGED_QUERY.format(self.kind))
+            self.ids.update(cursor.fetchall())
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+        self.values = None
+
+    def encode(self, values):
+        """
+        Returns nullable Int64 array of ids of values, missing values stay missing
+        """
+
+        values = pd.Series(values, dtype='object')
+        unseen = [value for value in pd.unique(values.dropna()) if value not in self.ids]
+
+        if unseen:
+            self.insert(unseen)
+
+        return values.map(self.ids).astype(pd.Int64Dtype()).array
+
+    def decode(self, ids):
+        """
+        Returns object array of values of ids
+        """
+
+        if self.values is None:
+            self.values = {id_: value for value, id_ in self.ids.items()}
+
+        return pd.Series(ids).map(self.values).to_numpy(dtype='object')
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def telemetry_dictionaries(engine_):
+    """
+    Returns dictionaries used by encode_telemetry
+    """
+
+    return {kind: Dictionary(kind, engine_) for kind, _ in TELEMETRY_ENCODED.values()}
+
+
+def encode_telemetry(df, dictionaries):
+    """
+    Replaces varchar uniqueid and gosnum with their integer ids (vehicle_id, gosnum_id)
+    The varchar columns are kept as NULL; transport.telemetry_decoded restores them for readers
+    """
+
+    df = df.copy()
+
+    for column, (kind, id_column) in TELEMETRY_ENCODED.items():
+        if column in df.columns:
+            df[id_column] = dictionaries[kind].encode(df[column])
+            df[column] = None
+
+    return df
@@ -0,0 +1,100 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import metrics
+from client import get_client
+from download import write_telemetry, telemetry_path
+from utils import get_logger
+
+
+class RateLimiter:
+    """
+    Token bucket shared between fetch threads
+    rate_ = max requests per second to HOST, 0 or None disables limiting
+    """
+
+    def __init__(self, rate_):
+        self.rate = rate_
+        self.tokens = float(rate_ or 0)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request slot is available
+        """
+
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def fetch_telemetry(units, config_, logger_=None, manifest_=None):
+    """
+    Downloads telemetry for (date, city_name, route_id) units concurrently
+    Concurrency is bounded by FETCH_WORKERS, request rate by FETCH_RATE_LIMIT (requests/s)
+    Fetched units are recorded in manifest_ if passed
+    Returns dict with requests, rows, failed, elapsed and client retry counters
+    """
+
+    logger_ = logger_ or get_logger('fetch')
+
+    workers = config_.get('FETCH_WORKERS', 1)
+    limiter = RateLimiter(config_.get('FETCH_RATE_LIMIT'))
+    client = get_client(config_, logger_=logger_)
+
+    def fetch_unit(unit):
+        date, city_name, route_id = unit
+
+        with metrics.span('rate_limit'):
+            limiter.acquire()
+
+        with metrics.span('fetch', city=city_name, route=route_id):
+            return write_telemetry(date, city_name, route_id, config_, logger_, client)
+
+    stats = {'requests': 0, 'rows': 0, 'failed': 0}
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_unit, unit): unit for unit in units}
+
+        for future in as_completed(futures):
+            stats['requests'] += 1
+            date, city_name, route_id = futures[future]
+            try:
+                rows = future.result() or 0
+                stats['rows'] += rows
+                if manifest_ is not None:
+                    manifest_.mark_fetched(city_name, route_id, date, rows,
+                                           telemetry_path(date, city_name, route_id, config_))
+            except Exception as e:
+                stats['failed'] += 1
+                logger_.debug(f'Failed: Date = {date} // City = {city_name} // Route = {route_id} // {e!r}')
+                if manifest_ is not None:
+                    manifest_.mark_failed(city_name, route_id, date)
+
+    client.close()
+
+    stats['retries'] = client.counters['retries']
+    stats['rejected'] = client.counters['rejected']
+    stats['elapsed'] = time.monotonic() - start
+    elapsed = max(stats['elapsed'], 1e-9)
+
+    logger_.debug(f'Fetched {stats["requests"]} units ({stats["failed"]} failed, {stats["retries"]} retries) '
+                  f'in {stats["elapsed"]:.1f}s // '
+                  f'{stats["requests"] / elapsed:.2f} requests/s // {stats["rows"] / elapsed:.1f} rows/s')
+
+    return stats
@@ -0,0 +1,273 @@
+import time
+import datetime
+import yaml
+import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine
+import migration as mig
+from client import get_client
+from download import get_telemetry
+from encoding import telemetry_dictionaries, encode_telemetry
+from fetch import RateLimiter
+from upload import copy_dataframe, partition_bounds, record_day
+from utils import get_logger
+
+
+class LastSeen:
+    """
+    Bounded map uniqueid -> last written timestamp
+    Least recently updated vehicles are evicted above max_vehicles or after ttl seconds without updates
+    Timestamps of evicted vehicles are kept as watermarks, polls return the whole day, so a vehicle that
+    shows up again must not have its earlier points written twice
+    """
+
+    def __init__(self, max_vehicles=100000, ttl=60 * 60, watermarks=None):
+        self.max_vehicles = max_vehicles
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.watermarks = dict(watermarks or {})
+
+    def new_rows(self, df):
+        """
+        Returns rows newer than last seen position of their vehicle and remembers latest timestamps
+        """
+
+        if len(df) == 0:
+            return df
+
+        known = {}
+
+        for uniqueid in df['uniqueid'].unique():
+            if uniqueid in self.items:
+                known[uniqueid] = self.items[uniqueid][0]
+            elif uniqueid in self.watermarks:
+                known[uniqueid] = self.watermarks[uniqueid]
+        last = pd.Series(known, dtype='datetime64[ns]').reindex(df['uniqueid'].to_numpy()).to_numpy()
+        new = df[pd.isna(last) | (df['timestamp'].to_numpy() > last)]
+
+        now = time.monotonic()
+
+        for uniqueid, timestamp in new.groupby('uniqueid')['timestamp'].max().items():
+            self.items[uniqueid] = (timestamp, now)
+            self.items.move_to_end(uniqueid)
+            self.watermarks.pop(uniqueid, None)
+
+        self.evict(now)
+
+        return new
+
+    def evict(self, now):
+        while self.items and (len(self.items) > self.max_vehicles or
+                              now - next(iter(self.items.values()))[1] > self.ttl):
+            uniqueid, (timestamp, _) = self.items.popitem(last=False)
+            self.watermarks[uniqueid] = timestamp
+
+    def forget(self, before):
+        """
+        Drops watermarks older than before, e.g. of past days
+        """
+
+        self.watermarks = {uniqueid: timestamp for uniqueid, timestamp in self.watermarks.items()
+                           if timestamp >= before}
+
+    def __len__(self):
+        return len(self.items)
+
+
+class LiveWriter:
+    """
+    Buffers new points and writes them to their day partitions in micro-batches
+    Written days are recorded in transport.telemetry_days once a later day is written and on close
+    """
+
+    def __init__(self, engine_, batch_size, flush_seconds, logger_, dictionaries=None):
+        self.engine = engine_
+        self.dictionaries = dictionaries
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.logger = logger_
+        self.buffer = []
+        self.buffered = 0
+        self.flushed_at = time.monotonic()
+        self.partitions = set()
+        self.unrecorded = set()
+        self.written = 0
+        self.max_timestamp = None
+
+    def add(self, df):
+        if len(df) != 0:
+            self.buffer.append(df)
+            self.buffered += len(df)
+
+        if self.buffered >= self.batch_size or time.monotonic() - self.flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = time.monotonic()
+
+        if self.buffered == 0:
+            return
+
+        df = pd.concat(self.buffer, ignore_index=True)
+        dates = set(df['timestamp'].dt.date)
+
+        for date in dates:
+            if date not in self.partitions:
+                self.engine.execute(mig.TELEMETRY_PARTITION_CREATE.format(*partition_bounds(date)))
+                self.partitions.add(date)
+
+        self.written += len(df)
+        self.max_timestamp = max(filter(None, [self.max_timestamp, df['timestamp'].max()]))
+
+        if self.dictionaries is not None:
+            df = encode_telemetry(df, self.dictionaries)
+
+        copy_dataframe(df, 'telemetry', self.engine)
+        self.logger.debug(f'Wrote {len(df)} new points')
+
+        self.buffer = []
+        self.buffered = 0
+
+        self.unrecorded.update(dates)
+        self.record(max(self.unrecorded))
+
+    def record(self, before=None):
+        """
+        Records written days earlier than before (all written days if None) in transport.telemetry_days
+        """
+
+        for date in sorted(self.unrecorded):
+            if before is None or date < before:
+                record_day(date, self.engine)
+                self.unrecorded.discard(date)
+                self.logger.debug(f'Recorded {date} in telemetry_days')
+
+    def close(self):
+        """
+        Flushes buffered points and records every written day
+        """
+
+        self.flush()
+        self.record()
+
+
+def load_watermarks(config_, engine_, date):
+    """
+    Returns {uniqueid: latest timestamp} written for date and later, so a restarted daemon skips them
+    """
+
+    relation = 'telemetry_decoded' if config_.get('DICTIONARY_ENCODE') else 'telemetry'
+    rows = engine_.execute(mig.LIVE_WATERMARKS_QUERY.format(relation, date.strftime('%Y-%m-%d'))).fetchall()
+
+    return {uniqueid: pd.Timestamp(timestamp) for uniqueid, timestamp in rows}
+
+
+def next_interval(interval, cycle_seconds, new_share, config_):
+    """
+    Adapts poll interval: backs off when a cycle overruns or little is new, speeds up when most routes move
+    """
+
+    low = config_.get('LIVE_MIN_INTERVAL', 15)
+    high = config_.get('LIVE_MAX_INTERVAL', 300)
+
+    if cycle_seconds > interval or new_share < 0.1:
+        interval *= 1.5
+    elif new_share > 0.5:
+        interval /= 1.5
+
+    return min(high, max(low, interval, cycle_seconds))
+
+
+def run_live(config_, engine_, logger_=None, cycles=None):
+    """
+    Polls /ajax/transport/ for today's telemetry of configured cities and writes only new points
+    Runs until interrupted or for <cycles> polls
+    """
+
+    logger_ = logger_ or get_logger('live')
+
+    routes = engine_.execute("""
+        select c.name
+             , r.id
+        from transport.cities c
+            inner join transport.routes r
+                on c.id = r.city_id
+        where r.valid_to is null
+    """).fetchall()
+    routes = [(city, route_id) for city, route_id in routes if city in config_['CITIES']]
+
+    client = get_client(config_, logger_=logger_)
+    limiter = RateLimiter(config_.get('FETCH_RATE_LIMIT'))
+    today = datetime.date.today()
+    last_seen = LastSeen(config_.get('LIVE_MAX_VEHICLES', 100000), config_.get('LIVE_VEHICLE_TTL', 60 * 60),
+                         load_watermarks(config_, engine_, today))
+    logger_.debug(f'Seeded {len(last_seen.watermarks)} vehicle watermarks of {today}')
+    writer = LiveWriter(engine_, config_.get('LIVE_BATCH_SIZE', 10000), config_.get('LIVE_FLUSH_SECONDS', 60),
+                        logger_, telemetry_dictionaries(engine_) if config_.get('DICTIONARY_ENCODE') else None)
+
+    interval = config_.get('LIVE_MIN_INTERVAL', 15)
+    started = time.monotonic()
+    polls = 0
+    cycle = 0
+
+    def poll(route):
+        limiter.acquire()
+        try:
+            return get_telemetry(datetime.date.today(), route[0], route[1], config_, logger_, client_=client)
+        except Exception as e:
+            logger_.debug(f'Poll failed: City = {route[0]} // Route = {route[1]} // {e!r}')
+            return pd.DataFrame()
+
+    try:
+        with ThreadPoolExecutor(max_workers=config_.get('FETCH_WORKERS', 1)) as executor:
+            while cycles is None or cycle < cycles:
+                cycle_start = time.monotonic()
+                moving = 0
+
+                if datetime.date.today() != today:
+                    today = datetime.date.today()
+                    last_seen.forget(pd.Timestamp(today))
+
+                for df in executor.map(poll, routes):
+                    new = last_seen.new_rows(df)
+                    moving += len(new) != 0
+                    writer.add(new)
+
+                polls += len(routes)
+                cycle += 1
+                cycle_seconds = time.monotonic() - cycle_start
+                interval = next_interval(interval, cycle_seconds, moving / max(len(routes), 1), config_)
+
+                elapsed = time.monotonic() - started
+                lag = (datetime.datetime.now() - writer.max_timestamp).total_seconds() \
+                    if writer.max_timestamp is not None else float('nan')
+
+                logger_.debug(f'Cycle {cycle}: {cycle_seconds:.1f}s // routes with new points = {moving} // '
+                              f'buffered = {writer.buffered} // vehicles = {len(last_seen)} // lag = {lag:.0f}s // '
+                              f'{polls / elapsed:.2f} polls/s // {writer.written / elapsed:.1f} rows/s // '
+                              f'next poll in {interval:.0f}s')
+
+                if cycles is None or cycle < cycles:
+                    time.sleep(max(0, interval - cycle_seconds))
+    except KeyboardInterrupt:
+        logger_.debug('Interrupted')
+    finally:
+        writer.close()
+        client.close()
+
+    return writer.written
+
+
+if __name__ == '__main__':
+    with open('config.yaml') as file:
+        config = yaml.Loader(file).get_data()
+
+    postgres_engine = create_engine('postgresql+psycopg2://{}:{}@{}/{}'.format(
+        config['DB_USER'],
+        config['DB_PASS'],
+        config['DB_HOST'],
+        config['DB_NAME']
+    ))
+
+    run_live(config, postgres_engine)
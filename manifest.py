@@ -0,0 +1,280 @@
+import os
+import sqlite3
+import hashlib
+import datetime
+import threading
+from utils import get_logger
+
+MANIFEST_DDL = """
+CREATE TABLE IF NOT EXISTS units (
+    city        text NOT NULL
+  , route_id    integer NOT NULL
+  , date        text NOT NULL
+  , status      text NOT NULL
+  , rows        integer
+  , checksum    text
+  , path        text
+  , attempts    integer NOT NULL DEFAULT 0
+  , updated_at  text NOT NULL
+  , PRIMARY KEY (city, route_id, date)
+);
+
+CREATE INDEX IF NOT EXISTS units_date_status ON units (date, status);
+"""
+
+FETCHED = 'fetched'
+LOADED = 'loaded'
+FAILED = 'failed'
+GAVE_UP = 'gave_up'
+
+
+def file_checksum(path):
+    """
+    Returns sha256 hex digest of file contents
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file_:
+        for chunk in iter(lambda: file_.read(2 ** 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def manifest_path(config_):
+    """
+    Returns MANIFEST_PATH, TEMP_FOLDER/manifest.sqlite by default
+    """
+
+    return config_.get('MANIFEST_PATH') or '/'.join([config_['TEMP_FOLDER'], 'manifest.sqlite'])
+
+
+class Manifest:
+    """
+    Persistent SQLite index of (city, route_id, date) telemetry units with status, row count and checksum
+    Lives at MANIFEST_PATH (TEMP_FOLDER/manifest.sqlite by default)
+    A unit that failed FETCH_MAX_ATTEMPTS times in a row is given up and no longer fetched
+    """
+
+    def __init__(self, config_):
+        self.path = manifest_path(config_)
+        self.logger = get_logger('manifest')
+        self.lock = threading.Lock()
+        self.max_attempts = config_.get('FETCH_MAX_ATTEMPTS', 5)
+
+        is_new = not os.path.exists(self.path)
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript(MANIFEST_DDL)
+
+        # manifests created before attempts were counted
+        if 'attempts' not in [row[1] for row in self.connection.execute("PRAGMA table_info(units)")]:
+            self.connection.execute("ALTER TABLE units ADD COLUMN attempts integer NOT NULL DEFAULT 0")
+
+        if is_new:
+            self.seed(config_['TEMP_FOLDER'])
+
+    def _execute(self, query, parameters=()):
+        with self.lock, self.connection:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def seed(self, temp_folder):
+        """
+        Registers telemetry files already present in temp_folder as fetched
+        Checksums are left empty, row counts are unknown
+        """
+
+        count = 0
+
+        for folder in os.listdir(temp_folder):
+            if not folder.startswith('telemetry_') or os.path.isfile('/'.join([temp_folder, folder])):
+                continue
+            for file_ in os.listdir('/'.join([temp_folder, folder])):
+                # {city}_{route_id}_{YYYY}_{MM}_{DD}.<extension>
+                parts = os.path.splitext(file_)[0].rsplit('_', 4)
+                try:
+                    date = datetime.datetime.strptime('_'.join(parts[2:]), '%Y_%m_%d').date()
+                    self.mark_fetched(parts[0], int(parts[1]), date, None, '/'.join([temp_folder, folder, file_]),
+                                      checksum=False)
+                    count += 1
+                except ValueError:
+                    continue
+
+        self.logger.debug(f'Seeded manifest with {count} units from {temp_folder}')
+
+    def statuses(self, date, cities=None):
+        """
+        Returns dict {(city, route_id): status} for date
+        """
+
+        rows = self._execute("SELECT city, route_id, status FROM units WHERE date = ?", (date.isoformat(),))
+
+        return {(city, route_id): status for city, route_id, status in rows if cities is None or city in cities}
+
+    def last_date(self, cities):
+        """
+        Returns latest date with any unit for cities, None if manifest is empty
+        """
+
+        placeholders = ', '.join('?' * len(cities))
+        date = self._execute(f"SELECT max(date) FROM units WHERE city IN ({placeholders})", tuple(cities))[0][0]
+
+        return datetime.date.fromisoformat(date) if date else None
+
+    def mark_fetched(self, city, route_id, date, rows, path, checksum=True):
+        """
+        Records unit as fetched, computes file checksum unless checksum=False
+        """
+
+        self._execute("""
+            INSERT OR REPLACE INTO units (city, route_id, date, status, rows, checksum, path, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (city, route_id, date.isoformat(), FETCHED, rows,
+              file_checksum(path) if checksum and os.path.exists(path) else None,
+              path, datetime.datetime.now().isoformat()))
+
+    def mark_failed(self, city, route_id, date):
+        """
+        Records unit as failed, so the next run fetches it again
+        After max_attempts failures in a row the unit is given up instead
+        """
+
+        self._execute("""
+            INSERT INTO units (city, route_id, date, status, rows, checksum, path, attempts, updated_at)
+            VALUES (?, ?, ?, CASE WHEN 1 >= ? THEN ? ELSE ? END, NULL, NULL, NULL, 1, ?)
+            ON CONFLICT (city, route_id, date) DO UPDATE
+            SET status = CASE WHEN units.attempts + 1 >= ? THEN ? ELSE ? END
+              , rows = NULL
+              , checksum = NULL
+              , path = NULL
+              , attempts = units.attempts + 1
+              , updated_at = excluded.updated_at
+        """, (city, route_id, date.isoformat(), self.max_attempts, GAVE_UP, FAILED,
+              datetime.datetime.now().isoformat(), self.max_attempts, GAVE_UP, FAILED))
+
+        status, attempts = self._execute("SELECT status, attempts FROM units WHERE city = ? AND route_id = ? "
+                                         "AND date = ?", (city, route_id, date.isoformat()))[0]
+
+        if status == GAVE_UP:
+            self.logger.warning(f'Gave up on City = {city} // Route = {route_id} // Date = {date} '
+                                f'after {attempts} attempts')
+
+    def first_incomplete_date(self, routes):
+        """
+        Returns earliest date with a failed unit or a day between first and last date of the manifest on which
+        one of routes [(city, route_id, valid_from date)] has no fetched, loaded or given up unit,
+        None if there is none
+        A route is expected from its valid_from on, so routes added later do not reach back to older days
+        """
+
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS expected (city text, route_id integer, "
+                                    "valid_from text)")
+            self.connection.execute("DELETE FROM expected")
+            self.connection.executemany("INSERT INTO expected VALUES (?, ?, ?)",
+                                        [(city, route_id, valid_from.isoformat())
+                                         for city, route_id, valid_from in routes])
+
+            date = self.connection.execute("""
+                WITH RECURSIVE days(date) AS (
+                    SELECT min(date) FROM units WHERE city IN (SELECT city FROM expected)
+                    UNION ALL
+                    SELECT date(date, '+1 day')
+                    FROM days
+                    WHERE date < (SELECT max(date) FROM units WHERE city IN (SELECT city FROM expected))
+                )
+                SELECT min(date)
+                FROM (
+                    SELECT min(d.date) AS date
+                    FROM days d
+                        INNER JOIN expected e
+                            ON e.valid_from <= d.date
+                        LEFT JOIN units u
+                            ON u.city = e.city AND u.route_id = e.route_id AND u.date = d.date
+                           AND u.status != ?
+                    WHERE u.date IS NULL
+                    UNION ALL
+                    SELECT min(date)
+                    FROM units
+                    WHERE status = ? AND city IN (SELECT city FROM expected)
+                )
+            """, (FAILED, FAILED)).fetchone()[0]
+
+        return datetime.date.fromisoformat(date) if date else None
+
+    def mark_loaded(self, date):
+        """
+        Marks all fetched units of date as loaded, returns their row count
+        """
+
+        rows = self._execute("SELECT coalesce(sum(rows), 0) FROM units WHERE date = ? AND status = ?",
+                             (date.isoformat(), FETCHED))[0][0]
+
+        self._execute("UPDATE units SET status = ?, updated_at = ? WHERE date = ? AND status = ?",
+                      (LOADED, datetime.datetime.now().isoformat(), date.isoformat(), FETCHED))
+
+        return rows
+
+    def units(self, status=None):
+        """
+        Returns [(city, route_id, date)] of units with status (all units if None)
+        """
+
+        rows = self._execute("SELECT city, route_id, date FROM units WHERE ? IS NULL OR status = ? ORDER BY date",
+                             (status, status))
+
+        return [(city, route_id, datetime.date.fromisoformat(date)) for city, route_id, date in rows]
+
+    def summary(self):
+        """
+        Returns {status: (units, rows, first date, last date)}
+        """
+
+        rows = self._execute("""
+            SELECT status, count(*), coalesce(sum(rows), 0), min(date), max(date)
+            FROM units
+            GROUP BY status
+            ORDER BY status
+        """)
+
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def partial_days(self):
+        """
+        Returns dates with both loaded and not loaded units, given up units do not count
+        """
+
+        rows = self._execute("""
+            SELECT date
+            FROM units
+            GROUP BY date
+            HAVING sum(status = ?) > 0 AND sum(status NOT IN (?, ?)) > 0
+            ORDER BY date
+        """, (LOADED, LOADED, GAVE_UP))
+
+        return [datetime.date.fromisoformat(row[0]) for row in rows]
+
+    def verify_day(self, date, engine_, written, carried=0):
+        """
+        Compares rows written to date by this load with transport.telemetry_days rows minus carried,
+        the rows swap_partition kept from the previous partition, so the check is exact with or without dedup
+        Units of a mismatching day are reset to fetched so the next run reloads them
+        """
+
+        actual = engine_.execute(f"""
+            select coalesce(max(rows), 0)
+            from transport.telemetry_days
+            where date = '{date}'
+        """).fetchone()[0] - carried
+
+        if actual != written:
+            self.logger.debug(f'Day {date} is partially loaded: {actual} rows in DB, {written} written')
+            self._execute("UPDATE units SET status = ? WHERE date = ? AND status = ?",
+                          (FETCHED, date.isoformat(), LOADED))
+            return False
+
+        return True
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,401 @@
+import heapq
+import numpy as np
+import pandas as pd
+import shapely
+from spatial import utm_epsg, project
+from tracks import iter_vehicle_chunks
+from utils import get_logger
+
+EDGE_COLUMNS = [
+    'uniqueid',
+    'bus_id',
+    'edge_id',
+    'way_id',
+    'from_node',
+    'to_node',
+    'entered',
+    'seconds',
+    'length',
+    'speed',
+    'points'
+]
+
+
+class RoadGraph:
+    """
+    Routable graph of one city built from dev.fetch_roads / osm_cache roads layer
+    Ways are split into edges at junctions (vertices shared by more than two segments) and way ends,
+    vertices with identical coordinates are one node
+    Adjacency is stored as CSR arrays (indptr, indices, weights), edges are two-way
+    Candidate search runs on an STRtree over projected segments, each segment knows its edge and offset
+    """
+
+    def __init__(self, roads_gdf, epsg=None):
+        self.logger = get_logger('mapmatch')
+
+        lines = roads_gdf.explode(index_parts=False)
+        lines = lines[lines.geometry.geom_type == 'LineString']
+
+        coordinates, line = shapely.get_coordinates(np.asarray(lines.geometry), return_index=True)
+
+        self.epsg = epsg or utm_epsg(coordinates[:, 0])
+
+        _, node = np.unique(np.round(coordinates, 7), axis=0, return_inverse=True)
+        node = node.ravel()
+        x, y = project(coordinates[:, 0], coordinates[:, 1], self.epsg)
+
+        # segment a -> a + 1 between consecutive vertices of a line, zero-length ones dropped
+        start_vertex = np.flatnonzero((line[1:] == line[:-1]) & (node[1:] != node[:-1]))
+
+        pairs = np.unique(np.sort(np.column_stack([node[start_vertex], node[start_vertex + 1]]), axis=1), axis=0)
+        degree = np.bincount(pairs.ravel(), minlength=node.max() + 1 if len(node) else 0)
+
+        previous_continues = np.r_[False, (line[start_vertex][1:] == line[start_vertex][:-1]) &
+                                   (start_vertex[1:] == start_vertex[:-1] + 1)]
+        edge_start = ~previous_continues | (degree[node[start_vertex]] != 2)
+        edge_end = np.r_[edge_start[1:], True]
+
+        segment_edge = np.cumsum(edge_start) - 1
+        dx = x[start_vertex + 1] - x[start_vertex]
+        dy = y[start_vertex + 1] - y[start_vertex]
+        segment_length = np.hypot(dx, dy)
+        cumulative = np.cumsum(segment_length) - segment_length
+
+        self.segment_x = x[start_vertex]
+        self.segment_y = y[start_vertex]
+        self.segment_dx = dx
+        self.segment_dy = dy
+        self.segment_length = segment_length
+        self.segment_edge = segment_edge
+        self.segment_offset = cumulative - cumulative[edge_start][segment_edge]
+
+        self.edge_length = np.bincount(segment_edge, weights=segment_length)
+        self.edge_way = lines['id'].to_numpy()[line[start_vertex][edge_start]] if 'id' in lines.columns \
+            else line[start_vertex][edge_start]
+
+        nodes, endpoints = np.unique(np.r_[node[start_vertex][edge_start], node[start_vertex + 1][edge_end]],
+                                     return_inverse=True)
+        self.nodes = len(nodes)
+        self.edge_u = endpoints[:len(self.edge_length)]
+        self.edge_v = endpoints[len(self.edge_length):]
+
+        # CSR over both directions, parallel edges keep the shortest, loops are dropped
+        source = np.r_[self.edge_u, self.edge_v]
+        target = np.r_[self.edge_v, self.edge_u]
+        weight = np.r_[self.edge_length, self.edge_length]
+        keep = source != target
+        order = np.lexsort((weight[keep], target[keep], source[keep]))
+        source, target, weight = source[keep][order], target[keep][order], weight[keep][order]
+        first = np.r_[True, (source[1:] != source[:-1]) | (target[1:] != target[:-1])]
+        source, target, weight = source[first], target[first], weight[first]
+
+        self.indptr = np.searchsorted(source, np.arange(self.nodes + 1))
+        self.indices = target
+        self.weights = weight
+
+        # plain lists are much faster than numpy scalars inside the Dijkstra loop
+        self._adjacency = (self.indptr.tolist(), self.indices.tolist(), self.weights.tolist())
+
+        segments = np.stack([np.column_stack([self.segment_x, self.segment_y]),
+                             np.column_stack([self.segment_x + dx, self.segment_y + dy])], axis=1)
+        self.tree = shapely.STRtree(shapely.linestrings(segments))
+
+        self.logger.debug(f'Built graph of {len(self.edge_length)} edges, {self.nodes} nodes, '
+                          f'{len(segment_length)} segments in EPSG:{self.epsg}')
+
+    def candidates(self, x, y, radius, k):
+        """
+        Returns (edge, position along edge, distance) arrays of shape (points, k) of k nearest edges
+        within radius meters of each point, edge = -1 and distance = inf where there are fewer
+        """
+
+        points = len(x)
+        edge = np.full((points, k), -1)
+        position = np.zeros((points, k))
+        distance = np.full((points, k), np.inf)
+
+        point_index, segment = self.tree.query(shapely.points(x, y), predicate='dwithin', distance=radius)
+
+        if len(point_index) == 0:
+            return edge, position, distance
+
+        px = x[point_index] - self.segment_x[segment]
+        py = y[point_index] - self.segment_y[segment]
+        length = self.segment_length[segment]
+        t = np.clip((px * self.segment_dx[segment] + py * self.segment_dy[segment]) / length ** 2, 0, 1)
+        dist = np.hypot(px - t * self.segment_dx[segment], py - t * self.segment_dy[segment])
+        segment_edge = self.segment_edge[segment]
+        along = self.segment_offset[segment] + t * length
+
+        # nearest segment of each (point, edge), then k nearest edges of each point
+        order = np.lexsort((dist, segment_edge, point_index))
+        first = np.r_[True, (point_index[order][1:] != point_index[order][:-1]) |
+                      (segment_edge[order][1:] != segment_edge[order][:-1])]
+        order = order[first]
+        order = order[np.lexsort((dist[order], point_index[order]))]
+
+        point_order = point_index[order]
+        rank = np.arange(len(order)) - np.searchsorted(point_order, point_order)
+        order, rank = order[rank < k], rank[rank < k]
+
+        edge[point_index[order], rank] = segment_edge[order]
+        position[point_index[order], rank] = along[order]
+        distance[point_index[order], rank] = dist[order]
+
+        return edge, position, distance
+
+    def _dijkstra(self, source, targets, limit):
+        """
+        Returns {target: distance} of targets reachable from source within limit meters
+        Stops as soon as every target is settled
+        """
+
+        indptr, indices, weights = self._adjacency
+        best = {source: 0.0}
+        heap = [(0.0, source)]
+        remaining = set(targets)
+        found = {}
+
+        while heap and remaining:
+            distance, node = heapq.heappop(heap)
+
+            if distance > best[node]:
+                continue
+
+            if node in remaining:
+                remaining.discard(node)
+                found[node] = distance
+
+            for i in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[i]
+                candidate = distance + weights[i]
+                if candidate <= limit and candidate < best.get(neighbour, np.inf):
+                    best[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+
+        return found
+
+    def shortest_paths(self, sources, targets, limits):
+        """
+        Returns network distance for each (source, target) node pair, inf if longer than its limit
+        One bounded Dijkstra runs per distinct source
+        """
+
+        keys = sources.astype('int64') * self.nodes + targets
+        unique, inverse = np.unique(keys, return_inverse=True)
+        unique_limits = np.zeros(len(unique))
+        np.maximum.at(unique_limits, inverse, limits)
+
+        result = np.full(len(unique), np.inf)
+        unique_sources = unique // self.nodes
+        bounds = np.flatnonzero(np.r_[True, unique_sources[1:] != unique_sources[:-1], True])
+
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            targets_ = (unique[lo:hi] % self.nodes).tolist()
+            found = self._dijkstra(int(unique_sources[lo]), targets_, float(unique_limits[lo:hi].max()))
+            result[lo:hi] = [found.get(target, np.inf) for target in targets_]
+
+        return result[inverse]
+
+    def route_distances(self, edge_a, position_a, edge_b, position_b, limits):
+        """
+        Returns (route length, exit cost on edge_a, entry cost on edge_b, exit node, entry node)
+        of the shortest route between positions on two edges, inf route if longer than limit
+        Positions on the same edge are connected directly
+        """
+
+        ends_a = [(self.edge_u[edge_a], position_a), (self.edge_v[edge_a], self.edge_length[edge_a] - position_a)]
+        ends_b = [(self.edge_u[edge_b], position_b), (self.edge_v[edge_b], self.edge_length[edge_b] - position_b)]
+
+        combinations = [(node_a, cost_a, node_b, cost_b) for node_a, cost_a in ends_a for node_b, cost_b in ends_b]
+        paths = self.shortest_paths(np.concatenate([node_a for node_a, _, _, _ in combinations]),
+                                    np.concatenate([node_b for _, _, node_b, _ in combinations]),
+                                    np.tile(limits, len(combinations))).reshape(len(combinations), -1)
+
+        totals = np.stack([cost_a + paths[i] + cost_b for i, (_, cost_a, _, cost_b) in enumerate(combinations)])
+        best = np.argmin(totals, axis=0)
+        columns = np.arange(len(edge_a))
+
+        route = totals[best, columns]
+        exit_cost = np.stack([cost_a for _, cost_a, _, _ in combinations])[best, columns]
+        entry_cost = np.stack([cost_b for _, _, _, cost_b in combinations])[best, columns]
+        exit_node = np.stack([node_a for node_a, _, _, _ in combinations])[best, columns]
+        entry_node = np.stack([node_b for _, _, node_b, _ in combinations])[best, columns]
+
+        same = edge_a == edge_b
+        route[same] = np.abs(position_b[same] - position_a[same])
+        route[route > limits] = np.inf
+
+        return route, exit_cost, entry_cost, exit_node, entry_node
+
+
+def viterbi(emission, transition, step, order, bounds):
+    """
+    Most likely candidate of each point, vectorized across vehicles: step s of every vehicle is one numpy pass
+    emission is (points, k) log-probabilities, transition (points, k, k) from point p to p + 1
+    A point whose every path is impossible restarts the chain from its own emission
+    Returns (chosen candidate or -1, continues from previous point) arrays
+    """
+
+    points, k = emission.shape
+    score = np.full((points, k), -np.inf)
+    back = np.full((points, k), -1, dtype='int8')
+
+    for s in range(len(bounds) - 1):
+        current = order[bounds[s]:bounds[s + 1]]
+
+        if s == 0:
+            score[current] = emission[current]
+            continue
+
+        previous = current - 1
+        candidate = score[previous][:, :, None] + transition[previous]
+        arg = candidate.argmax(axis=1)
+        new = np.take_along_axis(candidate, arg[:, None, :], axis=1)[:, 0, :] + emission[current]
+
+        restart = ~np.isfinite(new).any(axis=1)
+        new[restart] = emission[current][restart]
+        arg[restart] = -1
+
+        score[current] = new
+        back[current] = arg
+
+    chosen = np.full(points, -1)
+    continues = np.zeros(points, dtype=bool)
+
+    for s in reversed(range(len(bounds) - 1)):
+        current = order[bounds[s]:bounds[s + 1]]
+
+        finite = np.isfinite(score[current]).any(axis=1)
+        chosen[current] = np.where(finite, score[current].argmax(axis=1), -1)
+
+        following = current + 1
+        linked = following < points
+        linked[linked] = (step[following[linked]] == s + 1) & (chosen[following[linked]] != -1)
+        linked[linked] = back[following[linked], chosen[following[linked]]] != -1
+
+        chosen[current[linked]] = back[following[linked], chosen[following[linked]]]
+        continues[following[linked]] = True
+
+    return chosen, continues
+
+
+def match_chunk(df, graph, sigma, beta, radius, k, max_gap, max_speed):
+    """
+    Map-matches telemetry of a few vehicles sorted by (uniqueid, timestamp), returns edge traversals
+    """
+
+    points = len(df)
+    x, y = project(df['lon'], df['lat'], graph.epsg)
+    seconds = df['timestamp'].to_numpy(dtype='datetime64[ns]').astype('int64') / 1e9
+    vehicle = df['uniqueid'].to_numpy()
+
+    new_vehicle = np.r_[True, vehicle[1:] != vehicle[:-1]]
+    first_point = np.maximum.accumulate(np.where(new_vehicle, np.arange(points), 0))
+    step = np.arange(points) - first_point
+
+    edge, position, distance = graph.candidates(x, y, radius, k)
+    emission = np.where(edge != -1, -0.5 * (distance / sigma) ** 2, -np.inf)
+
+    # transitions p -> p + 1 of the same vehicle within max_gap seconds
+    dt = np.diff(seconds)
+    great_circle = np.hypot(np.diff(x), np.diff(y))
+    linked = np.flatnonzero(~new_vehicle[1:] & (dt <= max_gap) & (dt >= 0))
+
+    transition = np.full((points, k, k), -np.inf)
+
+    pair_a, pair_b = np.meshgrid(np.arange(k), np.arange(k), indexing='ij')
+    pair_a, pair_b = pair_a.ravel(), pair_b.ravel()
+
+    rows = np.repeat(linked, k * k)
+    edge_a = edge[rows, np.tile(pair_a, len(linked))]
+    edge_b = edge[rows + 1, np.tile(pair_b, len(linked))]
+    valid = (edge_a != -1) & (edge_b != -1)
+
+    limits = np.minimum(max_speed * dt[rows], 2 * great_circle[rows] + 2 * radius)
+    route = np.full(len(rows), np.inf)
+
+    if valid.any():
+        route[valid] = graph.route_distances(edge_a[valid], position[rows, np.tile(pair_a, len(linked))][valid],
+                                             edge_b[valid], position[rows + 1, np.tile(pair_b, len(linked))][valid],
+                                             limits[valid])[0]
+
+    transition[rows, np.tile(pair_a, len(linked)), np.tile(pair_b, len(linked))] = \
+        np.where(np.isfinite(route), -np.abs(route - great_circle[rows]) / beta, -np.inf)
+
+    order = np.argsort(step, kind='stable')
+    bounds = np.searchsorted(step[order], np.arange(step.max() + 2)) if points else np.array([0])
+
+    chosen, continues = viterbi(emission, transition, step, order, bounds)
+
+    matched = chosen != -1
+    matched_edge = np.where(matched, edge[np.arange(points), np.maximum(chosen, 0)], -1)
+    matched_position = position[np.arange(points), np.maximum(chosen, 0)]
+
+    # runs of consecutive points on one edge along a continuous path
+    same_edge = np.r_[False, matched_edge[1:] == matched_edge[:-1]] & continues
+    run = np.cumsum(~same_edge) - 1
+    runs = run[-1] + 1 if points else 0
+
+    entered = np.full(runs, np.nan)
+    left = np.full(runs, np.nan)
+    from_node = np.full(runs, -1)
+    to_node = np.full(runs, -1)
+
+    crossing = np.flatnonzero(continues[1:] & ~same_edge[1:])
+
+    if len(crossing) != 0:
+        route, exit_cost, entry_cost, exit_node, entry_node = graph.route_distances(
+            matched_edge[crossing], matched_position[crossing], matched_edge[crossing + 1],
+            matched_position[crossing + 1], np.full(len(crossing), np.inf))
+
+        share = np.where(route > 0, 1 / np.where(route > 0, route, 1), 0)
+        left[run[crossing]] = seconds[crossing] + dt[crossing] * exit_cost * share
+        to_node[run[crossing]] = exit_node
+        entered[run[crossing + 1]] = seconds[crossing + 1] - dt[crossing] * entry_cost * share
+        from_node[run[crossing + 1]] = entry_node
+
+    run_first = np.flatnonzero(~same_edge)
+    run_edge = matched_edge[run_first]
+
+    # complete traversals: entered and left through different ends of a matched edge
+    complete = (run_edge != -1) & np.isfinite(entered) & np.isfinite(left) & (from_node != to_node) & \
+        (from_node != -1) & (to_node != -1)
+
+    length = graph.edge_length[run_edge[complete]]
+    traversal_seconds = left[complete] - entered[complete]
+
+    return pd.DataFrame({
+        'uniqueid': vehicle[run_first[complete]],
+        'bus_id': df['bus_id'].to_numpy()[run_first[complete]],
+        'edge_id': run_edge[complete],
+        'way_id': graph.edge_way[run_edge[complete]],
+        'from_node': from_node[complete],
+        'to_node': to_node[complete],
+        'entered': pd.to_datetime(np.round(entered[complete] * 1e9).astype('int64'), unit='ns'),
+        'seconds': traversal_seconds,
+        'length': length,
+        'speed': np.where(traversal_seconds > 0, length / np.maximum(traversal_seconds, 1e-9) * 3.6, np.nan),
+        'points': np.bincount(run, minlength=runs)[complete],
+    }, columns=EDGE_COLUMNS)
+
+
+def match_telemetry(telemetry_df, graph, sigma=10, beta=50, radius=50, k=5, max_gap=120, max_speed=30,
+                    vehicles=200):
+    """
+    Snaps each vehicle's ordered points to road edges with an HMM (Gaussian GPS noise of sigma meters,
+    exponential penalty with scale beta on the difference between route and straight-line distance)
+    and returns per-edge traversal times: one row per edge a vehicle entered and left through different ends
+    Points more than max_gap seconds apart or needing more than max_speed m/s start a new chain
+    Edges crossed between two points without a point on them are not reported
+    """
+
+    df = telemetry_df.sort_values(['uniqueid', 'timestamp'], kind='stable')
+
+    chunks = [match_chunk(chunk, graph, sigma, beta, radius, k, max_gap, max_speed)
+              for chunk in iter_vehicle_chunks(df, vehicles) if len(chunk) != 0]
+
+    if len(chunks) == 0:
+        return pd.DataFrame([], columns=EDGE_COLUMNS)
+
+    return pd.concat(chunks, ignore_index=True)
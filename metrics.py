@@ -0,0 +1,144 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+PREFIX = 'bustime'
+
+
+class Metrics:
+    """
+    Thread-safe registry of timing spans and counters labelled by stage, city, route, relation
+    Counters incremented inside a span inherit its labels, so HTTP retries and bytes of a fetch
+    land on the city and route being fetched
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def _labels(self, labels):
+        current = dict(getattr(self.local, 'labels', {}))
+        current.update({key: str(value) for key, value in labels.items() if value is not None})
+
+        return current
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        Times the with-block as stage, accumulating calls, total and max seconds per label set
+        """
+
+        outer = getattr(self.local, 'labels', {})
+        labels = self._labels(labels)
+        self.local.labels = labels
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.local.labels = outer
+
+            with self.lock:
+                span = self.spans.setdefault(self._key(stage, labels), {'calls': 0, 'seconds': 0.0, 'max': 0.0})
+                span['calls'] += 1
+                span['seconds'] += seconds
+                span['max'] = max(span['max'], seconds)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds value to counter name
+        """
+
+        key = self._key(name, self._labels(labels))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def stage_seconds(self):
+        """
+        Returns total seconds per stage over all labels
+        """
+
+        totals = {}
+
+        with self.lock:
+            for (stage, _), span in self.spans.items():
+                totals[stage] = totals.get(stage, 0) + span['seconds']
+
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'spans': [dict(stage=stage, labels=dict(labels), **span) for (stage, labels), span in self.spans.items()],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self.counters.items()],
+            }
+
+    def to_prometheus(self):
+        """
+        Returns metrics in Prometheus text exposition format
+        """
+
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+        lines = []
+
+        with self.lock:
+            for suffix, field in [('calls_total', 'calls'), ('seconds_total', 'seconds'), ('seconds_max', 'max')]:
+                lines.append(f'# TYPE {PREFIX}_stage_{suffix} {"gauge" if field == "max" else "counter"}')
+                for (stage, labels), span in sorted(self.spans.items()):
+                    lines.append(f'{PREFIX}_stage_{suffix}{format_labels((("stage", stage),) + labels)} '
+                                 f'{span[field]}')
+
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{PREFIX}_{name}_total{format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """
+        Writes metrics to path: Prometheus text for .prom files, JSON summary otherwise
+        """
+
+        with open(path, 'w', encoding='utf-8') as file:
+            if path.endswith('.prom'):
+                file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), file, ensure_ascii=False, indent=1, default=str)
+
+    def report(self, logger_):
+        """
+        Logs total seconds per stage, slowest first
+        """
+
+        logger_.debug(' // '.join(f'{stage} = {seconds:.1f}s' for stage, seconds in self.stage_seconds().items()))
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = {}
+            self.started = time.time()
+
+
+# process-wide registry used by pipeline stages
+registry = Metrics()
+span = registry.span
+inc = registry.inc
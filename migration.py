@@ -48,16 +48,100 @@ CONSTRAINTS_NAMES = {
     'routes': ['routes_pk', 'routes_city_id_fkey']
 }
 
+# current version of each city and route stays in cities / routes (valid_to is set when it disappears),
+# replaced versions are moved to *_history
+REFERENCE_HISTORY_DDL = """
+ALTER TABLE transport.cities
+    ADD COLUMN IF NOT EXISTS valid_from timestamp NOT NULL DEFAULT now()
+  , ADD COLUMN IF NOT EXISTS valid_to timestamp;
+
+ALTER TABLE transport.routes
+    ADD COLUMN IF NOT EXISTS valid_from timestamp NOT NULL DEFAULT now()
+  , ADD COLUMN IF NOT EXISTS valid_to timestamp;
+
+CREATE TABLE IF NOT EXISTS transport.cities_history (
+    id           bigint NOT NULL
+  , name         varchar(255) NOT NULL
+  , valid_from   timestamp NOT NULL
+  , valid_to     timestamp NOT NULL
+  , CONSTRAINT cities_history_pk PRIMARY KEY (id, valid_from)
+);
+
+CREATE TABLE IF NOT EXISTS transport.routes_history (
+    id           int NOT NULL
+  , name         varchar(255) NOT NULL
+  , type         varchar(255)
+  , city_id      bigint NOT NULL
+  , valid_from   timestamp NOT NULL
+  , valid_to     timestamp NOT NULL
+  , CONSTRAINT routes_history_pk PRIMARY KEY (id, valid_from)
+);
+"""
+
+REFERENCE_MIGRATION = REFERENCE_HISTORY_DDL
+
+REFERENCE_COLUMNS = {
+    'cities': ['name'],
+    'routes': ['name', 'type', 'city_id']
+}
+
+REFERENCE_STAGING_DDL = """
+DROP TABLE IF EXISTS transport.{0}_staging;
+CREATE UNLOGGED TABLE transport.{0}_staging (LIKE transport.{0} INCLUDING DEFAULTS);
+"""
+
+# {0} relation, {1} columns, {2} current values, {3} staged values
+REFERENCE_HISTORY_INSERT = """
+INSERT INTO transport.{0}_history (id, {1}, valid_from, valid_to)
+SELECT r.id
+     , {2}
+     , r.valid_from
+     , coalesce(r.valid_to, now())
+FROM transport.{0} r
+    INNER JOIN transport.{0}_staging s
+        ON s.id = r.id
+WHERE ({2}) IS DISTINCT FROM ({3})
+   OR r.valid_to IS NOT NULL
+ON CONFLICT DO NOTHING;
+"""
+
+# {0} relation, {1} columns, {2} current values, {3} assignments, {4} excluded values
+REFERENCE_UPSERT = """
+INSERT INTO transport.{0} AS r (id, {1})
+SELECT id, {1}
+FROM transport.{0}_staging
+ON CONFLICT (id) DO UPDATE
+SET {3}
+  , valid_from = now()
+  , valid_to = NULL
+WHERE ({2}) IS DISTINCT FROM ({4})
+   OR r.valid_to IS NOT NULL
+RETURNING (xmax = 0) AS inserted;
+"""
+
+# {0} relation, {1} extra condition limiting removal to the synced scope
+REFERENCE_REMOVE = """
+UPDATE transport.{0} r
+SET valid_to = now()
+WHERE r.valid_to IS NULL
+  AND NOT EXISTS (SELECT 1 FROM transport.{0}_staging s WHERE s.id = r.id){1};
+"""
+
+REFERENCE_SCOPES = {
+    'cities': '',
+    'routes': '\n  AND r.city_id IN (SELECT city_id FROM transport.routes_staging)'
+}
+
 TELEMETRY_DDL = """
 CREATE TABLE IF NOT EXISTS transport.telemetry (
     uniqueid      varchar(8) NOT NULL
   , "timestamp"   timestamp NOT NULL
   , bus_id        bigint NOT NULL
-  , heading       int
-  , speed         int
-  , lon           float NOT NULL
-  , lat           float NOT NULL
-  , direction     int
+  , heading       smallint
+  , speed         smallint
+  , lon           real NOT NULL
+  , lat           real NOT NULL
+  , direction     smallint
   , gosnum        varchar(255)
   , bortnum       varchar(255)
   , probeg        int
@@ -66,12 +150,536 @@ CREATE TABLE IF NOT EXISTS transport.telemetry (
 PARTITION BY RANGE("timestamp");
 """
 
+# only when some column still has its old type: views (telemetry_decoded) block ALTER COLUMN TYPE,
+# the view is dropped then and re-created by DICTIONARY_DDL later in TELEMETRY_MIGRATION
+TELEMETRY_RETYPE_DDL = """
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1
+               FROM information_schema.columns
+               WHERE table_schema = 'transport'
+                 AND table_name = 'telemetry'
+                 AND ((column_name IN ('heading', 'speed', 'direction') AND data_type <> 'smallint')
+                      OR (column_name IN ('lon', 'lat') AND data_type <> 'real'))) THEN
+        DROP VIEW IF EXISTS transport.telemetry_decoded;
+
+        ALTER TABLE transport.telemetry
+            ALTER COLUMN heading TYPE smallint
+          , ALTER COLUMN speed TYPE smallint
+          , ALTER COLUMN lon TYPE real
+          , ALTER COLUMN lat TYPE real
+          , ALTER COLUMN direction TYPE smallint;
+    END IF;
+END
+$$;
+"""
+
+# created on the partitioned table, so every partition gets them; ATTACH reuses matching staging indexes
+TELEMETRY_INDEXES_DDL = """
+CREATE INDEX IF NOT EXISTS telemetry_timestamp_brin ON transport.telemetry USING brin ("timestamp");
+CREATE INDEX IF NOT EXISTS telemetry_bus_id_uniqueid_timestamp ON transport.telemetry (bus_id, uniqueid, "timestamp");
+"""
+
+TELEMETRY_DAYS_DDL = """
+CREATE TABLE IF NOT EXISTS transport.telemetry_days (
+    date          date NOT NULL CONSTRAINT telemetry_days_pk PRIMARY KEY
+  , rows          bigint NOT NULL
+  , min_timestamp timestamp
+  , max_timestamp timestamp
+  , loaded_at     timestamp NOT NULL DEFAULT now()
+);
+
+INSERT INTO transport.telemetry_days (date, rows, min_timestamp, max_timestamp)
+SELECT date("timestamp")
+     , count(*)
+     , min("timestamp")
+     , max("timestamp")
+FROM transport.telemetry
+GROUP BY 1
+ON CONFLICT (date) DO NOTHING;
+"""
+
+# days exported to Parquet and dropped from the database by archive.py
+TELEMETRY_ARCHIVE_DDL = """
+ALTER TABLE transport.telemetry_days ADD COLUMN IF NOT EXISTS archived_at timestamp;
+"""
+
+# vehicle_id and gosnum_id are part of telemetry (indexes and staging depend on them) whether or not
+# DICTIONARY_ENCODE is set, the dictionary stays empty without it
+# dense per-kind integer ids (city, vehicle, gosnum), never reused or renumbered
+DICTIONARY_DDL = """
+CREATE TABLE IF NOT EXISTS transport.dictionary (
+    kind      varchar(16) NOT NULL
+  , value     varchar(255) NOT NULL
+  , id        int NOT NULL
+  , CONSTRAINT dictionary_pk PRIMARY KEY (kind, value)
+  , CONSTRAINT dictionary_kind_id UNIQUE (kind, id)
+);
+
+ALTER TABLE transport.telemetry
+    ADD COLUMN IF NOT EXISTS vehicle_id int
+  , ADD COLUMN IF NOT EXISTS gosnum_id int
+  , ALTER COLUMN uniqueid DROP NOT NULL;
+
+CREATE INDEX IF NOT EXISTS telemetry_bus_id_vehicle_id_timestamp
+    ON transport.telemetry (bus_id, vehicle_id, "timestamp");
+
+CREATE OR REPLACE VIEW transport.telemetry_decoded AS
+SELECT coalesce(t.uniqueid, v.value) AS uniqueid
+     , t."timestamp"
+     , t.bus_id
+     , t.heading
+     , t.speed
+     , t.lon
+     , t.lat
+     , t.direction
+     , coalesce(t.gosnum, g.value) AS gosnum
+     , t.bortnum
+     , t.probeg
+     , t.upload_date
+FROM transport.telemetry t
+    LEFT JOIN transport.dictionary v
+        ON v.kind = 'vehicle' AND v.id = t.vehicle_id
+    LEFT JOIN transport.dictionary g
+        ON g.kind = 'gosnum' AND g.id = t.gosnum_id;
+"""
+
+TELEMETRY_MIGRATION = TELEMETRY_DDL + TELEMETRY_RETYPE_DDL + TELEMETRY_INDEXES_DDL + DICTIONARY_DDL + \
+    TELEMETRY_DAYS_DDL + TELEMETRY_ARCHIVE_DDL
+
+TELEMETRY_DAY_UPSERT = """
+INSERT INTO transport.telemetry_days (date, rows, min_timestamp, max_timestamp, loaded_at)
+SELECT '{0}'::date
+     , count(*)
+     , min("timestamp")
+     , max("timestamp")
+     , now()
+FROM transport.telemetry_{1}
+ON CONFLICT (date) DO UPDATE
+SET rows = excluded.rows
+  , min_timestamp = excluded.min_timestamp
+  , max_timestamp = excluded.max_timestamp
+  , loaded_at = excluded.loaded_at
+  , archived_at = NULL;
+"""
+
+MAX_DATE_QUERY = """
+select coalesce(max(date), current_date - interval '1 week') as max_date
+from transport.telemetry_days
+"""
+
 TELEMETRY_PARTITION_DDL = """
 DROP TABLE IF EXISTS transport.telemetry_{0};
 CREATE TABLE transport.telemetry_{0}
 PARTITION OF transport.telemetry FOR VALUES FROM ('{1}') TO ('{2}');
 """
 
+TELEMETRY_PARTITION_CREATE = """
+CREATE TABLE IF NOT EXISTS transport.telemetry_{0}
+PARTITION OF transport.telemetry FOR VALUES FROM ('{1}') TO ('{2}');
+"""
+
+TELEMETRY_STAGING_DDL = """
+DROP TABLE IF EXISTS transport.telemetry_{0}_staging;
+CREATE TABLE transport.telemetry_{0}_staging (LIKE transport.telemetry INCLUDING DEFAULTS);
+"""
+
+TELEMETRY_STAGING_CARRY_OVER = """
+INSERT INTO transport.telemetry_{0}_staging
+SELECT t.*
+FROM transport.telemetry_{0} t
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM transport.telemetry_{0}_staging s
+    WHERE s.bus_id = t.bus_id
+);
+"""
+
+TELEMETRY_STAGING_FINALIZE = """
+CREATE INDEX ON transport.telemetry_{0}_staging USING brin ("timestamp");
+CREATE INDEX ON transport.telemetry_{0}_staging (bus_id, uniqueid, "timestamp");
+CREATE INDEX ON transport.telemetry_{0}_staging (bus_id, vehicle_id, "timestamp");
+ALTER TABLE transport.telemetry_{0}_staging
+    ADD CONSTRAINT telemetry_{0}_range CHECK ("timestamp" >= '{1}' AND "timestamp" < '{2}');
+ANALYZE transport.telemetry_{0}_staging;
+"""
+
+# latest written position per vehicle since {1}, seeds live.LastSeen; {0} is telemetry or telemetry_decoded
+LIVE_WATERMARKS_QUERY = """
+select uniqueid
+     , max("timestamp")
+from transport.{0}
+where "timestamp" >= '{1}'
+group by 1
+"""
+
+TELEMETRY_DETACH_DDL = """
+ALTER TABLE transport.telemetry DETACH PARTITION transport.telemetry_{0};
+ALTER TABLE transport.telemetry_{0} RENAME TO telemetry_{0}_old;
+"""
+
+TELEMETRY_ATTACH_DDL = """
+ALTER TABLE transport.telemetry_{0}_staging RENAME TO telemetry_{0};
+ALTER TABLE transport.telemetry ATTACH PARTITION transport.telemetry_{0} FOR VALUES FROM ('{1}') TO ('{2}');
+DROP TABLE IF EXISTS transport.telemetry_{0}_old;
+"""
+
+# renumbers sha256-based city ids to dense dictionary ids, routes and history follow
+CITY_IDS_MIGRATION_DDL = """
+BEGIN;
+
+INSERT INTO transport.dictionary (kind, value, id)
+SELECT 'city'
+     , name
+     , (SELECT coalesce(max(id), 0) FROM transport.dictionary WHERE kind = 'city') + row_number() OVER (ORDER BY name)
+FROM transport.cities c
+WHERE NOT EXISTS (SELECT 1 FROM transport.dictionary d WHERE d.kind = 'city' AND d.value = c.name);
+
+CREATE TEMPORARY TABLE city_ids ON COMMIT DROP AS
+SELECT c.id AS old_id
+     , d.id AS new_id
+FROM transport.cities c
+    INNER JOIN transport.dictionary d
+        ON d.kind = 'city' AND d.value = c.name
+WHERE c.id <> d.id;
+
+ALTER TABLE transport.routes DROP CONSTRAINT IF EXISTS routes_city_id_fkey;
+
+-- negative ids first, so new ids never collide with old ones on the primary key
+UPDATE transport.cities c SET id = -m.new_id FROM city_ids m WHERE c.id = m.old_id;
+UPDATE transport.cities SET id = -id WHERE id < 0;
+UPDATE transport.routes r SET city_id = m.new_id FROM city_ids m WHERE r.city_id = m.old_id;
+UPDATE transport.routes_history r SET city_id = m.new_id FROM city_ids m WHERE r.city_id = m.old_id;
+UPDATE transport.cities_history c SET id = m.new_id FROM city_ids m WHERE c.id = m.old_id;
+
+ALTER TABLE transport.routes
+    ADD CONSTRAINT routes_city_id_fkey FOREIGN KEY (city_id) REFERENCES transport.cities(id);
+
+COMMIT;
+"""
+
+# removes a day loaded by benchmark.bench_pipeline: partition (dropping it detaches it), leftovers of a swap
+# and its telemetry_days row
+TELEMETRY_DAY_DROP_DDL = """
+DROP TABLE IF EXISTS transport.telemetry_{0};
+DROP TABLE IF EXISTS transport.telemetry_{0}_staging;
+DROP TABLE IF EXISTS transport.telemetry_{0}_old;
+DELETE FROM transport.telemetry_days WHERE date = '{1}';
+"""
+
+DICTIONARY_MIGRATION = CITY_IDS_MIGRATION_DDL
+
+DICTIONARY_QUERY = """
+SELECT value, id
+FROM transport.dictionary
+WHERE kind = '{0}'
+"""
+
+DICTIONARY_STAGING_DDL = """
+CREATE TEMPORARY TABLE dictionary_staging (
+    value     varchar(255) NOT NULL
+) ON COMMIT DROP;
+"""
+
+# the lock serializes concurrent writers so ids stay dense and unique per kind
+DICTIONARY_INSERT = """
+LOCK TABLE transport.dictionary IN SHARE ROW EXCLUSIVE MODE;
+
+INSERT INTO transport.dictionary (kind, value, id)
+SELECT '{0}'
+     , s.value
+     , (SELECT coalesce(max(id), 0) FROM transport.dictionary WHERE kind = '{0}') + row_number() OVER (ORDER BY s.value)
+FROM (SELECT DISTINCT value FROM dictionary_staging) s
+WHERE NOT EXISTS (SELECT 1 FROM transport.dictionary d WHERE d.kind = '{0}' AND d.value = s.value);
+"""
+
+DICTIONARY_STAGED_QUERY = """
+SELECT d.value, d.id
+FROM transport.dictionary d
+    INNER JOIN dictionary_staging s
+        ON s.value = d.value
+WHERE d.kind = '{0}'
+"""
+
+ARCHIVE_DAYS_QUERY = """
+select date
+from transport.telemetry_days
+where date < '{0}' and archived_at is null
+order by date
+"""
+
+ARCHIVED_DAYS_QUERY = """
+select date
+from transport.telemetry_days
+where archived_at is not null and date >= '{0}' and date <= '{1}'
+"""
+
+# content fingerprint of a day partition, compared with the written Parquet files before the partition is dropped
+# text columns are compared by null count and total length, so lost leading zeros or "123.0" do not pass
+ARCHIVE_FINGERPRINT_QUERY = """
+select count(*) as rows
+     , coalesce(sum(t.bus_id), 0) as bus_id
+     , coalesce(sum(t.speed), 0) as speed
+     , coalesce(sum(t.heading), 0) as heading
+     , coalesce(sum(t.direction), 0) as direction
+     , coalesce(sum(t.probeg), 0) as probeg
+     , count(coalesce(t.uniqueid, v.value)) as uniqueid_count
+     , coalesce(sum(length(coalesce(t.uniqueid, v.value))), 0) as uniqueid_length
+     , count(coalesce(t.gosnum, g.value)) as gosnum_count
+     , coalesce(sum(length(coalesce(t.gosnum, g.value))), 0) as gosnum_length
+     , count(t.bortnum) as bortnum_count
+     , coalesce(sum(length(t.bortnum)), 0) as bortnum_length
+from transport.telemetry_{0} t
+    left join transport.dictionary v
+        on v.kind = 'vehicle' and v.id = t.vehicle_id
+    left join transport.dictionary g
+        on g.kind = 'gosnum' and g.id = t.gosnum_id
+"""
+
+# sorted so Parquet row group statistics on bus_id, uniqueid and timestamp allow skipping
+ARCHIVE_EXPORT_QUERY = """
+COPY (
+    SELECT coalesce(c.name, 'unknown') AS city
+         , coalesce(t.uniqueid, v.value) AS uniqueid
+         , t."timestamp"
+         , t.bus_id
+         , t.heading
+         , t.speed
+         , t.lon
+         , t.lat
+         , t.direction
+         , coalesce(t.gosnum, g.value) AS gosnum
+         , t.bortnum
+         , t.probeg
+         , t.upload_date
+    FROM transport.telemetry_{0} t
+        LEFT JOIN transport.routes r
+            ON r.id = t.bus_id
+        LEFT JOIN transport.cities c
+            ON c.id = r.city_id
+        LEFT JOIN transport.dictionary v
+            ON v.kind = 'vehicle' AND v.id = t.vehicle_id
+        LEFT JOIN transport.dictionary g
+            ON g.kind = 'gosnum' AND g.id = t.gosnum_id
+    ORDER BY 1, t.bus_id, 2, t."timestamp"
+) TO STDOUT WITH (FORMAT csv, HEADER)
+"""
+
+ARCHIVE_DROP_DDL = """
+ALTER TABLE transport.telemetry DETACH PARTITION transport.telemetry_{0};
+DROP TABLE transport.telemetry_{0};
+UPDATE transport.telemetry_days SET archived_at = now() WHERE date = '{1}';
+"""
+
+HOT_TELEMETRY_QUERY = """
+select coalesce(c.name, 'unknown') as city
+     , t.*
+from transport.telemetry_decoded t
+    left join transport.routes r
+        on r.id = t.bus_id
+    left join transport.cities c
+        on c.id = r.city_id
+where t."timestamp" >= %(start)s and t."timestamp" < %(end)s
+"""
+
+TRAVEL_TIMES_DDL = """
+CREATE TABLE IF NOT EXISTS transport.travel_times (
+    route_id      int NOT NULL
+  , id_from       bigint NOT NULL
+  , id_to         bigint NOT NULL
+  , hour          smallint NOT NULL
+  , weekday       smallint NOT NULL
+  , trips         bigint NOT NULL
+  , seconds       double precision NOT NULL
+  , mean          real
+  , p50           real
+  , p98           real
+  , histogram     bigint[] NOT NULL
+  , updated_at    timestamp NOT NULL DEFAULT now()
+  , CONSTRAINT travel_times_pk PRIMARY KEY (route_id, id_from, id_to, hour, weekday)
+);
+
+CREATE TABLE IF NOT EXISTS transport.travel_times_daily (
+    city          varchar(255) NOT NULL
+  , date          date NOT NULL
+  , route_id      int NOT NULL
+  , id_from       bigint NOT NULL
+  , id_to         bigint NOT NULL
+  , hour          smallint NOT NULL
+  , weekday       smallint NOT NULL
+  , trips         bigint NOT NULL
+  , seconds       double precision NOT NULL
+  , histogram     bigint[] NOT NULL
+  , CONSTRAINT travel_times_daily_pk PRIMARY KEY (city, date, route_id, id_from, id_to, hour, weekday)
+);
+"""
+
+TRAVEL_TIMES_STAGING_DDL = """
+DROP TABLE IF EXISTS transport.travel_times_staging;
+CREATE UNLOGGED TABLE transport.travel_times_staging (LIKE transport.travel_times INCLUDING DEFAULTS);
+DROP TABLE IF EXISTS transport.travel_times_daily_staging;
+CREATE UNLOGGED TABLE transport.travel_times_daily_staging (LIKE transport.travel_times_daily);
+"""
+
+TRAVEL_TIMES_QUERY = """
+select route_id, id_from, id_to, hour, weekday, trips, seconds, histogram
+from transport.travel_times
+where route_id in ({0})
+"""
+
+TRAVEL_TIMES_DAILY_QUERY = """
+select route_id, id_from, id_to, hour, weekday, trips, seconds, histogram
+from transport.travel_times_daily
+where city = '{0}' and date = '{1}'
+"""
+
+TRAVEL_TIMES_DELETE = """
+DELETE FROM transport.travel_times
+WHERE route_id = {0} AND id_from = {1} AND id_to = {2} AND hour = {3} AND weekday = {4};
+"""
+
+TRAVEL_TIMES_UPSERT = """
+INSERT INTO transport.travel_times (route_id, id_from, id_to, hour, weekday, trips, seconds, mean, p50, p98, histogram)
+SELECT route_id, id_from, id_to, hour, weekday, trips, seconds, mean, p50, p98, histogram
+FROM transport.travel_times_staging
+ON CONFLICT ON CONSTRAINT travel_times_pk DO UPDATE
+SET trips = excluded.trips
+  , seconds = excluded.seconds
+  , mean = excluded.mean
+  , p50 = excluded.p50
+  , p98 = excluded.p98
+  , histogram = excluded.histogram
+  , updated_at = now();
+"""
+
+TRAVEL_TIMES_DAILY_REPLACE = """
+DELETE FROM transport.travel_times_daily
+WHERE city = '{0}' AND date = '{1}';
+
+INSERT INTO transport.travel_times_daily
+SELECT *
+FROM transport.travel_times_daily_staging;
+"""
+
+SPEED_GRID_DDL = """
+CREATE TABLE IF NOT EXISTS transport.speed_grid (
+    city          varchar(255) NOT NULL
+  , epsg          int NOT NULL
+  , cell_size     smallint NOT NULL
+  , cell_x        int NOT NULL
+  , cell_y        int NOT NULL
+  , weekday       smallint NOT NULL
+  , bucket        smallint NOT NULL
+  , count         bigint NOT NULL
+  , speed_sum     double precision NOT NULL
+  , histogram     bigint[] NOT NULL
+  , CONSTRAINT speed_grid_pk PRIMARY KEY (city, epsg, cell_size, cell_x, cell_y, weekday, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS transport.speed_grid_daily (
+    city          varchar(255) NOT NULL
+  , date          date NOT NULL
+  , epsg          int NOT NULL
+  , cell_size     smallint NOT NULL
+  , cell_x        int NOT NULL
+  , cell_y        int NOT NULL
+  , bucket        smallint NOT NULL
+  , count         bigint NOT NULL
+  , speed_sum     double precision NOT NULL
+  , histogram     bigint[] NOT NULL
+  , bus_id        bigint NOT NULL DEFAULT 0
+  , CONSTRAINT speed_grid_daily_pk PRIMARY KEY (city, date, bus_id, epsg, cell_size, cell_x, cell_y, bucket)
+);
+
+-- contributions are kept per route, so a partial load replaces only its own routes;
+-- rows of tables created before that have bus_id 0 and are replaced by the next load of their day
+ALTER TABLE transport.speed_grid_daily ADD COLUMN IF NOT EXISTS bus_id bigint NOT NULL DEFAULT 0;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1
+                   FROM information_schema.key_column_usage
+                   WHERE table_schema = 'transport'
+                     AND constraint_name = 'speed_grid_daily_pk'
+                     AND column_name = 'bus_id') THEN
+        ALTER TABLE transport.speed_grid_daily DROP CONSTRAINT IF EXISTS speed_grid_daily_pk;
+        ALTER TABLE transport.speed_grid_daily
+            ADD CONSTRAINT speed_grid_daily_pk PRIMARY KEY (city, date, bus_id, epsg, cell_size, cell_x, cell_y, bucket);
+    END IF;
+END
+$$;
+"""
+
+SPEED_GRID_STAGING_DDL = """
+DROP TABLE IF EXISTS transport.speed_grid_daily_staging;
+CREATE UNLOGGED TABLE transport.speed_grid_daily_staging (LIKE transport.speed_grid_daily);
+"""
+
+ROUTE_CITIES_QUERY = """
+select r.id
+     , c.name
+from transport.routes r
+    inner join transport.cities c
+        on c.id = r.city_id
+"""
+
+# adds staged routes of the day and subtracts their previous contribution to (city, date),
+# routes not in staging (carried over by swap_partition) keep theirs; histograms are summed bin by bin
+SPEED_GRID_UPDATE = """
+WITH replaced AS (
+    SELECT *
+    FROM transport.speed_grid_daily
+    WHERE city = '{0}' AND date = '{1}'
+      AND (bus_id = 0 OR bus_id IN (SELECT bus_id FROM transport.speed_grid_daily_staging))
+), delta AS (
+    SELECT city, epsg, cell_size, cell_x, cell_y, (extract(isodow FROM date) - 1)::smallint AS weekday, bucket
+         , count, speed_sum, histogram
+    FROM transport.speed_grid_daily_staging
+    UNION ALL
+    SELECT city, epsg, cell_size, cell_x, cell_y, (extract(isodow FROM date) - 1)::smallint AS weekday, bucket
+         , -count, -speed_sum, ARRAY(SELECT -value FROM unnest(histogram) AS value)
+    FROM replaced
+), bins AS (
+    SELECT d.city, d.epsg, d.cell_size, d.cell_x, d.cell_y, d.weekday, d.bucket, h.bin, sum(h.value) AS value
+    FROM delta d
+        CROSS JOIN unnest(d.histogram) WITH ORDINALITY AS h(value, bin)
+    GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+), histograms AS (
+    SELECT city, epsg, cell_size, cell_x, cell_y, weekday, bucket, array_agg(value ORDER BY bin) AS histogram
+    FROM bins
+    GROUP BY 1, 2, 3, 4, 5, 6, 7
+), totals AS (
+    SELECT city, epsg, cell_size, cell_x, cell_y, weekday, bucket, sum(count) AS count, sum(speed_sum) AS speed_sum
+    FROM delta
+    GROUP BY 1, 2, 3, 4, 5, 6, 7
+)
+INSERT INTO transport.speed_grid AS g (city, epsg, cell_size, cell_x, cell_y, weekday, bucket, count, speed_sum,
+                                       histogram)
+SELECT t.city, t.epsg, t.cell_size, t.cell_x, t.cell_y, t.weekday, t.bucket, t.count, t.speed_sum, h.histogram
+FROM totals t
+    INNER JOIN histograms h
+        USING (city, epsg, cell_size, cell_x, cell_y, weekday, bucket)
+ON CONFLICT (city, epsg, cell_size, cell_x, cell_y, weekday, bucket) DO UPDATE
+SET count = g.count + excluded.count
+  , speed_sum = g.speed_sum + excluded.speed_sum
+  , histogram = ARRAY(SELECT a + b
+                      FROM unnest(g.histogram, excluded.histogram) WITH ORDINALITY AS h(a, b, i)
+                      ORDER BY i);
+
+DELETE FROM transport.speed_grid
+WHERE city = '{0}' AND count <= 0;
+
+DELETE FROM transport.speed_grid_daily
+WHERE city = '{0}' AND date = '{1}'
+  AND (bus_id = 0 OR bus_id IN (SELECT bus_id FROM transport.speed_grid_daily_staging));
+
+INSERT INTO transport.speed_grid_daily
+SELECT *
+FROM transport.speed_grid_daily_staging;
+"""
+
+ANALYTICS_MIGRATION = TRAVEL_TIMES_DDL + SPEED_GRID_DDL
+
 
 def run_migrations(query, config_):
     """
@@ -106,4 +714,8 @@ if __name__ == '__main__':
 
     else:
         logger.debug('Migration flag set to False, doing migration')
-        run_migrations(SCHEMA_DDL, config)
\ No newline at end of file
+        run_migrations(SCHEMA_DDL, config)
+        run_migrations(REFERENCE_MIGRATION, config)
+        run_migrations(TELEMETRY_MIGRATION, config)
+        run_migrations(ANALYTICS_MIGRATION, config)
+        run_migrations(DICTIONARY_MIGRATION, config)
\ No newline at end of file
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import shapely
+import geopandas as gpd
+import dev
+from client import get_overpass_client
+from utils import get_logger
+
+LAYERS = ('stops', 'roads')
+
+
+def content_hash(gdf):
+    """
+    Returns sha256 of layer attributes and geometry WKB, used as layer version
+    """
+
+    digest = hashlib.sha256()
+    digest.update(gdf.drop(columns='geometry').to_json(orient='values', default_handler=str).encode('utf-8'))
+
+    for wkb in shapely.to_wkb(gdf.geometry.values):
+        digest.update(wkb)
+
+    return digest.hexdigest()
+
+
+def cache_paths(config_, city, layer):
+    """
+    Returns (data, metadata) paths of cached layer
+    """
+
+    folder = config_.get('OSM_CACHE_FOLDER', 'osm_cache')
+    os.makedirs(folder, exist_ok=True)
+
+    return f'{folder}/{city}_{layer}.parquet', f'{folder}/{city}_{layer}.json'
+
+
+def build_layer(city, layer, config_, client_=None):
+    """
+    Builds processed layer from OSM_EXTRACT if set, else from Overpass
+    Overpass is queried through client_ or a client built from config_ (OVERPASS_URL, HTTP_* settings)
+    """
+
+    if layer not in LAYERS:
+        raise ValueError(f'Unknown layer {layer}, expected one of {LAYERS}')
+
+    extract = config_.get('OSM_EXTRACT')
+    client = None if extract else client_ or get_overpass_client(config_, get_logger('osm_cache'))
+
+    try:
+        if layer == 'stops':
+            raw = dev.stops_from_extract(dev.load_extract(extract)) if extract else \
+                dev.fetch_stops(city, client_=client)
+            gdf = gpd.GeoDataFrame(dev.get_tags(raw, config_.get('OSM_STOP_TAGS', ['name'])).drop(columns=['type']),
+                                   geometry='geometry')
+        else:
+            gdf = dev.roads_from_extract(dev.load_extract(extract)) if extract else \
+                dev.fetch_roads(city, client_=client)
+    finally:
+        if client is not None and client_ is None:
+            client.close()
+
+    return gdf.set_crs(4326, allow_override=True), 'extract' if extract else 'overpass'
+
+
+def write_meta(meta_path, meta):
+    """
+    Writes layer metadata next to the target and renames it, so concurrent readers never see a partial file
+    """
+
+    with open(f'{meta_path}.{os.getpid()}.tmp', 'w') as file_:
+        json.dump(meta, file_)
+
+    os.replace(f'{meta_path}.{os.getpid()}.tmp', meta_path)
+
+
+def last_used(data_path):
+    """
+    Returns last_used of cached layer from its metadata, file mtime if metadata is missing or unreadable
+    """
+
+    try:
+        with open(data_path[:-len('.parquet')] + '.json') as file_:
+            meta = json.load(file_)
+        return meta.get('last_used', meta['created_at'])
+    except (OSError, ValueError, KeyError):
+        return os.path.getmtime(data_path)
+
+
+def evict(config_, logger_):
+    """
+    Removes least recently used layers (by last_used in metadata) until cache fits OSM_CACHE_MAX_MB
+    """
+
+    folder = config_.get('OSM_CACHE_FOLDER', 'osm_cache')
+    limit = config_.get('OSM_CACHE_MAX_MB', 1024) * 2 ** 20
+
+    files = [f'{folder}/{file_}' for file_ in os.listdir(folder) if file_.endswith('.parquet')]
+    files.sort(key=last_used)
+
+    size = sum(os.path.getsize(file_) for file_ in files)
+
+    while size > limit and files:
+        file_ = files.pop(0)
+        size -= os.path.getsize(file_)
+        os.remove(file_)
+        if os.path.exists(file_[:-len('.parquet')] + '.json'):
+            os.remove(file_[:-len('.parquet')] + '.json')
+        logger_.debug(f'Evicted {file_}')
+
+
+def ensure_layer(city, layer, config_, refresh=False, client_=None):
+    """
+    Builds layer of city into the cache when missing, older than OSM_CACHE_TTL_DAYS or refresh=True
+    Returns the built layer, None if the cached one is still fresh
+    Metadata (source, content hash, build and last use time) is stored next to the layer, every hit updates
+    last_used; a rebuild with the same content hash keeps the cached file and only renews its metadata
+    """
+
+    logger_ = get_logger('osm_cache')
+
+    data_path, meta_path = cache_paths(config_, city, layer)
+    ttl = config_.get('OSM_CACHE_TTL_DAYS', 30) * 24 * 60 * 60
+    meta = None
+
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path) as file_:
+            meta = json.load(file_)
+
+        if not refresh and time.time() - meta['created_at'] < ttl:
+            meta['last_used'] = time.time()
+            write_meta(meta_path, meta)
+            logger_.debug(f'Cache hit for {city} {layer}, version {meta["hash"][:12]}')
+            return None
+
+    gdf, source = build_layer(city, layer, config_, client_)
+    version = content_hash(gdf)
+
+    if meta is not None and meta['hash'] == version:
+        logger_.debug(f'Rebuilt {city} {layer} from {source} is unchanged, version {version[:12]}')
+    else:
+        # written next to the target and renamed, concurrent readers see the old or the new file, never a partial one
+        gdf.to_parquet(f'{data_path}.{os.getpid()}.tmp', index=False)
+        os.replace(f'{data_path}.{os.getpid()}.tmp', data_path)
+        logger_.debug(f'Cached {city} {layer} from {source}: {len(gdf)} rows, version {version[:12]}')
+
+    write_meta(meta_path, {
+        'city': city,
+        'layer': layer,
+        'source': source,
+        'hash': version,
+        'rows': len(gdf),
+        'created_at': time.time(),
+        'created': datetime.datetime.now().isoformat(),
+        'last_used': time.time()
+    })
+
+    evict(config_, logger_)
+
+    return gdf
+
+
+def get_layer(city, layer, config_, refresh=False, client_=None):
+    """
+    Returns processed stops or roads layer of city from on-disk GeoParquet cache, see ensure_layer
+    """
+
+    gdf = ensure_layer(city, layer, config_, refresh, client_)
+
+    return gpd.read_parquet(cache_paths(config_, city, layer)[0]) if gdf is None else gdf
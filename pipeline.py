@@ -0,0 +1,208 @@
+import os
+import time
+import datetime
+import queue
+import threading
+import metrics
+import pandas as pd
+from client import get_client
+from dedup import Deduplicator
+from download import get_telemetry, telemetry_path
+from fetch import RateLimiter
+from staging import write_frame
+from upload import DayLoader
+from utils import get_logger, peak_rss_mb
+
+
+class DayTracker:
+    """
+    Counts outstanding units per day, a day is complete once every unit of it was fetched or failed
+    """
+
+    def __init__(self, units):
+        self.remaining = {}
+
+        for date, _, _ in units:
+            self.remaining[date] = self.remaining.get(date, 0) + 1
+
+    def done(self, date):
+        """
+        Counts one unit of date as done, returns True if it was the last one
+        """
+
+        self.remaining[date] -= 1
+
+        return self.remaining[date] == 0
+
+
+def run_pipeline(units, config_, engine_, manifest_=None, logger_=None):
+    """
+    Fetches (date, city_name, route_id) units and loads them while fetching continues
+    FETCH_WORKERS threads put fetched frames into a queue bounded by PIPELINE_QUEUE_SIZE, so fetching waits
+    when the database falls behind; the calling thread loads TELEMETRY_BATCH_SIZE-row batches as they arrive
+    Each day is published once, when its last unit is in (see DayLoader.finish)
+    With PIPELINE_SPILL (default), fetched frames are also written to TEMP_FOLDER and marked fetched in manifest_,
+    so after a crash the next load picks them up instead of fetching them again
+    Returns dict with units, failed, rows, elapsed, fetch and load seconds
+    """
+
+    logger_ = logger_ or get_logger('pipeline')
+
+    units = sorted(units)
+    workers = config_.get('FETCH_WORKERS', 1)
+    batch_size = config_.get('TELEMETRY_BATCH_SIZE', 500000)
+    spill = config_.get('PIPELINE_SPILL', True)
+
+    limiter = RateLimiter(config_.get('FETCH_RATE_LIMIT'))
+    client = get_client(config_, logger_=logger_)
+    tracker = DayTracker(units)
+    deduplicator = Deduplicator(config_, logger_) if config_.get('DEDUP', True) else None
+    loader = DayLoader(config_, engine_, logger_)
+
+    todo = queue.Queue()
+    fetched = queue.Queue(maxsize=config_.get('PIPELINE_QUEUE_SIZE', 64))
+    stop = threading.Event()
+    busy = {'fetch': 0.0, 'load': 0.0}
+    lock = threading.Lock()
+
+    for unit in units:
+        todo.put(unit)
+
+    def put(item):
+        # blocks while the queue is full, gives up if loading failed
+        with metrics.span('backpressure'):
+            while not stop.is_set():
+                try:
+                    fetched.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+    def produce():
+        while not stop.is_set():
+            try:
+                date, city_name, route_id = todo.get_nowait()
+            except queue.Empty:
+                return
+
+            start = time.monotonic()
+
+            try:
+                with metrics.span('rate_limit'):
+                    limiter.acquire()
+
+                with metrics.span('fetch', city=city_name, route=route_id):
+                    df = get_telemetry(date, city_name, route_id, config_, logger_, client_=client)
+
+                if spill:
+                    path = telemetry_path(date, city_name, route_id, config_)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                    with metrics.span('spill'):
+                        write_frame(df, path)
+
+                    if manifest_ is not None:
+                        manifest_.mark_fetched(city_name, route_id, date, len(df), path)
+            except Exception as e:
+                logger_.debug(f'Failed: Date = {date} // City = {city_name} // Route = {route_id} // {e!r}')
+                df = None
+
+                if manifest_ is not None:
+                    manifest_.mark_failed(city_name, route_id, date)
+
+            with lock:
+                busy['fetch'] += time.monotonic() - start
+
+            put(((date, city_name, route_id), df))
+
+    buffers = {}
+    counts = {}
+    loaded_units = {}
+    stats = {'units': 0, 'failed': 0, 'rows': 0}
+
+    def load(date):
+        batch = pd.concat(buffers.pop(date))
+        counts.pop(date)
+        start = time.monotonic()
+        loader.load(date, batch)
+        busy['load'] += time.monotonic() - start
+
+    def finish(date):
+        if date in buffers:
+            load(date)
+
+        start = time.monotonic()
+        loader.finish(date)
+
+        if manifest_ is not None:
+            if not spill:
+                for city_name, route_id, rows in loaded_units.get(date, []):
+                    manifest_.mark_fetched(city_name, route_id, date, rows, None, checksum=False)
+
+            manifest_.mark_loaded(date)
+
+            if date in loader.prepared:
+                manifest_.verify_day(date, engine_, loader.day_rows[date], loader.carried.get(date, 0))
+
+        loaded_units.pop(date, None)
+
+        if deduplicator is not None:
+            open_days = [day for day, remaining in tracker.remaining.items() if remaining > 0]
+            deduplicator.forget(min(open_days) if open_days else date + datetime.timedelta(days=1))
+
+        busy['load'] += time.monotonic() - start
+        logger_.debug(f'Published {date}: {loader.day_rows.get(date, 0)} rows // queue = {fetched.qsize()}')
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=produce, daemon=True) for _ in range(workers)]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        for _ in range(len(units)):
+            with metrics.span('queue_wait'):
+                (date, city_name, route_id), df = fetched.get()
+
+            stats['units'] += 1
+
+            if df is None:
+                stats['failed'] += 1
+            else:
+                stats['rows'] += len(df)
+                loaded_units.setdefault(date, []).append((city_name, route_id, len(df)))
+
+                if deduplicator is not None and len(df) != 0:
+                    df = deduplicator.process(df)
+
+                if len(df) != 0:
+                    buffers.setdefault(date, []).append(df)
+                    counts[date] = counts.get(date, 0) + len(df)
+
+                # same bound as batch_by_day: at most batch_size rows buffered across open days
+                while counts and sum(counts.values()) >= batch_size:
+                    load(max(counts, key=counts.get))
+
+            if tracker.done(date):
+                finish(date)
+    finally:
+        stop.set()
+
+        for thread in threads:
+            thread.join()
+
+        client.close()
+
+    if deduplicator is not None:
+        deduplicator.report()
+
+    stats['elapsed'] = time.monotonic() - started
+    stats['fetch'] = busy['fetch'] / max(workers, 1)
+    stats['load'] = busy['load']
+    elapsed = max(stats['elapsed'], 1e-9)
+
+    logger_.debug(f'Pipelined {stats["units"]} units ({stats["failed"]} failed) in {stats["elapsed"]:.1f}s // '
+                  f'fetch = {stats["fetch"]:.1f}s per worker // load = {stats["load"]:.1f}s // '
+                  f'{stats["rows"] / elapsed:.1f} rows/s // peak RSS = {peak_rss_mb():.0f} MB')
+
+    return stats
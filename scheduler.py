@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import datetime
+import yaml
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils import get_logger
+from staging import is_staged, read_frame, write_frame
+
+# per-process caches of spatial indexes and road graphs, built once per city in each worker
+_indexes = {}
+_graphs = {}
+
+
+def unit_files(city, date, config_):
+    """
+    Returns staged telemetry files of city for date
+    """
+
+    folder = '/'.join([config_['TEMP_FOLDER'], f'telemetry_{date.strftime("%Y_%m_%d")}'])
+
+    if not os.path.isdir(folder):
+        return []
+
+    # {city}_{route_id}_{YYYY}_{MM}_{DD}.<extension>
+    return sorted('/'.join([folder, file_]) for file_ in os.listdir(folder)
+                  if is_staged(file_) and os.path.splitext(file_)[0].rsplit('_', 4)[0] == city)
+
+
+def get_index(city, config_):
+    """
+    Returns spatial.NetworkIndex of city from worker cache, building it from osm_cache layers on first use
+    """
+
+    if city not in _indexes:
+        from osm_cache import get_layer
+        from spatial import NetworkIndex
+
+        _indexes[city] = NetworkIndex(get_layer(city, 'stops', config_), get_layer(city, 'roads', config_))
+
+    return _indexes[city]
+
+
+def get_graph(city, config_):
+    """
+    Returns mapmatch.RoadGraph of city from worker cache, building it from the osm_cache roads layer on first use
+    """
+
+    if city not in _graphs:
+        from osm_cache import get_layer
+        from mapmatch import RoadGraph
+
+        _graphs[city] = RoadGraph(get_layer(city, 'roads', config_))
+
+    return _graphs[city]
+
+
+def tracks_path(city, date, config_):
+    """
+    Returns path of tracks file of (city, date)
+    """
+
+    return f'{config_.get("TRACKS_FOLDER", "tracks")}/{city}_{date.strftime("%Y_%m_%d")}.parquet'
+
+
+def edges_path(city, date, config_):
+    """
+    Returns path of edge traversals file of (city, date)
+    """
+
+    return f'{config_.get("TRACKS_FOLDER", "tracks")}/{city}_{date.strftime("%Y_%m_%d")}_edges.parquet'
+
+
+def process_unit(unit, config_):
+    """
+    CPU-bound stages for one (city, date): parse staged files, classify points, aggregate tracks
+    and, with MAP_MATCHING, map-match points to road edges
+    Writes tracks (and edge traversals) to TRACKS_FOLDER and returns row counts with per-stage timings
+    """
+
+    from spatial import classify_points
+    from tracks import build_tracks
+
+    city, date = unit
+    timings = {}
+
+    start = time.perf_counter()
+    frames = [read_frame(path) for path in unit_files(city, date, config_)]
+    frames = [frame for frame in frames if len(frame) != 0]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    timings['parse'] = time.perf_counter() - start
+
+    result = {'city': city, 'date': date, 'pid': os.getpid(), 'rows': len(df), 'tracks': 0, 'edges': 0}
+
+    if len(df) != 0:
+        start = time.perf_counter()
+        marked = classify_points(df, get_index(city, config_), config_.get('STOP_BUFFER', 50),
+                                 config_.get('STOP_SPEED', 15))
+        timings['classify'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tracks_df = build_tracks(marked)
+        timings['aggregate'] = time.perf_counter() - start
+
+        path = tracks_path(city, date, config_)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_frame(tracks_df, path)
+
+        result['tracks'] = len(tracks_df)
+
+        if config_.get('MAP_MATCHING'):
+            from mapmatch import match_telemetry
+
+            start = time.perf_counter()
+            edges_df = match_telemetry(df, get_graph(city, config_), radius=config_.get('MATCH_RADIUS', 50))
+            write_frame(edges_df, edges_path(city, date, config_))
+            timings['match'] = time.perf_counter() - start
+
+            result['edges'] = len(edges_df)
+
+    result['timings'] = timings
+
+    return result
+
+
+def warm_layers(cities, config_, logger_):
+    """
+    Builds missing or expired osm_cache layers of cities once in the calling process,
+    so workers only read them instead of all querying Overpass and writing the same files
+    """
+
+    from osm_cache import ensure_layer, LAYERS
+
+    for city in sorted(cities):
+        for layer in LAYERS:
+            try:
+                ensure_layer(city, layer, config_)
+            except Exception as e:
+                logger_.warning(f'Layer {layer} of {city} failed: {e!r}')
+
+
+def run_units(units, config_, logger_=None, engine_=None):
+    """
+    Shards (city, date) units across PROCESS_WORKERS processes
+    Results are returned in units order regardless of completion order, so output is deterministic
+    A failing unit is logged and skipped, the others are kept
+    If engine_ is passed and TRAVEL_TIMES is set, stop-to-stop travel times are updated from each unit's tracks
+    Returns (results, failed units)
+    """
+
+    logger_ = logger_ or get_logger('scheduler')
+
+    units = sorted(units)
+    workers = config_.get('PROCESS_WORKERS') or os.cpu_count()
+
+    warm_layers({city for city, _ in units}, config_, logger_)
+
+    start = time.perf_counter()
+    completed = {}
+    failed = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_unit, unit, config_): unit for unit in units}
+
+        for future in as_completed(futures):
+            unit = futures[future]
+            try:
+                completed[unit] = future.result()
+            except Exception as e:
+                failed.append(unit)
+                logger_.warning(f'Unit failed: City = {unit[0]} // Date = {unit[1]} // {e!r}')
+
+    results = [completed[unit] for unit in units if unit in completed]
+    failed.sort()
+
+    elapsed = time.perf_counter() - start
+
+    workers_time = {}
+
+    for result in results:
+        logger_.debug(f'City = {result["city"]} // Date = {result["date"]} // Rows = {result["rows"]} // '
+                      f'Tracks = {result["tracks"]} // Edges = {result["edges"]} // ' +
+                      ' // '.join(f'{stage} = {seconds:.2f}s' for stage, seconds in result['timings'].items()))
+        worker = workers_time.setdefault(result['pid'], {'units': 0, 'seconds': 0})
+        worker['units'] += 1
+        worker['seconds'] += sum(result['timings'].values())
+
+    for pid, worker in sorted(workers_time.items()):
+        logger_.debug(f'Worker {pid}: {worker["units"]} units in {worker["seconds"]:.1f}s')
+
+    if engine_ is not None and config_.get('TRAVEL_TIMES'):
+        from travel_times import update_travel_times
+
+        for result in results:
+            if result['tracks'] != 0:
+                update_travel_times(read_frame(tracks_path(result['city'], result['date'], config_)),
+                                    result['city'], result['date'], engine_)
+
+    rows = sum(result['rows'] for result in results)
+    logger_.debug(f'Processed {len(results)} of {len(units)} units ({len(failed)} failed), {rows} rows '
+                  f'in {elapsed:.1f}s with {workers} workers // {rows / max(elapsed, 1e-9):.0f} rows/s')
+
+    return results, failed
+
+
+def date_range(start, end):
+    """
+    Returns list of dates from start to end inclusive
+    """
+
+    return [start + datetime.timedelta(days=days) for days in range((end - start).days + 1)]
+
+
+if __name__ == '__main__':
+    with open('config.yaml') as file:
+        config = yaml.Loader(file).get_data()
+
+    first = datetime.date.fromisoformat(sys.argv[1])
+    last = datetime.date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else first
+
+    run_units([(city, date) for city in config['CITIES'] for date in date_range(first, last)], config)
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+from utils import get_logger
+
+
+def utm_epsg(lon):
+    """
+    Returns EPSG code of northern UTM zone for longitude (or mean of longitudes)
+    """
+
+    return 32600 + int(np.mean(lon) + 186) // 6
+
+
+def project(lon, lat, epsg):
+    """
+    Projects WGS84 lon/lat arrays to epsg, returns (x, y) numpy arrays in meters
+    """
+
+    transformer = Transformer.from_crs(4326, epsg, always_xy=True)
+
+    return transformer.transform(np.asarray(lon, dtype='float64'), np.asarray(lat, dtype='float64'))
+
+
+class NetworkIndex:
+    """
+    Prebuilt STRtrees over projected stops and road segments of one city
+    stops_df is dev.get_stops output (id, lon, lat, utm, ...), roads_gdf is dev.fetch_roads output
+    """
+
+    def __init__(self, stops_df, roads_gdf=None, epsg=None):
+        if epsg is None:
+            epsg = int(stops_df['utm'].iloc[0]) if 'utm' in stops_df.columns else utm_epsg(stops_df['lon'])
+
+        self.epsg = epsg
+        self.logger = get_logger('spatial')
+
+        x, y = project(stops_df['lon'], stops_df['lat'], self.epsg)
+        self.stop_ids = stops_df['id'].to_numpy()
+        self.stop_names = stops_df['name'].to_numpy() if 'name' in stops_df.columns else None
+        self.stops_tree = shapely.STRtree(shapely.points(x, y))
+
+        self.roads_tree = None
+
+        if roads_gdf is not None and len(roads_gdf) != 0:
+            transformer = Transformer.from_crs(4326, self.epsg, always_xy=True)
+            roads = shapely.transform(np.asarray(roads_gdf.geometry),
+                                      lambda coords: np.column_stack(transformer.transform(coords[:, 0],
+                                                                                           coords[:, 1])))
+            self.roads_tree = shapely.STRtree(roads)
+
+        self.logger.debug(f'Built index over {len(self.stop_ids)} stops and '
+                          f'{0 if roads_gdf is None else len(roads_gdf)} roads in EPSG:{self.epsg}')
+
+    def near_stops(self, points, buffer):
+        """
+        Returns (stop index or -1, distance or nan) of nearest stop within buffer for each point
+        """
+
+        nearest = np.full(len(points), -1)
+        distance = np.full(len(points), np.nan)
+
+        (point_index, stop_index), dist = self.stops_tree.query_nearest(points, max_distance=buffer,
+                                                                         return_distance=True, all_matches=False)
+        nearest[point_index] = stop_index
+        distance[point_index] = dist
+
+        return nearest, distance
+
+    def near_roads(self, points, buffer):
+        """
+        Returns boolean mask of points within buffer of any road
+        """
+
+        mask = np.zeros(len(points), dtype=bool)
+
+        if self.roads_tree is not None:
+            point_index, _ = self.roads_tree.query(points, predicate='dwithin', distance=buffer)
+            mask[point_index] = True
+
+        return mask
+
+
+def classify_points(telemetry_df, index, buffer=50, speed=15, clip=True):
+    """
+    Adds x, y, stop_id, stop_name, dist and is_stop columns to telemetry
+    is_stop: point is within buffer meters of a stop at speed <= speed
+    if clip, points further than buffer from any stop or road are dropped
+    """
+
+    df = telemetry_df.copy()
+
+    x, y = project(df['lon'], df['lat'], index.epsg)
+    points = shapely.points(x, y)
+
+    nearest, distance = index.near_stops(points, buffer)
+    has_stop = nearest != -1
+
+    df['x'] = x
+    df['y'] = y
+    df['stop_id'] = pd.array(np.where(has_stop, index.stop_ids[nearest], 0), dtype=pd.Int64Dtype())
+    df.loc[~has_stop, 'stop_id'] = pd.NA
+    if index.stop_names is not None:
+        df['stop_name'] = np.where(has_stop, index.stop_names[nearest], None)
+    df['dist'] = distance
+    df['is_stop'] = has_stop & (df['speed'].to_numpy() <= speed)
+
+    if clip:
+        df = df[has_stop | index.near_roads(points, buffer)]
+
+    return df.reset_index(drop=True)
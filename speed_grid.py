@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import migration as mig
+from spatial import utm_epsg, project
+from travel_times import to_pg_array
+from upload import copy_dataframe
+from utils import get_logger
+
+# per route, so reloading some routes of a day replaces only their contribution
+KEYS = ['bus_id', 'cell_x', 'cell_y', 'bucket']
+
+# 5 km/h bins, last bin collects everything from 120 km/h
+SPEED_EDGES = np.arange(0, 125, 5)
+BINS = len(SPEED_EDGES)
+
+BUCKET_MINUTES = 15
+
+
+def grid_aggregates(df, epsg, cell_size=250):
+    """
+    Bins points into cell_size-meter cells of epsg and 15-minute buckets of the day
+    Returns mergeable aggregates per KEYS (route, cell, bucket): count, speed sum and speed histogram
+    """
+
+    df = df[df['speed'].notna()]
+
+    x, y = project(df['lon'], df['lat'], epsg)
+    timestamp = df['timestamp'].dt
+
+    keys = pd.DataFrame({
+        'bus_id': df['bus_id'].to_numpy(dtype='int64'),
+        'cell_x': np.floor(x / cell_size).astype('int64'),
+        'cell_y': np.floor(y / cell_size).astype('int64'),
+        'bucket': ((timestamp.hour * 60 + timestamp.minute) // BUCKET_MINUTES).to_numpy(dtype='int64'),
+    })
+
+    speed = df['speed'].to_numpy(dtype='float64')
+    bins = np.clip(np.searchsorted(SPEED_EDGES, speed, side='right') - 1, 0, BINS - 1)
+
+    return combine(keys, np.ones(len(keys), dtype='int64'), speed, bins)
+
+
+def combine(keys, count, speed_sum, bins=None, histograms=None):
+    """
+    Sums count, speed_sum and histograms (or one-hot bins) by KEYS
+    """
+
+    group, unique = pd.MultiIndex.from_frame(keys[KEYS]).factorize()
+
+    summed = np.zeros((len(unique), BINS), dtype='int64')
+
+    if histograms is not None:
+        np.add.at(summed, group, histograms)
+    else:
+        np.add.at(summed, (group, bins), 1)
+
+    aggregated = unique.to_frame(index=False, name=KEYS)
+    aggregated['count'] = np.bincount(group, weights=count, minlength=len(aggregated)).astype('int64')
+    aggregated['speed_sum'] = np.bincount(group, weights=speed_sum, minlength=len(aggregated))
+    aggregated['histogram'] = list(summed)
+
+    return aggregated
+
+
+def merge(frames):
+    """
+    Merges aggregates of several batches of the same city-day
+    """
+
+    df = pd.concat(frames, ignore_index=True)
+
+    return combine(df, df['count'].to_numpy(), df['speed_sum'].to_numpy(),
+                   histograms=np.stack(list(df['histogram'])))
+
+
+def update_speed_grid(aggregates, city, date, epsg, cell_size, engine_, logger_=None):
+    """
+    Replaces contributions of the routes in aggregates to (city, date) in transport.speed_grid_daily and applies
+    the difference to transport.speed_grid, so re-loading a day or some of its routes is idempotent and history
+    is never re-read
+    """
+
+    logger_ = logger_ or get_logger('speed_grid')
+
+    daily = aggregates[['bus_id', 'cell_x', 'cell_y', 'bucket', 'count', 'speed_sum']].copy()
+    daily['histogram'] = to_pg_array(aggregates['histogram'])
+    daily.insert(0, 'cell_size', cell_size)
+    daily.insert(0, 'epsg', epsg)
+    daily.insert(0, 'date', date)
+    daily.insert(0, 'city', city)
+
+    engine_.execute(mig.SPEED_GRID_STAGING_DDL)
+    copy_dataframe(daily[['city', 'date', 'epsg', 'cell_size', 'cell_x', 'cell_y', 'bucket', 'count', 'speed_sum',
+                          'histogram', 'bus_id']], 'speed_grid_daily_staging', engine_)
+
+    with engine_.begin() as connection:
+        connection.execute(mig.SPEED_GRID_UPDATE.format(city, date))
+
+    logger_.debug(f'Updated speed grid of {city} {date}: {daily["bus_id"].nunique()} routes // '
+                  f'{len(daily)} route cell buckets')
+
+    return len(daily)
+
+
+class SpeedGrid:
+    """
+    Ingest stage accumulating grid aggregates of loaded batches per (city, date)
+    City of a point comes from its route, the UTM zone is fixed per city on first sight
+    """
+
+    def __init__(self, engine_, cell_size=250, logger_=None):
+        self.engine = engine_
+        self.cell_size = cell_size
+        self.logger = logger_ or get_logger('speed_grid')
+        self.cities = dict(engine_.execute(mig.ROUTE_CITIES_QUERY).fetchall())
+        self.epsg = {}
+        self.parts = {}
+
+    def add(self, df):
+        """
+        Aggregates one batch of telemetry
+        """
+
+        city = df['bus_id'].map(self.cities)
+        dates = df['timestamp'].dt.date
+
+        for (city_name, date), part in df.groupby([city, dates], sort=False):
+            epsg = self.epsg.setdefault(city_name, utm_epsg(part['lon']))
+            self.parts.setdefault((city_name, date), []).append(grid_aggregates(part, epsg, self.cell_size))
+
+    def flush(self, date):
+        """
+        Writes aggregates of date for every city seen and frees them
+        """
+
+        for city_name, day in sorted(key for key in self.parts if key[1] == date):
+            update_speed_grid(merge(self.parts.pop((city_name, day))), city_name, day, self.epsg[city_name],
+                              self.cell_size, self.engine, self.logger)
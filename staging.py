@@ -0,0 +1,123 @@
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXTENSIONS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'arrow': '.arrow'
+}
+
+TELEMETRY_DTYPES = {
+    'uniqueid': 'string',
+    'bus_id': 'int64',
+    'heading': 'Int16',
+    'speed': 'Int16',
+    'lon': 'float64',
+    'lat': 'float64',
+    'direction': 'Int16',
+    'gosnum': 'string',
+    'bortnum': 'string',
+    'probeg': 'Int64'
+}
+
+# column order of transport.telemetry
+TELEMETRY_COLUMNS = ['uniqueid', 'timestamp', 'bus_id', 'heading', 'speed', 'lon', 'lat', 'direction', 'gosnum',
+                     'bortnum', 'probeg', 'upload_date']
+
+
+def get_extension(config_):
+    """
+    Returns file extension of STAGING_FORMAT (csv by default)
+    """
+
+    format_ = config_.get('STAGING_FORMAT', 'csv')
+
+    if format_ not in EXTENSIONS:
+        raise ValueError(f'Unknown STAGING_FORMAT {format_}, expected one of {list(EXTENSIONS)}')
+
+    if format_ != 'csv' and pa is None:
+        raise ImportError(f'STAGING_FORMAT {format_} requires pyarrow')
+
+    return EXTENSIONS[format_]
+
+
+def is_staged(file_):
+    """
+    Checks if file name has one of staging extensions
+    """
+
+    return os.path.splitext(file_)[1] in EXTENSIONS.values()
+
+
+def set_dtypes(df):
+    """
+    Casts telemetry columns to explicit dtypes
+    """
+
+    return df.astype({column: dtype for column, dtype in TELEMETRY_DTYPES.items() if column in df.columns})
+
+
+def empty_frame():
+    """
+    Returns empty telemetry DataFrame with all columns typed, so empty route-days keep the staging schema
+    """
+
+    return pd.DataFrame({column: pd.Series(dtype=TELEMETRY_DTYPES.get(column, 'datetime64[ns]'))
+                         for column in TELEMETRY_COLUMNS})
+
+
+def write_frame(df, path):
+    """
+    Writes DataFrame to path, format is chosen by extension
+    """
+
+    extension = os.path.splitext(path)[1]
+
+    if extension == '.csv':
+        df.to_csv(path, encoding='utf-8', index=False)
+    elif extension == '.parquet':
+        df.to_parquet(path, index=False)
+    elif extension == '.arrow':
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        raise ValueError(f'Unknown staging extension {extension}')
+
+
+def read_frame(path, columns=None):
+    """
+    Reads DataFrame from path, format is chosen by extension
+    Parquet and Arrow files are memory-mapped and only columns are read
+    CSV timestamps are parsed, columnar formats keep native types
+    Column-less files (empty route-days staged before empty_frame) read as an empty DataFrame
+    """
+
+    extension = os.path.splitext(path)[1]
+
+    if extension == '.csv':
+        df = pd.read_csv(path, usecols=columns)
+        for column in ('timestamp', 'upload_date'):
+            if column in df.columns:
+                df[column] = pd.to_datetime(df[column])
+        return df
+    elif extension == '.parquet':
+        if not pq.read_schema(path, memory_map=True).names:
+            return pd.DataFrame()
+        return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+    elif extension == '.arrow':
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        if columns is not None and table.num_columns != 0:
+            table = table.select(columns)
+        return table.to_pandas()
+    else:
+        raise ValueError(f'Unknown staging extension {extension}')
@@ -0,0 +1,141 @@
+import sys
+import json
+import zlib
+import threading
+import numpy as np
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROUTE_TYPES = ['Автобус', 'Троллейбус', 'Трамвай']
+
+
+class SyntheticCity:
+    """
+    Deterministic synthetic bustime.ru data: cities, routes and per route-day telemetry
+    """
+
+    def __init__(self, cities=3, routes=20, vehicles=5, points=500, seed=0):
+        self.cities = [f'city{index}' for index in range(cities)]
+        self.routes = {city: list(range(index * 1000 + 1, index * 1000 + routes + 1))
+                       for index, city in enumerate(self.cities)}
+        self.vehicles = vehicles
+        self.points = points
+        self.seed = seed
+
+    def route_name(self, route_id):
+        return f'{ROUTE_TYPES[route_id % len(ROUTE_TYPES)]} {route_id % 1000}'
+
+    def telemetry(self, city, route_id, day):
+        """
+        Returns list of dicts shaped like /ajax/transport/ response
+        """
+
+        rng = np.random.default_rng(zlib.crc32(f'{self.seed}/{city}/{route_id}/{day}'.encode('utf-8')))
+
+        vehicle = rng.integers(0, self.vehicles, self.points)
+        seconds = np.sort(rng.integers(5 * 60 * 60, 24 * 60 * 60, self.points))
+        lon = 49.1 + rng.normal(0, 0.05, self.points)
+        lat = 55.8 + rng.normal(0, 0.03, self.points)
+        speed = rng.integers(0, 60, self.points)
+        heading = rng.integers(0, 360, self.points)
+
+        return [{
+            'uniqueid': f'{route_id:05d}{vehicle[index]:03d}',
+            'timestamp': f'{seconds[index] // 3600:02d}:{seconds[index] // 60 % 60:02d}:{seconds[index] % 60:02d}',
+            'bus_id': route_id,
+            'heading': int(heading[index]),
+            'speed': int(speed[index]),
+            'lon': float(lon[index]),
+            'lat': float(lat[index]),
+            'direction': int(vehicle[index] % 2),
+            'gosnum': f'{vehicle[index]:04d}',
+            'bortnum': f'{route_id}{vehicle[index]}',
+            'probeg': int(seconds[index] * 10)
+        } for index in range(self.points)]
+
+    def cities_html(self):
+        items = ''.join(f'<a class="item" href="/{city}/">{city}</a>' for city in self.cities)
+        return f'<html><body><div aria-label=" Список городов ">{items}</div></body></html>'
+
+    def routes_html(self, city):
+        options = ''.join(f'<option value="{route_id}">{self.route_name(route_id)}</option>'
+                          for route_id in self.routes.get(city, []))
+        return f'<html><body><select name="bus_id"><option value="0">Все</option>{options}</select></body></html>'
+
+
+def make_handler(data):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def reply(self, body, content_type):
+            body = body.encode('utf-8')
+            etag = f'"{zlib.crc32(body):08x}"'
+
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = [part for part in self.path.split('?')[0].split('/') if part]
+
+            if len(parts) == 0:
+                self.reply(data.cities_html(), 'text/html; charset=utf-8')
+            elif len(parts) >= 2 and parts[1] == 'transport':
+                self.reply(data.routes_html(parts[0]), 'text/html; charset=utf-8')
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/ajax/transport':
+                self.send_error(404)
+                return
+
+            length = int(self.headers.get('Content-Length', 0))
+            form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+
+            self.reply(json.dumps(data.telemetry(form['city_slug'], int(form['bus_id']), form['day'])),
+                       'application/json')
+
+        def log_message(self, format_, *args):
+            pass
+
+    return Handler
+
+
+class StubServer:
+    """
+    Local HTTP server emulating bustime.ru pages and /ajax/transport/, usable as context manager
+    """
+
+    def __init__(self, data=None, port=0):
+        self.data = data or SyntheticCity()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(self.data))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    with StubServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000) as stub:
+        print(f'Serving synthetic bustime at {stub.url}')
+        stub.thread.join()
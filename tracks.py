@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+TRACK_COLUMNS = [
+    'uniqueid',
+    'bus_id',
+    'speed_mean',
+    'speed_median',
+    'timestamp_min',
+    'timestamp_max',
+    'id_from',
+    'id_to',
+    'name_to',
+    'dist',
+    'time_travelled'
+]
+
+
+def get_tracks(df_raw):
+    """
+    Sorts classified telemetry (spatial.classify_points output) by uniqueid, timestamp and adds track column
+    A track is a run of points ending with a visit to one stop: a new track starts after the vehicle
+    leaves a stop or when the vehicle changes
+    """
+
+    vehicle = pd.factorize(df_raw['uniqueid'], sort=True)[0]
+    order = np.lexsort((df_raw['timestamp'].to_numpy(), vehicle))
+
+    df = df_raw.iloc[order].reset_index(drop=True)
+    vehicle = vehicle[order]
+
+    stop = df['stop_id'].to_numpy(dtype='float64', na_value=np.nan)
+
+    new = np.ones(len(df), dtype=bool)
+    new[1:] = ((stop[1:] != stop[:-1]) & ~np.isnan(stop[:-1])) | (vehicle[1:] != vehicle[:-1])
+
+    df['track'] = np.cumsum(new)
+
+    return df
+
+
+def aggregate_tracks(tracks_df):
+    """
+    Aggregates get_tracks output into one row per track with NumPy reductions over sorted track runs:
+    speed mean/median, timestamp min/max, from/to stop ids, closest distance to stop, time travelled
+    """
+
+    if len(tracks_df) == 0:
+        return pd.DataFrame([], columns=TRACK_COLUMNS)
+
+    track = tracks_df['track'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, track[1:] != track[:-1]])
+    sizes = np.diff(np.r_[starts, len(track)])
+
+    speed = tracks_df['speed'].to_numpy(dtype='float64', na_value=np.nan)
+    timestamp = tracks_df['timestamp'].to_numpy(dtype='datetime64[ns]').view('int64')
+    stop = tracks_df['stop_id'].to_numpy(dtype='float64', na_value=np.nan)
+    dist = tracks_df['dist'].to_numpy(dtype='float64', na_value=np.nan)
+
+    # median: sort speeds within each track, then pick middle element(s) by offset
+    sorted_speed = speed[np.lexsort((speed, track))]
+    median = (sorted_speed[starts + (sizes - 1) // 2] + sorted_speed[starts + sizes // 2]) / 2
+
+    # last point of each track that is near a stop gives id_to and name_to
+    position = np.where(np.isnan(stop), -1, np.arange(len(stop)))
+    last_stop = np.maximum.reduceat(position, starts)
+    has_stop = last_stop != -1
+
+    aggregated = pd.DataFrame({
+        'uniqueid': tracks_df['uniqueid'].to_numpy()[starts],
+        'bus_id': tracks_df['bus_id'].to_numpy()[starts],
+        'speed_mean': np.add.reduceat(np.nan_to_num(speed), starts) / np.add.reduceat(~np.isnan(speed), starts),
+        'speed_median': median,
+        'timestamp_min': pd.to_datetime(np.minimum.reduceat(timestamp, starts)),
+        'timestamp_max': pd.to_datetime(np.maximum.reduceat(timestamp, starts)),
+        'id_to': pd.array(np.where(has_stop, stop[last_stop], np.nan), dtype='Float64').astype(pd.Int64Dtype()),
+        'dist': np.fmin.reduceat(dist, starts),
+    })
+
+    if 'stop_name' in tracks_df.columns:
+        aggregated['name_to'] = np.where(has_stop, tracks_df['stop_name'].to_numpy()[last_stop], None)
+    else:
+        aggregated['name_to'] = None
+
+    same_vehicle = np.r_[False, aggregated['uniqueid'].to_numpy()[1:] == aggregated['uniqueid'].to_numpy()[:-1]]
+    aggregated['id_from'] = aggregated['id_to'].shift(1).where(same_vehicle, pd.NA).astype(pd.Int64Dtype())
+    aggregated['time_travelled'] = (aggregated['timestamp_max'] - aggregated['timestamp_min']).dt.total_seconds() \
+        .astype('int64')
+
+    return aggregated[TRACK_COLUMNS]
+
+
+def iter_vehicle_chunks(df, vehicles):
+    """
+    Yields parts of df holding at most <vehicles> vehicles each, so tracks never cross a chunk
+    """
+
+    codes, uniques = pd.factorize(df['uniqueid'])
+
+    for start in range(0, len(uniques), vehicles):
+        yield df[(codes >= start) & (codes < start + vehicles)]
+
+
+def build_tracks(frames, vehicles=1000):
+    """
+    Runs get_tracks + aggregate_tracks one vehicle chunk at a time
+    frames is a DataFrame or an iterable of DataFrames with disjoint vehicles (e.g. one per query by uniqueid range)
+    """
+
+    if isinstance(frames, pd.DataFrame):
+        frames = iter_vehicle_chunks(frames, vehicles)
+
+    chunks = [aggregate_tracks(get_tracks(frame)) for frame in frames if len(frame) != 0]
+
+    if len(chunks) == 0:
+        return pd.DataFrame([], columns=TRACK_COLUMNS)
+
+    return pd.concat(chunks, ignore_index=True)
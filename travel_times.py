@@ -0,0 +1,189 @@
+import numpy as np
+import pandas as pd
+import migration as mig
+from upload import copy_dataframe
+from utils import get_logger
+
+KEYS = ['route_id', 'id_from', 'id_to', 'hour', 'weekday']
+AGGREGATES = ['trips', 'seconds', 'histogram']
+
+# log-spaced bins from 1 second to 4 hours, ~10% relative error on quantiles
+BIN_EDGES = np.geomspace(1, 4 * 60 * 60, 97)
+BINS = len(BIN_EDGES) - 1
+
+
+def bin_index(seconds):
+    """
+    Returns histogram bin of each travel time, values outside the range go to the edge bins
+    """
+
+    return np.clip(np.searchsorted(BIN_EDGES, seconds, side='right') - 1, 0, BINS - 1)
+
+
+def quantile(histogram, q):
+    """
+    Returns q-quantile estimated from histogram counts, interpolating log-linearly inside a bin
+    """
+
+    histogram = np.asarray(histogram, dtype='float64')
+    total = histogram.sum()
+
+    if total == 0:
+        return np.nan
+
+    cumulative = np.cumsum(histogram)
+    target = q * total
+    bin_ = min(int(np.searchsorted(cumulative, target, side='left')), BINS - 1)
+    below = cumulative[bin_] - histogram[bin_]
+    fraction = (target - below) / histogram[bin_] if histogram[bin_] else 0
+
+    return float(BIN_EDGES[bin_] * (BIN_EDGES[bin_ + 1] / BIN_EDGES[bin_]) ** fraction)
+
+
+def group_histograms(keys, histograms):
+    """
+    Sums rows of histograms (2d array) and returns (unique keys frame, summed histograms, group of each row)
+    """
+
+    group, unique = pd.MultiIndex.from_frame(keys).factorize()
+
+    summed = np.zeros((len(unique), BINS), dtype='int64')
+    np.add.at(summed, group, histograms)
+
+    return unique.to_frame(index=False, name=list(keys.columns)), summed, group
+
+
+def day_aggregates(tracks_df):
+    """
+    Aggregates tracks.build_tracks output into mergeable stop-pair statistics per KEYS:
+    number of trips, total seconds and travel time histogram
+    """
+
+    df = tracks_df[tracks_df['id_from'].notna() & tracks_df['id_to'].notna()]
+
+    keys = pd.DataFrame({
+        'route_id': df['bus_id'].to_numpy(dtype='int64'),
+        'id_from': df['id_from'].to_numpy(dtype='int64'),
+        'id_to': df['id_to'].to_numpy(dtype='int64'),
+        'hour': df['timestamp_min'].dt.hour.to_numpy(dtype='int64'),
+        'weekday': df['timestamp_min'].dt.weekday.to_numpy(dtype='int64'),
+    })
+
+    seconds = df['time_travelled'].to_numpy(dtype='float64')
+
+    group, unique = pd.MultiIndex.from_frame(keys).factorize()
+
+    histograms = np.zeros((len(unique), BINS), dtype='int64')
+    np.add.at(histograms, (group, bin_index(seconds)), 1)
+
+    aggregated = unique.to_frame(index=False, name=KEYS)
+    aggregated['trips'] = histograms.sum(axis=1)
+    aggregated['seconds'] = np.bincount(group, weights=seconds, minlength=len(aggregated))
+    aggregated['histogram'] = list(histograms)
+
+    return aggregated
+
+
+def merge(left, right, sign=1):
+    """
+    Adds (sign=1) or subtracts (sign=-1) right aggregates from left by KEYS, drops keys left without trips
+    """
+
+    right = right[KEYS + AGGREGATES].copy()
+    right['trips'] *= sign
+    right['seconds'] *= sign
+    right['histogram'] = [np.asarray(histogram, dtype='int64') * sign for histogram in right['histogram']]
+
+    df = pd.concat([left[KEYS + AGGREGATES], right], ignore_index=True)
+
+    if len(df) == 0:
+        return df
+
+    merged, histograms, group = group_histograms(df[KEYS], np.stack(list(df['histogram'])).astype('int64'))
+    merged['trips'] = np.bincount(group, weights=df['trips'], minlength=len(merged)).astype('int64')
+    merged['seconds'] = np.bincount(group, weights=df['seconds'], minlength=len(merged))
+    merged['histogram'] = list(histograms)
+
+    return merged[merged['trips'] > 0].reset_index(drop=True)
+
+
+def with_quantiles(df):
+    """
+    Adds mean, p50 and p98 columns computed from aggregates
+    """
+
+    df = df.copy()
+    df['mean'] = df['seconds'] / df['trips']
+    df['p50'] = [quantile(histogram, 0.5) for histogram in df['histogram']]
+    df['p98'] = [quantile(histogram, 0.98) for histogram in df['histogram']]
+
+    return df
+
+
+def to_pg_array(histograms):
+    """
+    Formats histograms as PostgreSQL array literals for COPY
+    """
+
+    return ['{' + ','.join(str(value) for value in histogram) + '}' for histogram in histograms]
+
+
+def read_aggregates(query, engine_):
+    """
+    Reads aggregates with histogram arrays as numpy
+    """
+
+    df = pd.read_sql(query, engine_)
+    df['histogram'] = [np.asarray(histogram, dtype='int64') for histogram in df['histogram']]
+
+    return df
+
+
+def update_travel_times(tracks_df, city, date, engine_, logger_=None):
+    """
+    Applies one day of tracks to transport.travel_times without recomputing history:
+    previous contribution of (city, date) from transport.travel_times_daily is subtracted, the new one is added
+    Only keys of the day are rewritten, so re-runs of a day are idempotent
+    """
+
+    logger_ = logger_ or get_logger('travel_times')
+
+    day = day_aggregates(tracks_df)
+    old_day = read_aggregates(mig.TRAVEL_TIMES_DAILY_QUERY.format(city, date), engine_)
+
+    routes = sorted(set(day['route_id']) | set(old_day['route_id']))
+
+    if len(routes) == 0:
+        logger_.debug(f'No stop pairs for {city} {date}')
+        return 0
+
+    touched = pd.concat([day[KEYS], old_day[KEYS]]).drop_duplicates()
+    current = read_aggregates(mig.TRAVEL_TIMES_QUERY.format(', '.join(str(route) for route in routes)), engine_)
+    current = current.merge(touched, on=KEYS)
+
+    updated = with_quantiles(merge(merge(current, old_day, -1), day))
+
+    emptied = touched.merge(updated[KEYS], on=KEYS, how='left', indicator=True)
+    emptied = emptied[emptied['_merge'] == 'left_only'][KEYS]
+
+    engine_.execute(mig.TRAVEL_TIMES_STAGING_DDL)
+
+    staged = updated[KEYS + ['trips', 'seconds', 'mean', 'p50', 'p98']].copy()
+    staged['histogram'] = to_pg_array(updated['histogram'])
+    copy_dataframe(staged, 'travel_times_staging', engine_)
+
+    daily = day[KEYS + ['trips', 'seconds']].copy()
+    daily['histogram'] = to_pg_array(day['histogram'])
+    daily.insert(0, 'date', date)
+    daily.insert(0, 'city', city)
+    copy_dataframe(daily, 'travel_times_daily_staging', engine_)
+
+    with engine_.begin() as connection:
+        for row in emptied.itertuples(index=False):
+            connection.execute(mig.TRAVEL_TIMES_DELETE.format(*row))
+        connection.execute(mig.TRAVEL_TIMES_UPSERT)
+        connection.execute(mig.TRAVEL_TIMES_DAILY_REPLACE.format(city, date))
+
+    logger_.debug(f'Updated {len(updated)} stop pairs, removed {len(emptied)} for {city} {date}')
+
+    return len(updated)
@@ -1,10 +1,16 @@
+import io
 import os
 import yaml
 import pandas as pd
 import migration as mig
+import metrics
 import datetime
 from sqlalchemy import create_engine
-from utils import get_logger
+from utils import get_logger, peak_rss_mb
+from staging import is_staged, read_frame
+from manifest import FETCHED
+from dedup import Deduplicator
+from encoding import telemetry_dictionaries, encode_telemetry
 from pandas.errors import EmptyDataError
 
 
@@ -26,36 +32,118 @@ def drop_constraints(engine_):
     logger_.debug('Dropped constraints from schema')
 
 
-def load_files(config_, engine_):
+def copy_dataframe(df, relation, engine_, chunk_size=100000):
     """
-    Loads .csv files from TEMP_FOLDER
+    Streams DataFrame into transport.<relation> with COPY FROM STDIN, chunk_size rows at a time
+    All chunks are loaded in one transaction
+    """
+
+    df = df.copy()
+
+    # NaN turns integer columns into floats, which COPY would reject as "1.0"
+    for column in df.columns:
+        if df[column].dtype.kind == 'f' and (df[column].dropna() % 1 == 0).all():
+            df[column] = df[column].astype(pd.Int64Dtype())
+
+    columns = ', '.join(f'"{column}"' for column in df.columns)
+    query = f'COPY transport.{relation} ({columns}) FROM STDIN WITH (FORMAT csv)'
+
+    connection = engine_.raw_connection()
+
+    try:
+        with metrics.span('copy', relation=relation):
+            cursor = connection.cursor()
+
+            for start in range(0, len(df), chunk_size):
+                buffer = io.StringIO()
+                df.iloc[start:start + chunk_size].to_csv(buffer, index=False, header=False)
+                metrics.inc('copy_bytes', buffer.tell(), relation=relation)
+                buffer.seek(0)
+                cursor.copy_expert(query, buffer)
+
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    metrics.inc('copy_rows', len(df), relation=relation)
+
+    return len(df)
+
+
+def sync_reference(df, relation, engine_, logger_, chunk_size=100000):
+    """
+    Applies scraped cities or routes to transport.<relation> as a diff through a staging table:
+    new rows are inserted, changed rows are updated with their previous version moved to <relation>_history,
+    rows missing from df get valid_to set; unchanged rows are not touched
+    Returns dict with inserted, updated and removed counts
+    """
+
+    columns = mig.REFERENCE_COLUMNS[relation]
+    df = df[['id'] + columns].drop_duplicates('id', keep='last')
+
+    engine_.execute(mig.REFERENCE_STAGING_DDL.format(relation))
+    copy_dataframe(df, f'{relation}_staging', engine_, chunk_size)
+
+    current = ', '.join(f'r.{column}' for column in columns)
+
+    with engine_.begin() as connection:
+        connection.execute(mig.REFERENCE_HISTORY_INSERT.format(relation, ', '.join(columns), current,
+                                                               ', '.join(f's.{column}' for column in columns)))
+        upserted = connection.execute(mig.REFERENCE_UPSERT.format(
+            relation, ', '.join(columns), current,
+            '\n  , '.join(f'{column} = excluded.{column}' for column in columns),
+            ', '.join(f'excluded.{column}' for column in columns))).fetchall()
+        removed = connection.execute(mig.REFERENCE_REMOVE.format(relation, mig.REFERENCE_SCOPES[relation])).rowcount
+        connection.execute(f'DROP TABLE transport.{relation}_staging;')
+
+    counts = {'inserted': sum(1 for row in upserted if row[0]),
+              'updated': sum(1 for row in upserted if not row[0]),
+              'removed': removed}
+
+    logger_.debug(f'Synced transport.{relation}: {len(df)} scraped // ' +
+                  ' // '.join(f'{key} = {value}' for key, value in counts.items()))
+
+    return counts
+
+
+def load_files(config_, engine_, relations=None):
+    """
+    Syncs cities and routes (or only relations) from the newest .csv file of each in TEMP_FOLDER,
+    cities first so routes can reference them
+    Synced and older files are removed (REMOVE_TEMP) or renamed to .csv.synced, so a later run never
+    syncs an older scrape over a newer one
     """
 
     logger_ = get_logger('upload')
 
-    temp_files = os.listdir(config_['TEMP_FOLDER'])
+    temp_files = sorted(file_ for file_ in os.listdir(config_['TEMP_FOLDER'])
+                        if os.path.isfile('/'.join([config_['TEMP_FOLDER'], file_])) and file_.endswith('.csv')
+                        and file_.split('_')[0] in (relations or mig.REFERENCE_COLUMNS))
 
-    for file_ in temp_files:
-        if os.path.isfile('/'.join([config_['TEMP_FOLDER'], file_])) and 'csv' in file_:
-            logger_.debug(f'Processing {file_}')
+    for relation in mig.REFERENCE_COLUMNS:
+        # names end with scrape date YYYY_MM_DD, the newest sorts last
+        files = [file_ for file_ in temp_files if file_.split('_')[0] == relation]
+
+        if not files:
+            continue
 
-            relation = file_.split('_')[0]
-            df = pd.read_csv('/'.join([config_['TEMP_FOLDER'], file_]))
+        logger_.debug(f'Processing {files[-1]}' + (f', skipping older {files[:-1]}' if len(files) > 1 else ''))
 
-            engine_.execute(f"TRUNCATE TABLE transport.{relation};")
-            logger_.debug(f'Truncated transport.{relation}')
+        df = pd.read_csv('/'.join([config_['TEMP_FOLDER'], files[-1]]))
 
-            df.to_sql(relation,
-                      engine_,
-                      index=False,
-                      if_exists='append',
-                      schema='transport')
+        sync_reference(df, relation, engine_, logger_, config_.get('COPY_CHUNK_SIZE', 100000))
 
-            logger_.debug(f'Loaded {len(df)} rows to transport.{relation}')
+        for file_ in files:
+            path = '/'.join([config_['TEMP_FOLDER'], file_])
 
             if config_['REMOVE_TEMP']:
-                os.remove('/'.join([config_['TEMP_FOLDER'], file_]))
+                os.remove(path)
                 logger_.debug(f'Removed {file_}')
+            else:
+                os.replace(path, path + '.synced')
 
 
 def set_constraints(engine_):
@@ -70,13 +158,199 @@ def set_constraints(engine_):
         logger_.debug(f'Set constraints on {relation}')
 
 
-def upload_telemetry(config_, engine_):
+def read_telemetry_files(folder_path, logger_, columns=None):
+    """
+    Yields parsed telemetry DataFrames from staged files (.csv, .parquet, .arrow) of folder_path,
+    one file at a time
+    columns projection is applied to columnar formats only
+    """
+
+    for file_ in sorted(os.listdir(folder_path)):
+        if is_staged(file_):
+            try:
+                with metrics.span('read'):
+                    data = read_frame(f'{folder_path}/{file_}', None if file_.endswith('.csv') else columns)
+            except EmptyDataError:
+                logger_.debug('Empty file')
+                continue
+
+            if len(data) == 0:
+                continue
+
+            yield data
+
+
+def batch_by_day(frames, batch_size):
+    """
+    Routes rows of frames to their day and yields (date, DataFrame) batches
+    At most batch_size rows are buffered across all days, so memory does not depend on folder size
+    """
+
+    buffers = {}
+    counts = {}
+
+    def flush(date):
+        batch = pd.concat(buffers.pop(date))
+        counts.pop(date)
+        return date, batch
+
+    for frame in frames:
+        for date, part in frame.groupby(frame['timestamp'].dt.date, sort=False):
+            buffers.setdefault(date, []).append(part)
+            counts[date] = counts.get(date, 0) + len(part)
+
+            if counts[date] >= batch_size:
+                yield flush(date)
+
+        while sum(counts.values()) > batch_size:
+            yield flush(max(counts, key=counts.get))
+
+    for date in sorted(buffers):
+        yield flush(date)
+
+
+def partition_bounds(date):
+    """
+    Returns (suffix, lower, upper) of telemetry partition for date
+    """
+
+    return (date.strftime('%Y_%m_%d'),
+            date.strftime('%Y-%m-%d %H:%M:%S.%f'),
+            (date + datetime.timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S.%f'))
+
+
+def partition_exists(relation, engine_):
+    """
+    Checks if transport.<relation> exists
+    """
+
+    return engine_.execute(f"select to_regclass('transport.{relation}') is not null").fetchone()[0]
+
+
+def record_day(date, engine_):
+    """
+    Refreshes row count and timestamp range of date in transport.telemetry_days
+    """
+
+    engine_.execute(mig.TELEMETRY_DAY_UPSERT.format(date.strftime('%Y-%m-%d'), date.strftime('%Y_%m_%d')))
+
+
+def swap_partition(date, engine_, logger_):
+    """
+    Attaches transport.telemetry_<date>_staging in place of the day partition
+    Routes missing from staging are carried over from the current partition, so partial loads keep them
+    Readers see either the old or the new partition, never an empty one
+    Returns number of carried over rows
+    """
+
+    suffix, lower, upper = partition_bounds(date)
+    exists = partition_exists(f'telemetry_{suffix}', engine_)
+    carried = 0
+
+    if exists:
+        carried = engine_.execute(mig.TELEMETRY_STAGING_CARRY_OVER.format(suffix)).rowcount
+
+    # range CHECK lets ATTACH skip the validation scan while holding the lock
+    engine_.execute(mig.TELEMETRY_STAGING_FINALIZE.format(suffix, lower, upper))
+
+    with engine_.begin() as connection:
+        if exists:
+            connection.execute(mig.TELEMETRY_DETACH_DDL.format(suffix))
+        connection.execute(mig.TELEMETRY_ATTACH_DDL.format(suffix, lower, upper))
+
+    logger_.debug(f'Swapped partition telemetry_{suffix}, {carried} rows carried over')
+
+    return carried
+
+
+class DayLoader:
+    """
+    Loads telemetry batches into their day partitions and publishes each day once with finish
+    TELEMETRY_LOAD_MODE = swap (default) builds each day in a staging table and swaps it in,
+    replace drops and recreates the day partition before loading
+    with DICTIONARY_ENCODE, uniqueid and gosnum are stored as integer vehicle_id and gosnum_id
+    with SPEED_GRID, loaded days are also aggregated into transport.speed_grid
+    """
+
+    def __init__(self, config_, engine_, logger_):
+        self.engine = engine_
+        self.logger = logger_
+        self.swap = config_.get('TELEMETRY_LOAD_MODE', 'swap') == 'swap'
+        self.chunk_size = config_.get('COPY_CHUNK_SIZE', 100000)
+        self.dictionaries = telemetry_dictionaries(engine_) if config_.get('DICTIONARY_ENCODE') else None
+        self.grid = None
+
+        if config_.get('SPEED_GRID'):
+            from speed_grid import SpeedGrid
+
+            self.grid = SpeedGrid(engine_, config_.get('SPEED_GRID_CELL', 250), logger_)
+
+        self.prepared = set()
+        self.day_rows = {}
+        self.carried = {}
+        self.rows = 0
+        self.peak_batch = 0
+
+    def load(self, date, batch):
+        """
+        Copies one batch of date into its staging table (swap) or partition (replace)
+        """
+
+        if date not in self.prepared:
+            self.logger.debug(f'Processing {date.strftime("%Y-%m-%d")}')
+
+            with metrics.span('partition_ddl'):
+                if self.swap:
+                    self.engine.execute(mig.TELEMETRY_STAGING_DDL.format(date.strftime('%Y_%m_%d')))
+                else:
+                    self.engine.execute(mig.TELEMETRY_PARTITION_DDL.format(*partition_bounds(date)))
+            self.prepared.add(date)
+
+        self.logger.debug(f'Loading {len(batch)} rows...')
+
+        if self.grid is not None:
+            self.grid.add(batch)
+
+        if self.dictionaries is not None:
+            batch = encode_telemetry(batch, self.dictionaries)
+
+        relation = f'telemetry_{date.strftime("%Y_%m_%d")}_staging' if self.swap else 'telemetry'
+        copied = copy_dataframe(batch, relation, self.engine, self.chunk_size)
+        self.day_rows[date] = self.day_rows.get(date, 0) + copied
+        self.rows += copied
+        self.peak_batch = max(self.peak_batch, len(batch))
+
+        self.logger.debug('Success')
+
+    def finish(self, date):
+        """
+        Publishes date: swaps its staging table in, refreshes transport.telemetry_days and the speed grid
+        """
+
+        if date not in self.prepared:
+            return
+
+        with metrics.span('partition_ddl'):
+            if self.swap:
+                self.carried[date] = swap_partition(date, self.engine, self.logger)
+            record_day(date, self.engine)
+
+        if self.grid is not None:
+            self.grid.flush(date)
+
+
+def upload_telemetry(config_, engine_, manifest_=None):
     """
     uploads telemetry data to database
+    streams files through bounded TELEMETRY_BATCH_SIZE-row batches per day partition
+    if manifest_ is passed, only days with fetched units are loaded and loaded days are verified
+    load modes, dictionary encoding and speed grid are handled by DayLoader
     """
 
     logger_ = get_logger('load_telemetry')
 
+    batch_size = config_.get('TELEMETRY_BATCH_SIZE', 500000)
+
     temp_files = os.listdir(config_['TEMP_FOLDER'])
 
     temp_folders = []
@@ -85,57 +359,48 @@ def upload_telemetry(config_, engine_):
         if not os.path.isfile('/'.join([config_['TEMP_FOLDER'], file_])):
             temp_folders.append(file_)
 
-    logger_.debug(f'Will process these folders: {temp_folders}')
-    logger_.debug('Looking for max date')
+    if manifest_ is not None:
+        temp_folders = [folder for folder in temp_folders if folder.startswith('telemetry_') and FETCHED in
+                        manifest_.statuses(datetime.datetime.strptime(folder, 'telemetry_%Y_%m_%d').date()).values()]
 
-    date = engine_.execute("""
-        select max(date("timestamp")) as max_date
-        from transport.telemetry
-        where True
-    """).fetchone()[0]
+    logger_.debug(f'Will process these folders: {temp_folders}')
 
-    logger_.debug(f'Max date = {date}')
+    deduplicator = Deduplicator(config_, logger_) if config_.get('DEDUP', True) else None
+    loader = DayLoader(config_, engine_, logger_)
 
     for folder in sorted(temp_folders):
         logger_.debug(f'Processing {folder}')
-        dfs = []
-        for file_ in os.listdir(f'temp/{folder}'):
-            if 'csv' in file_:
-                try:
-                    data = pd.read_csv(f'temp/{folder}/{file_}')
-                    dfs.append(data)
-                except EmptyDataError:
-                    logger_.debug('Empty file')
 
-        if len(dfs) == 0:
-            logger_.debug('Dataframe is empty')
-        else:
-            df = pd.concat(dfs)
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            df['upload_date'] = pd.to_datetime(df['upload_date'])
+        frames = read_telemetry_files('/'.join([config_['TEMP_FOLDER'], folder]), logger_,
+                                      config_.get('STAGING_COLUMNS'))
+
+        if deduplicator is not None:
+            frames = deduplicator.iter(frames)
 
-            dates = list(set(df['timestamp'].dt.date))
+        for date, batch in batch_by_day(frames, batch_size):
+            loader.load(date, batch)
 
-            logger_.debug(f'Found dates: {dates}')
+        if deduplicator is not None:
+            deduplicator.forget(datetime.datetime.strptime(folder, 'telemetry_%Y_%m_%d').date() -
+                                datetime.timedelta(days=1))
 
-            for date in dates:
-                logger_.debug(f'Processing {date.strftime("%Y-%m-%d")}')
-                df_date = df[df['timestamp'].dt.date == date]
+    if deduplicator is not None:
+        deduplicator.report()
 
-                engine_.execute(mig.TELEMETRY_PARTITION_DDL.format(date.strftime('%Y_%m_%d'),
-                                                                   date.strftime('%Y-%m-%d %H:%M:%S.%f'),
-                                                                   (date + datetime.timedelta(days=1)). \
-                                                                   strftime('%Y-%m-%d %H:%M:%S.%f')))
+    for date in sorted(loader.prepared):
+        loader.finish(date)
 
-                logger_.debug('Loading...')
+    if manifest_ is not None:
+        for folder in sorted(temp_folders):
+            folder_date = datetime.datetime.strptime(folder, 'telemetry_%Y_%m_%d').date()
+            manifest_.mark_loaded(folder_date)
 
-                df_date.to_sql('telemetry',
-                               engine_,
-                               index=False,
-                               if_exists='append',
-                               schema='transport')
+            if folder_date in loader.prepared:
+                manifest_.verify_day(folder_date, engine_, loader.day_rows[folder_date],
+                                     loader.carried.get(folder_date, 0))
 
-                logger_.debug('Success')
+    logger_.debug(f'Loaded {loader.rows} rows for {len(loader.prepared)} days // '
+                  f'peak batch = {loader.peak_batch} rows // peak RSS = {peak_rss_mb():.0f} MB')
 
 
 if __name__ == '__main__':
@@ -149,6 +414,5 @@ if __name__ == '__main__':
         config['DB_NAME']
     ))
 
-    drop_constraints(postgres_engine)
+    # REFERENCE_UPSERT relies on cities_pk and routes_pk, constraints stay in place
     load_files(config, postgres_engine)
-    set_constraints(postgres_engine)
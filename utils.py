@@ -1,6 +1,7 @@
 import datetime
 import os
 import sys
+import resource
 import logging
 import hashlib
 from logging import StreamHandler, Formatter
@@ -15,6 +16,10 @@ def get_logger(name):
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
 
+    # handlers are attached once per name, repeated calls return the configured logger
+    if logger.handlers:
+        return logger
+
     stream_handler = StreamHandler(stream=sys.stdout)
     stream_handler.setFormatter(Formatter(fmt='[%(name)s: %(asctime)s: %(levelname)s] %(message)s'))
     logger.addHandler(stream_handler)
@@ -37,3 +42,14 @@ def sha256(string, size):
     """
 
     return int(hashlib.sha256(string.encode('utf-8')).hexdigest(), 16) % 10 ** size
+
+
+def peak_rss_mb():
+    """
+    Returns peak resident set size of current process in MB
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10